@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Optional
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of LLM calls in flight against the backend
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 4))
+# New chats are rejected with 429 while the longest waiting LLM call has waited longer than this
+LLM_QUEUE_SLO = float(os.getenv("LLM_QUEUE_SLO", 30))
+# Stages the user is waiting on directly, they go before planning and subtasks
+LLM_INTERACTIVE_STAGES = set(os.getenv("LLM_INTERACTIVE_STAGES", "categorize,answer,summarize").split(","))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# user the current pipeline runs for, set by process_request and inherited by the tasks it starts
+current_user: ContextVar[str] = ContextVar("current_user", default="anonymous")
+
+
+class AdmissionScheduler:
+    """
+    Limits concurrent LLM calls and hands free slots out by priority, round robin between users
+    within a priority, so one user's burst of calls doesn't delay everybody else's.
+    """
+
+    def __init__(self, concurrency: int = LLM_CONCURRENCY):
+        self.concurrency = max(concurrency, 1)
+        self.running = 0
+        # priority -> user -> waiting calls, the first user is served next
+        self._waiting: Dict[int, "OrderedDict[str, Deque[tuple[float, asyncio.Future]]]"] = {
+            INTERACTIVE: OrderedDict(),
+            BACKGROUND: OrderedDict(),
+        }
+
+    def waiting(self) -> int:
+        return sum(len(calls) for users in self._waiting.values() for calls in users.values())
+
+    def longest_wait(self) -> float:
+        """
+        Seconds the longest waiting call has been queued, 0 if nothing is waiting.
+        """
+        oldest = min((calls[0][0] for users in self._waiting.values() for calls in users.values()), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+    async def acquire(self, priority: int, user: str):
+        if self.running < self.concurrency and not self.waiting():
+            self.running += 1
+            return
+        enqueued = time.monotonic()
+        slot = asyncio.get_running_loop().create_future()
+        self._waiting[priority].setdefault(user, deque()).append((enqueued, slot))
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # the slot was handed over just before the cancellation, pass it on
+                self.release()
+            else:
+                self._discard(priority, user, slot)
+            raise
+        metrics.increment("llm_queue_wait_seconds", time.monotonic() - enqueued)
+
+    def release(self):
+        for priority in (INTERACTIVE, BACKGROUND):
+            users = self._waiting[priority]
+            while users:
+                user, calls = next(iter(users.items()))
+                _, slot = calls.popleft()
+                if calls:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                if not slot.done():
+                    # the running count stays the same, the slot changes owner
+                    slot.set_result(None)
+                    return
+        self.running -= 1
+
+    def _discard(self, priority: int, user: str, slot: asyncio.Future):
+        calls = self._waiting[priority].get(user)
+        if calls is None:
+            return
+        for entry in calls:
+            if entry[1] is slot:
+                calls.remove(entry)
+                break
+        if not calls:
+            del self._waiting[priority][user]
+
+
+scheduler = AdmissionScheduler()
+
+
+@asynccontextmanager
+async def llm_slot(stage: Optional[str] = None):
+    """
+    Holds one of the LLM backend's slots for the duration of a call.
+    """
+    priority = INTERACTIVE if stage in LLM_INTERACTIVE_STAGES else BACKGROUND
+    await scheduler.acquire(priority, current_user.get())
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+def overloaded() -> bool:
+    """
+    True if LLM calls queue longer than the SLO, new chats should then be turned away.
+    """
+    if scheduler.longest_wait() > LLM_QUEUE_SLO:
+        metrics.increment("llm_requests_shed")
+        return True
+    return False
+
+
+metrics.register_gauge("llm_calls_running", lambda: scheduler.running)
+metrics.register_gauge("llm_calls_waiting", scheduler.waiting)
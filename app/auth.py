@@ -0,0 +1,253 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import httpx
+import jwt
+from fastapi import HTTPException, status
+
+from app.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+INTROSPECTION_URL = os.getenv(
+    "INTROSPECTION_URL",
+    "https://auth.agentsphere.cloud/realms/agentsphere/protocol/openid-connect/token/introspect",
+)
+CLIENT_ID = os.getenv("CLIENT_ID", "agentserver")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 60))
+# seconds for an introspection or JWKS request, requests wait on it so it is much shorter than HTTP_TIMEOUT
+AUTH_HTTP_TIMEOUT = float(os.getenv("AUTH_HTTP_TIMEOUT", 5))
+
+# "introspect" asks Keycloak about every token, "local" verifies JWTs in-process against the realm's JWKS
+AUTH_MODE = os.getenv("AUTH_MODE", "introspect")
+TOKEN_ISSUER = os.getenv("TOKEN_ISSUER", "https://auth.agentsphere.cloud/realms/agentsphere")
+TOKEN_AUDIENCE = os.getenv("TOKEN_AUDIENCE", CLIENT_ID)
+TOKEN_ALGORITHMS = os.getenv("TOKEN_ALGORITHMS", "RS256").split(",")
+TOKEN_LEEWAY = float(os.getenv("TOKEN_LEEWAY", 10))
+# additionally introspect locally verified tokens (cached) to catch revoked sessions
+TOKEN_REVOCATION_CHECK = os.getenv("TOKEN_REVOCATION_CHECK", "false").lower() == "true"
+JWKS_URL = os.getenv("JWKS_URL", f"{TOKEN_ISSUER}/protocol/openid-connect/certs")
+# a local JWKS file replaces JWKS_URL, for offline setups and tests
+JWKS_FILE = os.getenv("JWKS_FILE")
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", 3600))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 30))
+
+# sha256(token) -> (expires_at, introspection result), least recently used first
+_token_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+# sha256(token) -> pending introspection, shared by concurrent lookups of the same token
+_inflight: Dict[str, "asyncio.Future[dict]"] = {}
+
+# kid -> signing key of the realm
+_jwks: Dict[str, jwt.PyJWK] = {}
+_jwks_fetched_at = 0.0
+_jwks_lock = asyncio.Lock()
+
+
+def _unauthorized():
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Token introspection failed"
+    )
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[dict]:
+    entry = _token_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, result = entry
+    if expires_at <= time.time():
+        _token_cache.pop(key, None)
+        return None
+    _token_cache.move_to_end(key)
+    return result
+
+
+def _cache_put(key: str, result: dict):
+    """
+    Caches an introspection result for TOKEN_CACHE_TTL seconds, but never beyond the token's own exp.
+    Inactive tokens are not cached so a freshly issued token is not shadowed by a stale answer.
+    """
+    if not result.get("active", True):
+        return
+    expires_at = time.time() + TOKEN_CACHE_TTL
+    exp = result.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, float(exp))
+    if expires_at <= time.time():
+        return
+    _token_cache[key] = (expires_at, result)
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+
+
+async def _fetch_introspection(token: str) -> dict:
+    client_secret = os.getenv("CLIENT_SECRET")
+    try:
+        response = await get_http_client().post(
+            INTROSPECTION_URL,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={"token": token, "client_id": CLIENT_ID, "client_secret": client_secret},
+            timeout=AUTH_HTTP_TIMEOUT,
+        )
+    except httpx.HTTPError as e:
+        logger.error(f"Token introspection request failed: {e}")
+        raise _unauthorized()
+    if response.status_code == 200:
+        return response.json()
+    raise _unauthorized()
+
+
+async def introspect_token(token: Optional[str]) -> dict:
+    """
+    Introspects a bearer token against Keycloak.
+
+    Results are cached per token hash and concurrent lookups of the same token share one request.
+    """
+    if token is None:
+        raise _unauthorized()
+    ctoken = token.split(" ", 1)[1] if token.startswith("Bearer ") else token
+    key = _token_key(ctoken)
+
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_fetch_introspection(ctoken))
+        _inflight[key] = future
+
+        def _done(f: "asyncio.Future[dict]"):
+            _inflight.pop(key, None)
+            if not f.cancelled() and f.exception() is None:
+                _cache_put(key, f.result())
+
+        future.add_done_callback(_done)
+    # shield so a disconnecting caller does not cancel the lookup for everyone else waiting on it
+    return await asyncio.shield(future)
+
+
+async def _fetch_jwks() -> dict:
+    if JWKS_FILE:
+        with open(JWKS_FILE) as f:
+            return json.load(f)
+    response = await get_http_client().get(JWKS_URL, timeout=AUTH_HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+async def refresh_jwks(force: bool = False) -> bool:
+    """
+    Reloads the realm's signing keys.
+
+    Unforced refreshes (unknown kid) are rate limited to one per JWKS_MIN_REFRESH_INTERVAL so
+    tokens with bogus key ids cannot make us hammer Keycloak. Returns True if the keys were reloaded.
+    """
+    global _jwks, _jwks_fetched_at
+    async with _jwks_lock:
+        if not force and time.time() - _jwks_fetched_at < JWKS_MIN_REFRESH_INTERVAL:
+            return False
+        _jwks_fetched_at = time.time()
+        try:
+            data = await _fetch_jwks()
+        except (httpx.HTTPError, OSError, ValueError) as e:
+            logger.error(f"Fetching JWKS failed: {e}")
+            return False
+
+        keys = {}
+        for jwk in data.get("keys", []):
+            if jwk.get("use", "sig") != "sig" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk)
+            except jwt.PyJWTError as e:
+                logger.warning(f"Skipping unusable JWK {jwk.get('kid')}: {e}")
+        _jwks = keys
+        logger.info(f"Loaded {len(keys)} signing keys")
+        return True
+
+
+async def jwks_refresh_loop():
+    """
+    Keeps the signing keys current in the background, started from the application lifespan.
+    """
+    while True:
+        try:
+            await refresh_jwks(force=True)
+        except Exception as e:
+            # keep refreshing, the keys loaded last stay in use meanwhile
+            logger.exception(f"Refreshing JWKS failed: {e}")
+        await asyncio.sleep(JWKS_REFRESH_INTERVAL)
+
+
+async def _signing_key(token: str) -> jwt.PyJWK:
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+    except jwt.PyJWTError:
+        raise _unauthorized()
+    key = _jwks.get(kid)
+    if key is None:
+        # unknown kid usually means the realm rotated its keys
+        await refresh_jwks()
+        key = _jwks.get(kid)
+    if key is None:
+        logger.info(f"No signing key for kid {kid}")
+        raise _unauthorized()
+    return key
+
+
+def _is_jwt(token: str) -> bool:
+    return token.count(".") == 2
+
+
+async def verify_jwt(token: str) -> dict:
+    """
+    Verifies signature, exp, aud and iss of a JWT access token in-process and returns its claims.
+    """
+    key = await _signing_key(token)
+    try:
+        return jwt.decode(
+            token,
+            key=key.key,
+            algorithms=TOKEN_ALGORITHMS,
+            audience=TOKEN_AUDIENCE or None,
+            issuer=TOKEN_ISSUER,
+            leeway=TOKEN_LEEWAY,
+            options={"require": ["exp", "iss"], "verify_aud": bool(TOKEN_AUDIENCE)},
+        )
+    except jwt.PyJWTError as e:
+        logger.info(f"Token verification failed: {e}")
+        raise _unauthorized()
+
+
+async def verify_token(token: Optional[str]) -> dict:
+    """
+    Authenticates a bearer token according to AUTH_MODE.
+
+    In local mode JWTs are verified against the cached JWKS; opaque tokens, and revocation checks
+    when TOKEN_REVOCATION_CHECK is set, still go through introspect_token.
+    """
+    if AUTH_MODE != "local" or token is None:
+        return await introspect_token(token)
+    ctoken = token.split(" ", 1)[1] if token.startswith("Bearer ") else token
+    if not _is_jwt(ctoken):
+        return await introspect_token(ctoken)
+
+    claims = await verify_jwt(ctoken)
+    if TOKEN_REVOCATION_CHECK:
+        result = await introspect_token(ctoken)
+        if not result.get("active", False):
+            raise _unauthorized()
+    return claims
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import List, Optional, Tuple
+
+import litellm
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+CLASSIFIER_ENABLED = os.getenv("CLASSIFIER_ENABLED", "true").lower() == "true"
+CLASSIFIER_EMBED_MODEL = os.getenv("CLASSIFIER_EMBED_MODEL", "ollama/mxbai-embed-large")
+# JSON lines file the labelled examples are kept in, unset keeps them in memory only
+CLASSIFIER_STORE = os.getenv("CLASSIFIER_STORE")
+# Also write the request texts to CLASSIFIER_STORE, otherwise only their embedding and a hash are kept
+CLASSIFIER_STORE_REQUESTS = os.getenv("CLASSIFIER_STORE_REQUESTS", "false").lower() == "true"
+CLASSIFIER_K = int(os.getenv("CLASSIFIER_K", 5))
+# Below these the request is categorised by the LLM instead
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv("CLASSIFIER_MIN_EXAMPLES", 20))
+CLASSIFIER_MIN_SIMILARITY = float(os.getenv("CLASSIFIER_MIN_SIMILARITY", 0.75))
+CLASSIFIER_MIN_CERTAINTY = int(os.getenv("CLASSIFIER_MIN_CERTAINTY", 8))
+# Only LLM labels at least this certain are learned from
+CLASSIFIER_LEARN_CERTAINTY = int(os.getenv("CLASSIFIER_LEARN_CERTAINTY", 7))
+CLASSIFIER_MAX_EXAMPLES = int(os.getenv("CLASSIFIER_MAX_EXAMPLES", 2000))
+
+
+def _request_key(request: str) -> str:
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class RequestClassifier:
+    """
+    Labels requests by their nearest neighbours among requests the LLM has already categorised.
+
+    Certainty is the similarity weighted share of the winning label among the k nearest examples,
+    scaled to 0-10 like CategoryResponse.certainty. Loading, classifying and learning block, callers
+    on the event loop run them in a thread (see classify_request).
+    """
+
+    def __init__(self, path: Optional[str] = CLASSIFIER_STORE, k: int = CLASSIFIER_K):
+        self.path = path
+        self.k = k
+        # (embedding, label, request key)
+        self._examples: List[Tuple[List[float], str, str]] = []
+        # keys of the requests among the examples, not to learn one again e.g. after an LLM cache hit
+        self._requests = set()
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                self._read()
+
+    def _read(self):
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    example = json.loads(line)
+                    key = example.get("request_hash") or _request_key(example["request"])
+                    self._examples.append((_normalize(example["embedding"]), example["label"], key))
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"Skipping malformed classifier example: {e}")
+        self._examples = self._examples[-CLASSIFIER_MAX_EXAMPLES:]
+        self._requests = {key for _, _, key in self._examples}
+        logger.info(f"Loaded {len(self._examples)} classifier examples from {self.path}")
+
+    def __len__(self):
+        if not self._loaded:
+            self._load()
+        return len(self._examples)
+
+    async def embed(self, request: str) -> Optional[List[float]]:
+        try:
+            response = await litellm.aembedding(model=CLASSIFIER_EMBED_MODEL, input=[request])
+        except Exception as e:
+            logger.warning(f"Embedding the request failed, categorising with the LLM: {e}")
+            return None
+        return _normalize(response.data[0]["embedding"])
+
+    def classify(self, embedding: List[float]) -> Optional[Tuple[str, int]]:
+        """
+        Returns label and certainty, or None if there are too few or too distant examples to decide.
+        """
+        if len(self) < CLASSIFIER_MIN_EXAMPLES:
+            return None
+        with self._lock:
+            examples = list(self._examples)
+        scored = heapq.nlargest(
+            self.k,
+            ((sum(a * b for a, b in zip(embedding, vector)), label) for vector, label, _ in examples),
+            key=lambda scored: scored[0],
+        )
+        if scored[0][0] < CLASSIFIER_MIN_SIMILARITY:
+            return None
+        votes = defaultdict(float)
+        for similarity, label in scored:
+            votes[label] += max(similarity, 0.0)
+        label, weight = max(votes.items(), key=lambda vote: vote[1])
+        total = sum(votes.values()) or 1.0
+        return label, round(10 * weight / total)
+
+    def learn(self, request: str, embedding: List[float], label: str):
+        if not self._loaded:
+            self._load()
+        key = _request_key(request)
+        with self._lock:
+            if key in self._requests:
+                return
+            self._requests.add(key)
+            if len(self._examples) >= CLASSIFIER_MAX_EXAMPLES:
+                self._requests.discard(self._examples.pop(0)[2])
+            self._examples.append((embedding, label, key))
+        if self.path:
+            example = {"request_hash": key, "label": label, "embedding": embedding}
+            if CLASSIFIER_STORE_REQUESTS:
+                example["request"] = request
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(example) + "\n")
+            except OSError as e:
+                logger.warning(f"Could not store classifier example: {e}")
+
+
+request_classifier = RequestClassifier()
+
+
+async def classify_request(request: str) -> Tuple[Optional[Tuple[str, int]], Optional[List[float]]]:
+    """
+    Tries to categorise a request locally.
+
+    Returns (label, certainty) if the local classifier is certain enough, else None, together with the
+    request's embedding so the LLM's answer can be learned from afterwards.
+    """
+    if not CLASSIFIER_ENABLED:
+        return None, None
+    embedding = await request_classifier.embed(request)
+    if embedding is None:
+        return None, None
+    # comparing against up to CLASSIFIER_MAX_EXAMPLES vectors takes a while, and may load the store first
+    result = await asyncio.to_thread(request_classifier.classify, embedding)
+    if result is None or result[1] < CLASSIFIER_MIN_CERTAINTY:
+        logger.info(f"Local classification {result} not certain enough, asking the LLM")
+        metrics.increment("classifier_fallbacks")
+        return None, embedding
+    metrics.increment("classifier_fast_path")
+    return result, embedding
+
+
+async def learn_request(request: str, embedding: Optional[List[float]], label: str, certainty: int):
+    if embedding is None or certainty < CLASSIFIER_LEARN_CERTAINTY:
+        return
+    await asyncio.to_thread(request_classifier.learn, request, embedding, label)
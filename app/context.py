@@ -0,0 +1,77 @@
+import logging
+import os
+from functools import lru_cache
+from typing import Awaitable, Callable, List
+
+import litellm
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Prompt tokens an agent loop may send per turn before older turns get summarised
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 16000))
+# Leading messages (system prompt and task) and trailing messages (latest turns) that are never summarised
+CONTEXT_PINNED_MESSAGES = int(os.getenv("CONTEXT_PINNED_MESSAGES", 2))
+CONTEXT_KEEP_RECENT = int(os.getenv("CONTEXT_KEEP_RECENT", 4))
+# Characters of a single tool response kept in the history, split between its head and tail
+TOOL_OUTPUT_MAX_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_CHARS", 6000))
+
+
+@lru_cache(maxsize=4096)
+def _count_text_tokens(model: str, text: str) -> int:
+    try:
+        return litellm.token_counter(model=model, text=text)
+    except Exception as e:
+        logger.debug(f"Token counting failed for {model}, estimating: {e}")
+        return len(text) // 4 + 1
+
+
+def count_tokens(model: str, messages: List[dict]) -> int:
+    # a few tokens per message for the chat template around the content
+    return sum(_count_text_tokens(model, m.get("content") or "") + 4 for m in messages)
+
+
+def clip_text(text: str, max_chars: int = TOOL_OUTPUT_MAX_CHARS) -> str:
+    """
+    Keeps head and tail of a long text and replaces the middle with a note about what was left out.
+    """
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n[... {omitted} characters omitted ...]\n{text[-tail:]}"
+
+
+async def compact_messages(
+    messages: List[dict],
+    model: str,
+    summarize: Callable[[List[dict]], Awaitable[str]],
+    budget: int = CONTEXT_TOKEN_BUDGET,
+) -> List[dict]:
+    """
+    Keeps an agent's message history within the token budget, in place.
+
+    When the history is over budget, everything between the pinned leading messages and the most
+    recent turns is replaced by a single summary message, so the prompt stays roughly constant in
+    size instead of growing with every turn.
+    """
+    tokens = count_tokens(model, messages)
+    if tokens <= budget:
+        return messages
+
+    start = CONTEXT_PINNED_MESSAGES
+    end = max(len(messages) - CONTEXT_KEEP_RECENT, start)
+    older = messages[start:end]
+    if len(older) < 2:
+        logger.warning(f"Context of {tokens} tokens exceeds budget {budget} but there is nothing to summarise")
+        return messages
+
+    logger.info(f"Context of {tokens} tokens exceeds budget {budget}, summarising {len(older)} messages")
+    summary = await summarize(older)
+    messages[start:end] = [{"role": "user", "content": f"Summary of the previous steps: {summary}"}]
+    metrics.increment("context_compactions")
+    metrics.increment("context_messages_summarised", len(older))
+    logger.info(f"Context reduced to {count_tokens(model, messages)} tokens")
+    return messages
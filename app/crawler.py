@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Set
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
+
+import httpx
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", 2))
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", 500))
+# Requests per second against the crawled site, plain HTTP and browser together
+CRAWL_RATE = float(os.getenv("CRAWL_RATE", 2.0))
+# Pages fetched at the same time and headless browsers kept for pages that need JavaScript
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 4))
+CRAWL_BROWSERS = int(os.getenv("CRAWL_BROWSERS", 2))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", 20))
+# Pages with less visible text than this but with scripts are rendered in the browser
+CRAWL_MIN_TEXT = int(os.getenv("CRAWL_MIN_TEXT", 200))
+
+SKIPPED_EXTENSIONS = (
+    ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp", ".pdf", ".zip", ".gz", ".tar",
+    ".mp4", ".mp3", ".woff", ".woff2", ".ttf", ".css", ".js", ".json", ".xml",
+)
+
+_DONE = object()
+
+
+class Page(NamedTuple):
+    url: str
+    # None if the page is unchanged since the crawl its validators come from (HTTP 304)
+    html: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+    links: List[str]
+
+
+def normalize_url(url: str, base: Optional[str] = None) -> Optional[str]:
+    """
+    Absolute form of a link without fragment, default port and trailing slash, None if it is no web page.
+    """
+    url, _ = urldefrag(urljoin(base, url) if base else url)
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return None
+    netloc = parts.hostname.lower()
+    if parts.port and parts.port != {"http": 80, "https": 443}[parts.scheme]:
+        netloc = f"{netloc}:{parts.port}"
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme, netloc, path, parts.query, ""))
+
+
+def needs_javascript(html: str) -> bool:
+    """
+    Heuristic for pages that only get their content from scripts, e.g. single page applications.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    has_scripts = soup.find("script") is not None
+    for tag in soup(["script", "style", "noscript", "template"]):
+        tag.decompose()
+    return has_scripts and len(soup.get_text(strip=True)) < CRAWL_MIN_TEXT
+
+
+class BrowserPool:
+    """
+    Headless Chrome sessions that are started on demand and reused for later pages.
+    """
+
+    def __init__(self, size: int = CRAWL_BROWSERS):
+        self.size = max(size, 1)
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._drivers: List = []
+        # browsers started or starting, reserved before the start is awaited so the pool never grows past size
+        self._started = 0
+
+    def _start(self):
+        from selenium import webdriver
+
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless=new")
+        driver = webdriver.Chrome(options=options)
+        driver.set_page_load_timeout(CRAWL_TIMEOUT)
+        return driver
+
+    @staticmethod
+    def _render(driver, url: str) -> str:
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        driver.get(url)
+        try:
+            # wait until the page stops loading resources
+            WebDriverWait(driver, 3).until(
+                lambda d: d.execute_script(
+                    """
+                    return window.performance.getEntriesByType('resource')
+                    .filter(e => ['xmlhttprequest', 'fetch', 'script', 'css', 'iframe', 'beacon', 'other'].includes(e.initiatorType)).length === 0;
+                    """
+                )
+            )
+        except Exception as e:
+            logger.debug(f"Timeout waiting for network requests of {url}: {e}")
+        return driver.page_source
+
+    async def fetch(self, url: str) -> str:
+        while True:
+            if self._idle.empty() and self._started < self.size:
+                self._started += 1
+                try:
+                    driver = await asyncio.to_thread(self._start)
+                except BaseException:
+                    self._started -= 1
+                    # a fetch waiting for this browser would wait forever, wake it to try a start itself
+                    self._idle.put_nowait(None)
+                    raise
+                self._drivers.append(driver)
+                break
+            driver = await self._idle.get()
+            if driver is not None:
+                break
+        try:
+            return await asyncio.to_thread(self._render, driver, url)
+        finally:
+            self._idle.put_nowait(driver)
+
+    def close(self):
+        for driver in self._drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.warning(f"Closing browser failed: {e}")
+        self._drivers = []
+        self._started = 0
+
+
+class Crawler:
+    """
+    Crawls the sites of the seed URLs (pages or sitemaps), following same-site links up to max_depth.
+
+    Pages are fetched with plain HTTP and only rendered in a pooled headless browser if they need
+    JavaScript. Every URL is fetched at most once, requests are spread out to `rate` per second.
+
+    `known` maps URLs of an earlier crawl to their etag, last_modified and links. Those pages are
+    requested conditionally, and an unchanged page is yielded without html and with its old links.
+    """
+
+    def __init__(
+        self,
+        seeds: Iterable[str],
+        max_depth: int = CRAWL_MAX_DEPTH,
+        max_pages: int = CRAWL_MAX_PAGES,
+        rate: float = CRAWL_RATE,
+        concurrency: int = CRAWL_CONCURRENCY,
+        browsers: Optional[BrowserPool] = None,
+        known: Optional[Dict[str, dict]] = None,
+    ):
+        self.seeds = list(seeds)
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.interval = 1 / rate if rate > 0 else 0
+        self.concurrency = max(concurrency, 1)
+        self.browsers = browsers or BrowserPool()
+        # normalized like the URLs _enqueue compares against them, e.g. without default port
+        self.sites = {urlsplit(normalize_url(seed)).netloc for seed in self.seeds if normalize_url(seed)}
+        self.known = known or {}
+        self.seen: Set[str] = set()
+        # URLs that could not be fetched, and URLs the site reports as removed
+        self.failed: Set[str] = set()
+        self.gone: Set[str] = set()
+        self.fetched = 0
+        self.rendered = 0
+        self.unchanged = 0
+        self._next_request = 0.0
+        self._throttle_lock = asyncio.Lock()
+        self._frontier: asyncio.Queue = asyncio.Queue()
+        self._pending = 0
+
+    @property
+    def complete(self) -> bool:
+        """Whether every page reachable from the seeds was fetched, i.e. pages not seen are gone."""
+        return not self.failed and len(self.seen) < self.max_pages
+
+    async def _throttle(self):
+        async with self._throttle_lock:
+            wait = self._next_request - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_request = time.monotonic() + self.interval
+
+    def _enqueue(self, url: Optional[str], depth: int):
+        if url is None or url in self.seen or len(self.seen) >= self.max_pages:
+            return
+        if urlsplit(url).netloc not in self.sites or urlsplit(url).path.lower().endswith(SKIPPED_EXTENSIONS):
+            return
+        self.seen.add(url)
+        self._pending += 1
+        self._frontier.put_nowait((url, depth))
+
+    async def _sitemap_urls(self, client: httpx.AsyncClient, url: str, nested: bool = True) -> List[str]:
+        await self._throttle()
+        response = await client.get(url)
+        response.raise_for_status()
+        urls = []
+        for entry in ET.fromstring(response.content):
+            loc = next((e.text.strip() for e in entry if e.tag.endswith("loc") and e.text), None)
+            if loc is None:
+                continue
+            # a sitemap index lists further sitemaps instead of pages
+            if entry.tag.endswith("sitemap"):
+                if nested:
+                    urls.extend(await self._sitemap_urls(client, loc, nested=False))
+            else:
+                urls.append(loc)
+        return urls
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str) -> Optional[Page]:
+        known = self.known.get(url, {})
+        headers = {}
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+        await self._throttle()
+        response = await client.get(url, headers=headers)
+        if response.status_code == 304:
+            self.unchanged += 1
+            return Page(url, None, known.get("etag"), known.get("last_modified"), known.get("links", []))
+        if response.status_code in (404, 410):
+            self.gone.add(url)
+            return None
+        response.raise_for_status()
+        if "html" not in response.headers.get("content-type", "html"):
+            return None
+        html = response.text
+        if needs_javascript(html):
+            logger.info(f"Rendering {url} in the browser")
+            await self._throttle()
+            html = await self.browsers.fetch(url)
+            self.rendered += 1
+        self.fetched += 1
+        return Page(url, html, response.headers.get("etag"), response.headers.get("last-modified"), self._links(url, html))
+
+    def _links(self, url: str, html: str) -> List[str]:
+        soup = BeautifulSoup(html, "html.parser")
+        links = (normalize_url(a["href"], base=url) for a in soup.find_all("a", href=True))
+        return list(dict.fromkeys(link for link in links if link))
+
+    async def _work(self, client: httpx.AsyncClient, pages: asyncio.Queue):
+        while True:
+            url, depth = await self._frontier.get()
+            try:
+                page = await self._fetch(client, url)
+                if page is not None:
+                    await pages.put(page)
+                    if depth < self.max_depth:
+                        for link in page.links:
+                            self._enqueue(link, depth + 1)
+            except Exception as e:
+                self.failed.add(url)
+                logger.warning(f"Fetching {url} failed: {e}")
+            finally:
+                self._pending -= 1
+                if self._pending == 0:
+                    await pages.put(_DONE)
+
+    async def pages(self) -> AsyncIterator[Page]:
+        """
+        Yields every crawled page as soon as it has been fetched.
+        """
+        pages: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        async with httpx.AsyncClient(timeout=CRAWL_TIMEOUT, follow_redirects=True) as client:
+            for seed in self.seeds:
+                if urlsplit(seed).path.lower().endswith(".xml"):
+                    try:
+                        # sitemaps list every page, there's no need to follow links
+                        for url in await self._sitemap_urls(client, seed):
+                            self._enqueue(normalize_url(url), self.max_depth)
+                    except Exception as e:
+                        self.failed.add(seed)
+                        logger.warning(f"Reading sitemap {seed} failed: {e}")
+                else:
+                    self._enqueue(normalize_url(seed), 0)
+            if self._pending == 0:
+                return
+
+            workers = [asyncio.create_task(self._work(client, pages)) for _ in range(self.concurrency)]
+            try:
+                while True:
+                    page = await pages.get()
+                    if page is _DONE:
+                        break
+                    yield page
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.to_thread(self.browsers.close)
+                logger.info(f"Crawled {self.fetched} pages, {self.rendered} rendered in the browser, "
+                            f"{self.unchanged} unchanged, {len(self.failed)} failed, {len(self.seen)} URLs seen")
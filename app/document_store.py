@@ -0,0 +1,100 @@
+import json
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class SqliteDatabase:
+    """
+    File-backed stand-in for a MongoDB database when no server is configured. Its collections
+    support the part of the pymongo API the knowledge store uses, documents are kept as JSON.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> "SqliteCollection":
+        return SqliteCollection(self, name)
+
+
+class SqliteCollection:
+    """
+    A table of JSON documents keyed by _id. Filters match fields by equality or {"$in": [...]}, a
+    field holding a list matches if any of its values does, like in MongoDB.
+    """
+
+    def __init__(self, database: SqliteDatabase, name: str):
+        if not re.fullmatch(r"[A-Za-z0-9_]+", name):
+            raise ValueError(f"Invalid collection name: {name}")
+        self.name = name
+        self._database = database
+        with database._lock:
+            database._db.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (id TEXT PRIMARY KEY, document TEXT)')
+            database._db.commit()
+
+    def _where(self, filter: Optional[dict]) -> Tuple[str, List[Any]]:
+        conditions, params = [], []
+        for field, condition in (filter or {}).items():
+            if isinstance(condition, dict):
+                if set(condition) != {"$in"}:
+                    raise ValueError(f"Unsupported filter: {condition}")
+                values = list(condition["$in"])
+            else:
+                values = [condition]
+            placeholders = ", ".join("?" * len(values))
+            if field == "_id":
+                conditions.append(f"id IN ({placeholders})")
+            elif re.fullmatch(r"[A-Za-z0-9_]+", field):
+                # json_each yields the elements of a list, or the value itself
+                conditions.append(f"EXISTS (SELECT 1 FROM json_each(document, '$.{field}') WHERE value IN ({placeholders}))")
+            else:
+                raise ValueError(f"Unsupported filter field: {field}")
+            params.extend(values)
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+    def _execute(self, sql: str, params: List[Any] = ()) -> List[tuple]:
+        with self._database._lock:
+            rows = self._database._db.execute(sql, params).fetchall()
+            self._database._db.commit()
+        return rows
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[Dict[str, int]] = None) -> List[dict]:
+        where, params = self._where(filter)
+        documents = [json.loads(row[0]) for row in self._execute(f'SELECT document FROM "{self.name}"{where}', params)]
+        if projection:
+            fields = {field for field, included in projection.items() if included} | {"_id"}
+            documents = [{k: v for k, v in document.items() if k in fields} for document in documents]
+        return documents
+
+    def find_one(self, filter: Optional[dict] = None) -> Optional[dict]:
+        documents = self.find(filter)
+        return documents[0] if documents else None
+
+    def replace_one(self, filter: dict, document: dict, upsert: bool = False):
+        id = filter["_id"]
+        if upsert:
+            self._execute(f'INSERT OR REPLACE INTO "{self.name}" (id, document) VALUES (?, ?)', [id, json.dumps({**document, "_id": id})])
+        else:
+            self._execute(f'UPDATE "{self.name}" SET document = ? WHERE id = ?', [json.dumps({**document, "_id": id}), id])
+
+    def update_one(self, filter: dict, update: dict):
+        if set(update) != {"$set"}:
+            raise ValueError(f"Unsupported update: {update}")
+        with self._database._lock:
+            where, params = self._where(filter)
+            row = self._database._db.execute(f'SELECT id, document FROM "{self.name}"{where} LIMIT 1', params).fetchone()
+            if row is not None:
+                document = {**json.loads(row[1]), **update["$set"]}
+                self._database._db.execute(f'UPDATE "{self.name}" SET document = ? WHERE id = ?', [json.dumps(document), row[0]])
+                self._database._db.commit()
+
+    def delete_one(self, filter: dict):
+        where, params = self._where(filter)
+        self._execute(f'DELETE FROM "{self.name}" WHERE id IN (SELECT id FROM "{self.name}"{where} LIMIT 1)', params)
+
+    def delete_many(self, filter: dict):
+        where, params = self._where(filter)
+        self._execute(f'DELETE FROM "{self.name}"{where}', params)
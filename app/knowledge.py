@@ -1,48 +1,244 @@
 
+import os
+import sys
+
+if __name__ == "__main__" and not __package__:
+    # started as python app/knowledge.py: import the app package from the repository root, not from
+    # this directory whose queue.py shadows the standard library. python -m app.knowledge is the same.
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import asyncio
+import hashlib
+import json
 import re
+import threading
 import time
-from typing import Any
+from typing import Any, Dict, Iterable, List, Optional, Set
 from pymilvus import MilvusClient
 import ollama
 import logging
 from markdownify import markdownify as md
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-
-from llm import getQueriesForDocument
 
-driver = webdriver.Chrome()
-import mongomock
-# Use an in-memory MongoDB mock
-client = mongomock.MongoClient()
-db = client["knowledgedb"]
-collection = db["knowledge"]
+from app.crawler import CRAWL_MAX_DEPTH, Crawler
+from app.document_store import SqliteDatabase
+from app.llm import getQueriesForDocument
+from app.pipeline import Stage, run_pipeline
 
 DOCLIMIT=6000
+EMBED_MODEL = os.getenv("EMBED_MODEL", "mxbai-embed-large")
+# Texts per embedding request and rows per Milvus insert
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+# Attempts per batch before ingestion fails
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", 3))
+# Workers per ingestion stage, fetching is configured with the CRAWL_* settings
+INGEST_SPLIT_CONCURRENCY = int(os.getenv("INGEST_SPLIT_CONCURRENCY", 2))
+INGEST_QUERY_CONCURRENCY = int(os.getenv("INGEST_QUERY_CONCURRENCY", 4))
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", 2))
+INGEST_STORE_CONCURRENCY = int(os.getenv("INGEST_STORE_CONCURRENCY", 1))
+
+# Vector index (a Milvus Lite file or a Milvus server URI) and the dimension of new collections
+KNOWLEDGE_MILVUS_URI = os.getenv("KNOWLEDGE_MILVUS_URI", "milvus_demo.db")
+KNOWLEDGE_COLLECTION = os.getenv("KNOWLEDGE_COLLECTION", "knowledge")
+KNOWLEDGE_DIMENSION = int(os.getenv("KNOWLEDGE_DIMENSION", 1024))
+# Drop the existing index and documents when the store is first used
+KNOWLEDGE_REBUILD = os.getenv("KNOWLEDGE_REBUILD", "false").lower() == "true"
+# Document store, a MongoDB server or else an SQLite file (":memory:" keeps the documents in memory,
+# the index is then rebuilt on every start as its documents are gone)
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB = os.getenv("MONGO_DB", "knowledgedb")
+# next to a Milvus Lite file if not set, so index, documents and crawled sources are kept together
+KNOWLEDGE_DOCUMENT_DB = os.getenv("KNOWLEDGE_DOCUMENT_DB")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
 logger=logging.getLogger(__name__)
 
+def emb_texts(texts):
+    response = ollama.embed(model=EMBED_MODEL, input=texts)
+    return response["embeddings"]
+
 def emb_text(text):
-    response = ollama.embeddings(model="mxbai-embed-large", prompt=text)
-    return response["embedding"]
-
-vector = MilvusClient("milvus_demo.db")
-if vector.has_collection(collection_name="knowledge"):
-    logger.info("Dropping existing collection:knowledge")
-    vector.drop_collection(collection_name="knowledge")
-
-if not vector.has_collection(collection_name="knowledge"):
-    logger.info("creating new collection: knowledge")
-    vector.create_collection(
-        collection_name="knowledge",
-        auto_id=True,
-        dimension=1024,
-    )
+    return emb_texts([text])[0]
+
+
+class KnowledgeStore:
+    """
+    Vector index of the generated queries and the documents they point to. Nothing is opened before
+    first use, an existing collection is reused as it is unless rebuild is set.
+    """
+
+    def __init__(
+        self,
+        milvus_uri: str = KNOWLEDGE_MILVUS_URI,
+        collection_name: str = KNOWLEDGE_COLLECTION,
+        dimension: int = KNOWLEDGE_DIMENSION,
+        mongo_uri: Optional[str] = MONGO_URI,
+        document_db: Optional[str] = KNOWLEDGE_DOCUMENT_DB,
+        rebuild: bool = KNOWLEDGE_REBUILD,
+    ):
+        self.milvus_uri = milvus_uri
+        self.collection_name = collection_name
+        self.dimension = dimension
+        self.mongo_uri = mongo_uri
+        if document_db is None:
+            document_db = "knowledge_documents.db" if "://" in milvus_uri else f"{os.path.splitext(milvus_uri)[0]}_documents.db"
+        self.document_db = document_db
+        self.rebuild_on_open = rebuild
+        self._vector = None
+        self._docs = None
+        self._sources = None
+        self._lock = threading.RLock()
+
+    @property
+    def vector(self) -> MilvusClient:
+        if self._vector is None:
+            with self._lock:
+                if self._vector is None:
+                    client = MilvusClient(self.milvus_uri)
+                    if client.has_collection(collection_name=self.collection_name):
+                        if self.rebuild_on_open:
+                            logger.info(f"Dropping existing collection: {self.collection_name}")
+                            client.drop_collection(collection_name=self.collection_name)
+                        elif not self.persistent_documents:
+                            # its vectors point at documents that were lost with the last process
+                            logger.warning(f"Documents are kept in memory, dropping existing collection: {self.collection_name}")
+                            client.drop_collection(collection_name=self.collection_name)
+                    self._open_collection(client)
+                    self._vector = client
+        return self._vector
+
+    @property
+    def persistent_documents(self) -> bool:
+        return bool(self.mongo_uri) or self.document_db != ":memory:"
+
+    @property
+    def docs(self):
+        if self._docs is None:
+            self._open_documents()
+        return self._docs
+
+    @property
+    def sources(self):
+        """Crawled URLs with their validators, links, content hash and the ids of their documents."""
+        if self._sources is None:
+            self._open_documents()
+        return self._sources
+
+    def _open_documents(self):
+        with self._lock:
+            if self._docs is not None:
+                return
+            if self.mongo_uri:
+                import pymongo
+
+                database = pymongo.MongoClient(self.mongo_uri)[MONGO_DB]
+            else:
+                database = SqliteDatabase(self.document_db)
+            docs = database[self.collection_name]
+            sources = database[f"{self.collection_name}_sources"]
+            if self.rebuild_on_open:
+                docs.delete_many({})
+                sources.delete_many({})
+            self._sources = sources
+            self._docs = docs
+
+    def _open_collection(self, client: MilvusClient):
+        if not client.has_collection(collection_name=self.collection_name):
+            logger.info(f"creating new collection: {self.collection_name}")
+            client.create_collection(
+                collection_name=self.collection_name,
+                auto_id=True,
+                dimension=self.dimension,
+            )
+            # sources of an earlier index would mark their pages unchanged, they'd never be embedded again
+            if self.sources.find_one() is not None:
+                logger.warning(f"Collection {self.collection_name} is new, forgetting the documents and sources of the previous one")
+                self.docs.delete_many({})
+                self.sources.delete_many({})
+            return
+        # keep the schema of the existing collection
+        fields = client.describe_collection(collection_name=self.collection_name).get("fields", [])
+        dimension = next((int(f["params"]["dim"]) for f in fields if "dim" in f.get("params", {})), self.dimension)
+        if dimension != self.dimension:
+            logger.warning(f"Collection {self.collection_name} has dimension {dimension}, not {self.dimension}, "
+                           f"set KNOWLEDGE_REBUILD=true if the embedding model changed")
+        self.dimension = dimension
+        client.load_collection(collection_name=self.collection_name)
+        logger.info(f"Reusing collection: {self.collection_name}")
+
+    def rebuild(self):
+        """Drops all vectors and documents and starts with an empty collection."""
+        with self._lock:
+            vector = self.vector
+            vector.drop_collection(collection_name=self.collection_name)
+            self._open_collection(vector)
+            self.docs.delete_many({})
+            self.sources.delete_many({})
+
+    def insert_rows(self, rows: List[dict]):
+        self.vector.insert(collection_name=self.collection_name, data=rows)
+
+    def insert_documents(self, docs: List[tuple]):
+        """Stores (id, doc) pairs, replacing documents with the same id."""
+        for id, doc in docs:
+            self.docs.replace_one({"_id": id}, {"_id": id, "doc": doc}, upsert=True)
+
+    def existing_documents(self, ids: Iterable[str]) -> Set[str]:
+        return {d["_id"] for d in self.docs.find({"_id": {"$in": list(ids)}}, {"_id": 1})}
+
+    def delete_vectors(self, ids: List[str]):
+        if ids:
+            self.vector.delete(collection_name=self.collection_name, filter=f"doc_id in {json.dumps(ids)}")
+
+    def release_documents(self, ids: Iterable[str]):
+        """Deletes the documents and their vectors that no source refers to anymore."""
+        ids = list(set(ids))
+        if not ids:
+            return
+        referenced = {id for source in self.sources.find({"doc_ids": {"$in": ids}}) for id in source["doc_ids"]}
+        orphans = [id for id in ids if id not in referenced]
+        if orphans:
+            self.delete_vectors(orphans)
+            self.docs.delete_many({"_id": {"$in": orphans}})
+            logger.info(f"Removed {len(orphans)} documents")
+
+    def known_sources(self) -> Dict[str, dict]:
+        # opening the index first drops sources whose vectors are gone, see _open_collection
+        self.vector
+        return {source["_id"]: source for source in self.sources.find()}
+
+    def replace_source(self, source: dict, old: Optional[dict] = None, keep: Iterable[str] = ()):
+        """
+        Points a URL at its new documents, then removes the old documents only it used. Documents in
+        keep are not removed, another URL is about to refer to them.
+        """
+        self.sources.replace_one({"_id": source["_id"]}, source, upsert=True)
+        if old:
+            self.release_documents(set(old.get("doc_ids", [])) - set(source.get("doc_ids", [])) - set(keep))
+
+    def remove_source(self, url: str, crawl: str):
+        """Drops a URL from a crawl, and with its documents once no crawl includes it anymore."""
+        source = self.sources.find_one({"_id": url})
+        if source is None:
+            return
+        crawls = [c for c in source.get("crawls", []) if c != crawl]
+        if crawls:
+            self.sources.update_one({"_id": url}, {"$set": {"crawls": crawls}})
+            return
+        self.sources.delete_one({"_id": url})
+        self.release_documents(source.get("doc_ids", []))
+
+    def search(self, embedding: List[float], limit: int = 10) -> List[Any]:
+        return self.vector.search(
+            collection_name=self.collection_name,
+            data=[embedding],
+            limit=limit,
+            output_fields=["query", "doc_id"],
+        )
+
+    def find_documents(self, ids: List[str]) -> List[dict]:
+        return list(self.docs.find({"_id": {"$in": ids}}))
+
+
+store = KnowledgeStore()
 
 import requests
 from bs4 import BeautifulSoup
@@ -57,26 +253,6 @@ def perform_web_search(query):
     search_results = response.json()
     return [entry['url'] for entry in search_results.get('webPages', {}).get('value', [])]
 
-def getPageWithSelenium(url):
-    driver.get(url)
-
-    try:
-        WebDriverWait(driver, 3).until(
-            lambda d: d.execute_script(
-                """
-                return window.performance.getEntriesByType('resource')
-                .filter(e => ['xmlhttprequest', 'fetch', 'script', 'css', 'iframe', 'beacon', 'other'].includes(e.initiatorType)).length === 0;
-                """
-            )
-        )
-    except Exception as e:
-        print("Timeout waiting for network requests:", e)
- 
-    page_source = driver.page_source
-    driver.quit()
-    return page_source
-
-
 def concatenate_strings(lst, max_char):
     result = []
     current_string = ""
@@ -175,51 +351,228 @@ def getDocsFromHTML(html):
    
 
 
+def withRetries(what, fn, *args, **kwargs):
+    """Calls fn, retrying EMBED_RETRIES times with backoff before the error is raised."""
+    for attempt in range(1, EMBED_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == EMBED_RETRIES:
+                logger.error(f"{what} failed after {attempt} attempts: {e}")
+                raise
+            logger.warning(f"{what} failed, retrying ({attempt}/{EMBED_RETRIES}): {e}")
+            time.sleep(2 ** attempt)
+
+
+def embedAll(texts):
+    """Embeds texts with one embedding request per EMBED_BATCH_SIZE texts."""
+    embs = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        embs.extend(withRetries(f"Embedding {len(batch)} texts", emb_texts, batch))
+    return embs
+
+
+def insertRows(rows):
+    """Inserts rows into the Milvus vector database, one insert per EMBED_BATCH_SIZE rows."""
+    for start in range(0, len(rows), EMBED_BATCH_SIZE):
+        batch = rows[start:start + EMBED_BATCH_SIZE]
+        withRetries(f"Inserting {len(batch)} rows", store.insert_rows, batch)
+        logger.info(f"Added {len(batch)} queries")
+
+
+def addQueries(queries):
+    """Embeds queries and adds them to the Milvus vector database, one embedding request and one insert per batch."""
+    valid = [q for q in queries if q and q.get("query") and q.get("doc_id")]
+    if len(valid) < len(queries):
+        logger.warning(f"Skipping {len(queries) - len(valid)} invalid queries")
+    embs = embedAll([q.get("query") for q in valid])
+    insertRows([{"vector": emb, "query": q.get("query"), "doc_id": q.get("doc_id")} for q, emb in zip(valid, embs)])
+
+
 def addQuery(query):
-    """Adds a query to the Milvus vector database with proper error handling."""
-    try:
-        if not query or not query.get("query") or not query.get("doc_id"):
-            logger.warning("Invalid query data provided. Skipping insertion.")
-            return
+    """Adds a query to the Milvus vector database."""
+    addQueries([query])
 
-        logger.info(f"Generating embedding for query: {query.get('query')}")
-        emb = emb_text(query.get("query"))
 
-        logger.info(f"Inserting query into collection: {query.get('query')} -> {query.get('doc_id')}")
-        vector.insert(
-            collection_name="knowledge",
-            data=[{"vector": emb, "query": query.get("query"), "doc_id": query.get("doc_id")}]
-        )
-        logger.info(f"Successfully added query: {query.get('query')} with doc: {query.get('doc_id')}")
-    except Exception as e:
-        logger.error(f"Error inserting query into Milvus: {e}")
+def document_hash(doc: str) -> str:
+    return hashlib.sha256(doc.encode()).hexdigest()
 
 
-def load_from_url(url):
+async def queryStage(item):
+    id, doc = item
+    queries = await getQueriesForDocument(doc)
+    logger.info(f"{queries}")
+    return [(id, doc, [str(q) for q in queries.queries or []])]
 
-    docs = getDocsFromHTML(getPageWithSelenium(url))
-    
-    for doc in docs:
-        queries = getQueriesForDocument(doc)
 
-        
-        logger.info(f"{queries}")
-        id = collection.insert_one({"doc": f"{doc}"}).inserted_id
+async def embedStage(batch):
+    """Embeds the queries of several documents together"""
+    texts = [q for _, _, queries in batch for q in queries]
+    embs = await asyncio.to_thread(embedAll, texts)
+    results = []
+    for id, doc, queries in batch:
+        results.append((id, doc, queries, embs[:len(queries)]))
+        embs = embs[len(queries):]
+    return results
+
+
+def storeDocuments(batch):
+    ids = [id for id, _, _, _ in batch]
+    # vectors left by an interrupted earlier attempt
+    store.delete_vectors(ids)
+    rows = []
+    for id, doc, queries, embs in batch:
         logger.info(f"id {id} with doc {doc[0:200]}")
-        for q in queries.queries:
-            addQuery({"query": str(q), "doc_id": str(id)})
+        rows.extend({"vector": emb, "query": q, "doc_id": id} for q, emb in zip(queries, embs))
+    insertRows(rows)
+    # a stored document marks its vectors as complete
+    store.insert_documents([(id, doc) for id, doc, _, _ in batch])
+    return ids
+
+
+class IngestRun:
+    """
+    Bookkeeping of one incremental ingestion. Documents are identified by the hash of their content,
+    so only documents that were never stored before go through query generation and embedding.
+
+    A changed URL keeps its previous documents until all of its new ones are stored, then it is
+    switched over and the old documents no other URL uses are deleted. If one of its documents
+    fails, the URL stays at its previous version and is retried by the next run.
+
+    Documents a changed URL of this run refers to are claimed before checking which already exist,
+    and are never deleted by another URL switching over, otherwise a URL could end up pointing at a
+    document that was deleted after it found it stored.
+    """
+
+    def __init__(self, crawl: str, known: Dict[str, dict]):
+        self.crawl = crawl
+        self.known = known
+        self.seen: Set[str] = set()
+        # doc id -> URLs waiting for it to be stored, URL -> doc ids it is waiting for
+        self.waiting: Dict[str, Set[str]] = {}
+        self.pending: Dict[str, Set[str]] = {}
+        # URL -> its new source record, saved once nothing is pending anymore
+        self.updates: Dict[str, dict] = {}
+        self.stored: Set[str] = set()
+        self.claimed: Set[str] = set()
+        self._claiming = asyncio.Lock()
+        self.unchanged = 0
+        self.changed = 0
+
+    async def split(self, page):
+        self.seen.add(page.url)
+        old = self.known.get(page.url)
+        source = {
+            "_id": page.url,
+            "etag": page.etag,
+            "last_modified": page.last_modified,
+            "links": page.links,
+            "crawls": sorted(set(old.get("crawls", []) if old else []) | {self.crawl}),
+        }
+        if page.html is None:
+            # not modified since the crawl the validators are from
+            self.unchanged += 1
+            await asyncio.to_thread(store.replace_source, {**old, **source})
+            return []
+
+        docs = [f"{doc}" for doc in await asyncio.to_thread(getDocsFromHTML, page.html) or []]
+        ids = [document_hash(doc) for doc in docs]
+        source["doc_ids"] = list(dict.fromkeys(ids))
+        source["hash"] = document_hash("".join(source["doc_ids"]))
+        if old and old.get("hash") == source["hash"]:
+            self.unchanged += 1
+            await asyncio.to_thread(store.replace_source, source)
+            return []
+
+        async with self._claiming:
+            self.claimed.update(source["doc_ids"])
+            existing = await asyncio.to_thread(store.existing_documents, source["doc_ids"])
+        missing, new = set(), []
+        for id, doc in zip(ids, docs):
+            if id in existing or id in self.stored or id in missing:
+                continue
+            missing.add(id)
+            if id not in self.waiting:
+                self.waiting[id] = set()
+                new.append((id, doc))
+            self.waiting[id].add(page.url)
+        self.updates[page.url] = source
+        self.pending[page.url] = missing
+        logger.info(f"{page.url} {'changed' if old else 'added'}, {len(missing)} of {len(source['doc_ids'])} documents are new")
+        if not missing:
+            await self._commit(page.url)
+        return new
+
+    async def store(self, batch):
+        ids = await asyncio.to_thread(storeDocuments, batch)
+        for id in ids:
+            self.stored.add(id)
+            for url in self.waiting.pop(id, ()):
+                self.pending[url].discard(id)
+                if not self.pending[url]:
+                    await self._commit(url)
+        return ids
+
+    async def _commit(self, url: str):
+        source = self.updates.pop(url)
+        del self.pending[url]
+        async with self._claiming:
+            await asyncio.to_thread(store.replace_source, source, self.known.get(url), self.claimed)
+        self.changed += 1
+
+    async def finish(self, crawler: Crawler):
+        """Removes the URLs of this crawl that are gone, provided the crawl reached every page."""
+        if self.updates:
+            logger.warning(f"{len(self.updates)} changed URLs kept their previous version: {list(self.updates)}")
+        removed = [url for url, source in self.known.items() if self.crawl in source.get("crawls", []) and url not in self.seen]
+        if removed and not crawler.complete:
+            logger.warning(f"Crawl incomplete, keeping {len(removed)} URLs that were not reached")
+            removed = []
+        for url in removed:
+            await asyncio.to_thread(store.remove_source, url, self.crawl)
+        logger.info(f"Ingested {self.changed} changed URLs, {self.unchanged} unchanged, {len(removed)} removed")
+
+
+async def ingest(urls, max_depth=0):
+    """
+    Loads pages into the knowledge base: crawl -> split -> query generation -> embed -> store, all
+    stages running at the same time with bounded queues in between. urls may be pages or sitemaps,
+    links are followed max_depth levels deep within their site. Returns the stages with their stats.
+
+    Ingestion is incremental: pages are requested conditionally, only new documents are processed
+    and pages of an earlier crawl of the same urls that are gone are removed (see IngestRun).
+
+    Raises PipelineError if any page or document failed, nothing is removed then. Pages that were
+    stored completely are kept, the others keep their previous version and are retried next time.
+    """
+    known = await asyncio.to_thread(store.known_sources)
+    run = IngestRun(" ".join(sorted(urls)), known)
+    crawler = Crawler(urls, max_depth=max_depth, known=known)
+    stages = await run_pipeline(crawler.pages(), [
+        Stage("split", run.split, INGEST_SPLIT_CONCURRENCY),
+        Stage("queries", queryStage, INGEST_QUERY_CONCURRENCY),
+        Stage("embed", embedStage, INGEST_EMBED_CONCURRENCY, batch_size=EMBED_BATCH_SIZE),
+        Stage("store", run.store, INGEST_STORE_CONCURRENCY, batch_size=EMBED_BATCH_SIZE),
+    ])
+    await run.finish(crawler)
+    return stages
+
 
+def load_from_url(url):
+    asyncio.run(ingest([url]))
+    return "fin"
+
+
+def load_from_site(url, max_depth=CRAWL_MAX_DEPTH):
+    """Loads the page or sitemap at url and the pages of the same site it links to."""
+    asyncio.run(ingest([url], max_depth=max_depth))
     return "fin"
 
 
 def getKnowledge(query):
 
-    resultsList = vector.search(
-            collection_name="knowledge",
-            data=[emb_text(query)],
-            limit=10,
-            output_fields=["query", "doc_id"],
-        )
+    resultsList = store.search(emb_text(query), limit=10)
 
     logger.info(f"{resultsList}")
     knowledge = f"""For query: {query} 
@@ -235,7 +588,7 @@ I have following information available:
                 idsToGet.append(result.get("entity").get("doc_id"))
     idsUnique = list(set(idsToGet))
     logger.info(f" id  {idsUnique}")
-    res = collection.find({"_id": {"$in": idsUnique}})
+    res = store.find_documents(idsUnique)
     for re in res:
         logger.info(re.get("doc"))
         knowledge += re.get("doc")
@@ -245,11 +598,15 @@ I have following information available:
     #knowledge += doc.get("doc")
    
     logger.info(knowledge)
+    return knowledge
 
-                
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
     try:
 
         #id = collection.insert_one({"doc": "asdsaddoc}"}).inserted_id
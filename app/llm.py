@@ -3,21 +3,31 @@ from enum import Enum
 import json
 import os
 from typing import Annotated, Any, Dict, Optional
-import httpx
 import litellm
 from pydantic import BaseModel, Field, conint
 import time  # Add this import at the top of the file
 
 import logging
 
+from app import metrics
+from app.admission import current_user, llm_slot
+from app.classifier import classify_request, learn_request
+from app.context import clip_text, compact_messages
+from app.llm_cache import cached_acompletion, cached_stream_completion
 from app.models import User
+from app.prompts import ANSWER_INSTRUCTIONS, PLAN_INSTRUCTIONS, REFINE_INSTRUCTIONS, SUBTASK_INSTRUCTIONS, layered_messages
 from app.queue import add_to_queue
+from app.routing import BACKEND_ERRORS, ESCALATION_CERTAINTY, cascade, model_for, model_options, models_for
+from app.scheduler import SUBTASK_CONCURRENCY, TaskGraph
+from app.streaming import IncrementalJSON, stream_completion
+from app.tools import TOOL_SUGGESTIONS_MAX_CHARS, ToolCallExecutor, cached_tool_result, clear_tool_cache, execute_tool_cached, get_tool_suggestions, is_read_only_command, parse_tool_call, prefetch_tool_suggestions
 
 logger = logging.getLogger(__name__)
-TOKEN=os.getenv("TOKEN")
 
-MODEL="ollama_chat/qwen2.5-coder:32b"
-#MODEL="gpt-4o-mini"
+# A draft plan that passes isExecutablePlan is used without the refinement pass
+PLAN_SKIP_REFINEMENT = os.getenv("PLAN_SKIP_REFINEMENT", "true").lower() == "true"
+PLAN_MAX_TASKS = int(os.getenv("PLAN_MAX_TASKS", 12))
+
 class DifficultyLevel(str, Enum):
     """Enum representing different levels of difficulty."""
     EASY = "easy"
@@ -50,61 +60,176 @@ async def categorizeRequest(chat_id: str, request: str):
     start_time = time.time()
 
     # Line to measure
-    await asyncio.create_task(add_to_queue(chat_id, f"Let me check how complex your request is... \n\n"))
+    await add_to_queue(chat_id, f"Let me check how complex your request is... \n\n")
     # End timing
     end_time = time.time()
 
     # Log the duration
     logger.info(f"Time taken for add_to_queue: {end_time - start_time:.6f} seconds")
 
-    model = MODEL
-    response = await litellm.acompletion(
-        model=model,
-        response_format=CategoryResponse,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"Categorize response, according to format: {CategoryResponse.__doc__}").model_dump(),
-            Message(role=Roles.USER.value, content=f'''Categorize following request, easy: just gathering information, even multiple sources, text generation, able to answer right away after information gathering. medium: requires special background but can be done by one, more than just gathering information. complex: Team is required, multiple roles are involved.  if you are uncertain a seconds Agent will check to confirm your category:
-                    {request}
-            ''').model_dump()
-        ],
-    )
-    logger.debug(f"respone {response}")
+    local, embedding = await classify_request(request)
+    if local is not None:
+        c = CategoryResponse(lvl=local[0], certainty=local[1])
+        logger.info(f"Categorized locally {c}")
+        await add_to_queue(chat_id, f"Category: {c.lvl} \n\n ")
+        return c
 
-    content = response.choices[0].message.content
-    logger.debug(f"content {content}")
-    c = CategoryResponse.model_validate(json.loads(content))
+    messages=[
+        Message(role=Roles.SYSTEM.value, content=f"Categorize response, according to format: {CategoryResponse.__doc__}").model_dump(),
+        Message(role=Roles.USER.value, content=f'''Categorize following request, easy: just gathering information, even multiple sources, text generation, able to answer right away after information gathering. medium: requires special background but can be done by one, more than just gathering information. complex: Team is required, multiple roles are involved.  if you are uncertain a seconds Agent will check to confirm your category:
+                {request}
+        ''').model_dump()
+    ]
+    parse = lambda content: CategoryResponse.model_validate(json.loads(content))
+    accept = lambda c: c.certainty >= ESCALATION_CERTAINTY
+    # an uncertain small model hands over to the next tier, and its answer isn't cached
+    c = await cascade(
+        "categorize",
+        lambda model: cached_acompletion(stage="categorize", validate=lambda content: accept(parse(content)), model=model, response_format=CategoryResponse, messages=messages),
+        parse,
+        accept=accept,
+    )
     logger.debug(f"c {c}")
-    await asyncio.create_task(add_to_queue(chat_id, f"Category: {c.lvl} \n\n "))
+    await learn_request(request, embedding, c.lvl.value, c.certainty)
+    await add_to_queue(chat_id, f"Category: {c.lvl} \n\n ")
     return c
 
 class SolveTask(BaseModel):
+    sequential: bool = Field(default=False, description="True if the tool calls depend on each other and must run one after another in the given order, False if they can run in parallel.")
     tool_calls: list[str] = Field(description="List of Tool calls in the format tool(param1, param2)")
     done: bool = Field(description="True if the task is done, False if not.")
     message: str = Field(description="Message to the user")
 
 
-async def execute_tool(user, toolname: str, params: Dict[str, Any]):
+async def summarizeMessages(messages: list) -> str:
+    """Summarises older turns of an agent loop so they can be dropped from its context"""
+    history = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    summaryMessages = [
+        Message(role=Roles.SYSTEM.value, content=f"You summarise the progress of an agent working on a task").model_dump(),
+        Message(role=Roles.USER.value, content=f'''Summarise the following steps concisely. Keep the commands that were executed, their important results, file paths, URLs, identifiers and errors, drop everything else:
+                {history}
+        ''').model_dump()
+    ]
+
+    async def summarize(model: str) -> str:
+        async with llm_slot("summarize"):
+            response = await litellm.acompletion(model=model, **model_options(model), messages=summaryMessages)
+        return response.choices[0].message.content
+
+    def parse(content: Optional[str]) -> str:
+        if not content or not content.strip():
+            raise ValueError("empty summary")
+        return content
+
+    return await cascade("summarize", summarize, parse)
+
+
+async def solveStep(user, chat_id: str, name: str, messages: list, done_prefix: str = "", stream: bool = True, stage: str = "answer", difficulty: Optional[str] = None):
     """
-    Calls the tool execution API with the given parameters.
+    Runs one agent turn with streamed structured output.
+
+    Read-only tool calls are started as soon as each one has been generated, a call that may change
+    state and every call after it only once the whole turn has validated as SolveTask. Calls run
+    concurrently where that is safe (see ToolCallExecutor). If the turn has no tool calls and the model
+    has set done=true, its message is forwarded to the chat while it is still being generated. Invalid
+    output is retried with the next model tier if nothing has been started yet.
+
+    Returns the parsed turn, its raw content and (tool, params, response) for every tool call, in the
+    order the model listed them.
     """
-    url = "http://127.0.0.1:8000/tools/execute"
-    headers = {"Content-Type": "application/json"}
-    if TOKEN:
-        headers["Authorization"] = f"Bearer {TOKEN}"
-
-    execution_request = ExecutionRequest(
-        toolname="bash sh",
-        params=params,
-        user=User(id=user.id, username=user.username)
-    )
+    prefix = f"{name}: {done_prefix}"
+    models = models_for(stage, difficulty)
+    await compact_messages(messages, models[0], summarizeMessages)
+
+    for i, model in enumerate(models):
+        parser = IncrementalJSON()
+        streamed = 0
+        early = True
+        executor = ToolCallExecutor(chat_id, lambda tool_call: runToolCall(user, chat_id, name, tool_call))
+
+        async def on_delta(delta: str):
+            nonlocal streamed, early
+            parser.feed(delta)
+            executor.sequential = parser.values.get("sequential") is True
+            for tool_call in parser.items.get("tool_calls", [])[len(executor):]:
+                if not early:
+                    break
+                if not isinstance(tool_call, str) or not isReadOnlyToolCall(tool_call):
+                    # must not run before the turn is known to be valid, and later calls keep their order
+                    early = False
+                    break
+                executor.submit(tool_call)
+            if not stream or parser.values.get("tool_calls") != [] or parser.values.get("done") is not True:
+                return
+            text = parser.partial_string("message")
+            if text and len(text) > streamed:
+                await add_to_queue(chat_id, (prefix if streamed == 0 else "") + text[streamed:])
+                streamed = len(text)
+
+        try:
+            try:
+                content = await stream_completion(on_delta, stage=stage, model=model, response_format=SolveTask, messages=messages)
+            except BACKEND_ERRORS as e:
+                if i == len(models) - 1 or streamed:
+                    raise
+                executor.cancel()
+                logger.warning(f"{stage}: {model} failed, escalating to {models[i + 1]}: {e}")
+                metrics.increment("model_escalations")
+                continue
+            logger.info(f"content {content}") # expecting tool call here
+            try:
+                parsedResp = SolveTask.model_validate(json.loads(content))
+            except ValueError as e:
+                # text that already went out can't be taken back, early tool calls were read-only
+                if i == len(models) - 1 or streamed:
+                    raise
+                executor.cancel()
+                logger.warning(f"{stage}: invalid output from {model}, escalating to {models[i + 1]}: {e}")
+                metrics.increment("model_escalations")
+                continue
+            executor.sequential = parsedResp.sequential
+            for tool_call in parsedResp.tool_calls[len(executor):]:
+                executor.submit(tool_call)
+            results = await executor.results()
+        except BaseException:
+            executor.cancel()
+            raise
+        break
+
+    if parsedResp.done:
+        if streamed:
+            await add_to_queue(chat_id, f"{parsedResp.message[streamed:]} \n\n")
+        else:
+            await add_to_queue(chat_id, f"{prefix}{parsedResp.message} \n\n")
+    return parsedResp, content, results
+
+
+def isReadOnlyToolCall(tool_call: str) -> bool:
+    try:
+        _, command = parse_tool_call(tool_call)
+    except ValueError:
+        return False
+    return is_read_only_command(command)
+
+
+async def runToolCall(user, chat_id: str, name: str, tool_call: str):
+    """
+    Executes a tool call in the format tool(params) and returns tool, params and the tool response.
+    """
+    tool, params = parse_tool_call(tool_call)
+    res = cached_tool_result(chat_id, params)
+    if res is not None:
+        # marked so the model knows the output is from an earlier run of the same command
+        await add_to_queue(chat_id, f"{name}: Toolcall {params} (cached) \n\n")
+        return f"{tool} (cached)", params, res
+    await add_to_queue(chat_id, f"{name}: Toolcall {params} \n\n")
 
-    logger.info(f"Sending execution request: {execution_request.model_dump_json()}")
+    async def show_output(tail: str):
+        await add_to_queue(chat_id, f"{name}: ... {tail} \n\n")
+
+    res = await execute_tool_cached(user, chat_id, tool, params, on_output=show_output)
+    return tool, params, res
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, data=execution_request.model_dump_json(), headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        return response.json()
-    
 
 async def answerRequest(user, chat_id: str,request: str):
     """
@@ -112,49 +237,22 @@ async def answerRequest(user, chat_id: str,request: str):
     """
 
     logger.info(f"Answer Request {request}")
-    await asyncio.create_task(add_to_queue(chat_id, f"Gathering information ... \n\n"))
+    await add_to_queue(chat_id, f"Gathering information ... \n\n")
 
-    model=MODEL
-    messages=[
-                Message(role=Roles.SYSTEM.value, content=f"Answer Request").model_dump(),
-                Message(role=Roles.USER.value, content=f'''Answer Request to the best of your knowledge
-                        {request}
-
-                        you can use shell(command) to execute bash/shell commands to gather the needed information, use cli tools, call APIs
-                        Follow the syntax to call shell(command) strictly: example: shell(ls -l), shell(gcloud init), shell(echo "content" >> file)
-                        if you gather the needed information set done=true and provide a message to the user.
-                ''').model_dump()
-            ]
+    messages=layered_messages(ANSWER_INSTRUCTIONS, request)
     while True:
 
-        response = await litellm.acompletion(
-            model=model,
-            response_format=SolveTask,
-            messages=messages,
-
-        )
-        content = response.choices[0].message.content
-        logger.info(f"content {content}") # expecting tool call here
-        # await asyncio.create_task(add_to_queue(chat_id, f"Superman: Content {content} \n\n"))
-        parsedResp = SolveTask.model_validate(json.loads(content))
+        parsedResp, content, results = await solveStep(user, chat_id, "Superman", messages, stage="answer")
         logger.info(f"parsedResp {parsedResp}") # expecting tool call here
-        if parsedResp.tool_calls:
-            for tool_call in parsedResp.tool_calls:
+        for tool, params, res in results:
+            # Log the message content before appending it to the messages list
+            message_content = f"Following tool execution has been executed with: Tool {tool} executed with command {params} response {clip_text(str(res))}"
+            logger.info(f"Appending message to messages list: {message_content}")
+
+            # Append the message to the messages list
+            messages.append(Message(role=Roles.USER.value, content=message_content).model_dump())
 
-                tool, params = tool_call.split("(", 1)
-                params = params[:-1]
-                await asyncio.create_task(add_to_queue(chat_id, f"Superman: Toolcall {params} \n\n"))
-                
-                res = await execute_tool(user, tool, params={"command":params})
-                # Log the message content before appending it to the messages list
-                message_content = f"Following tool execution has been executed with: Tool {tool} executed with command {params} response {res}"
-                logger.info(f"Appending message to messages list: {message_content}")
-
-                # Append the message to the messages list
-                messages.append(Message(role=Roles.USER.value, content=message_content).model_dump())
-             
         if parsedResp.done:
-            await asyncio.create_task(add_to_queue(chat_id, f"Superman: {parsedResp.message} \n\n"))
             break
 
     return parsedResp.message
@@ -191,6 +289,7 @@ class Task(BaseModel):
     test: str = Field(description="A test or validation method to ensure the task is completed correctly.")
     tool_queries: list[str] = Field(description="A list of tool quereies which might be needed to solve the task. prefer command lines or API calls over UI/Browser tools. Like ['clone git repo', 'list files', 'list directories', 'git commit']")
     context: str = Field(description="Context Information like repo urls, documentation, company programming guidelines")
+    depends_on: Optional[list[int]] = Field(default=None, description="Numbers (1-based position in the task list) of the earlier tasks that must be finished before this task can start. Empty list if the task doesn't need any other task.")
 
 class Tasks(BaseModel):
     """
@@ -200,75 +299,39 @@ class Tasks(BaseModel):
     tasks: list[Task] = Field(description="A list of individual tasks to be executed.")
 
 
-class ToolSuggestionRequest(BaseModel):
-    """Represents a request for tool suggestions based on a query and parameters."""
-    #user: Optional[User] = None
-    #token: str
-    queries: list[str]
-
-
-
-
-class ExecutionRequest(BaseModel):
-    """Represents a request to execute a tool with specific parameters."""
-    user: Optional[User] = None
-    toolname: Optional[str] = None
-    params: Optional[Dict[str, Any]] = None
-
-
-async def solveSubTask(user, agent:Agent, chat_id:str, task: Task):
+async def solveSubTask(user, agent:Agent, chat_id:str, task: Task, stream: bool = True, name: Optional[str] = None, difficulty: Optional[str] = None):
    #load_tools
     logger.info(f"task {task}")
-
-    await asyncio.create_task(add_to_queue(chat_id, f"{agent.role}: Solving subtask {task.description} \n\n"))
-    with httpx.Client() as client:
-        data = ToolSuggestionRequest(queries=task.tool_queries)
-        url = 'http://127.0.0.1:8000/tools/suggestions'  # Example URL that echoes the posted data
-        logger.info(f"Sending execution request: {data.model_dump_json()}")
-
-        responseTools = client.post(url, data=data.model_dump_json(),headers={"Content-Type": "application/json", "Authorization": f"Bearer {TOKEN}"})  # ✅ Correct async call)  # ✅ Correct async call
-    logger.info(f"responseTools {responseTools}")
-
-    messages=[
-                Message(role=Roles.SYSTEM.value, content=f"You are: {agent.model_dump()}").model_dump(),
-                Message(role=Roles.USER.value, content=f'''Shell is available 
-                        shell("command") # execute bash/shell commands to create edit files, use cli tools, call APIs
-                        whenever you want use the shell use "shell('command')" in the tool calls. you can execute multiple shell commands. Just use multiple entries in the tool_calls list.
-                        As long as the task is not done you can continue to execute tools. If you are done set done=true and provide a message to the user.
-                        Context Informtion: {task.context}
-                        Based on who you are, your background skills and tools, solve the current task:
-                        {task.description}
-                ''').model_dump()
-            ]
+    # subtasks running in parallel label their output with their task number
+    name = name or agent.role
+
+    await add_to_queue(chat_id, f"{name}: Solving subtask {task.description} \n\n")
+    # usually already looked up while the plan was generated
+    suggestions = await get_tool_suggestions(task.tool_queries)
+    logger.info(f"Tool suggestions {suggestions}")
+    suggested = f"\n\nSuggested tools: {clip_text(json.dumps(suggestions), TOOL_SUGGESTIONS_MAX_CHARS)}" if suggestions else ""
+
+    messages=layered_messages(
+        SUBTASK_INSTRUCTIONS,
+        f'''Context Informtion: {task.context}{suggested}
+
+Current task:
+{task.description}''',
+        persona=str(agent.model_dump()),
+    )
     
     while True:
 
-        content = await litellm.acompletion(
-            model=MODEL, 
-            response_format=SolveTask,
-            messages=messages,
-        )
-
-        response = content.choices[0].message.content
-        logger.info(f"content {response}") # expecting tool call here
-        parsedResp = SolveTask.model_validate(json.loads(response))
-        
-        if parsedResp.tool_calls:
-            for tool_call in parsedResp.tool_calls:
+        parsedResp, content, results = await solveStep(user, chat_id, name, messages, done_prefix="Subtask finished ", stream=stream, stage="subtask", difficulty=difficulty)
 
-                tool, params = tool_call.split("(", 1)
-                params = params[:-1]
-                await asyncio.create_task(add_to_queue(chat_id, f"{agent.role}: Toolcall {params} \n\n"))
-                
-                res = await execute_tool(user, tool, params={"command":params})
-                messages.append(Message(role=Roles.SYSTEM.value, content=f"Tool {tool} executed with params {params} res {res}").model_dump())
+        for tool, params, res in results:
+            messages.append(Message(role=Roles.SYSTEM.value, content=f"Tool {tool} executed with params {params} res {clip_text(str(res))}").model_dump())
         if parsedResp.done:
-            await asyncio.create_task(add_to_queue(chat_id, f"{agent.role}: Subtask finished {parsedResp.message} \n\n"))
             break
 
 
     """verify = await litellm.acompletion(
-        model=MODEL, 
+        model=model_for("subtask"), 
         response_format=SolveTask,
         messages=[
             Message(role=Roles.SYSTEM.value, content=f"You are: {agent.model_dump()}").model_dump(),
@@ -292,96 +355,174 @@ async def solveSubTask(user, agent:Agent, chat_id:str, task: Task):
 
  
 
-async def solveMediumRequest(user, chat_id: str, request: str):
+async def rollbackSubTask(user, agent: Agent, chat_id: str, task: Task, name: Optional[str] = None, difficulty: Optional[str] = None):
+    """Lets the agent follow the rollback instructions of a failed task, if it has any"""
+    if not task.rollback.strip():
+        return
+    rollback = Task(
+        rollback="",
+        description=f"Revert the failed task '{task.description}': {task.rollback}",
+        test="",
+        tool_queries=task.tool_queries,
+        context=task.context,
+    )
+    try:
+        await solveSubTask(user, agent=agent, chat_id=chat_id, task=rollback, stream=False, name=name, difficulty=difficulty)
+    except Exception as e:
+        logger.error(f"Rollback of task {task.description} failed: {e}")
+        await add_to_queue(chat_id, f"{name or agent.role}: Rollback failed: {e} \n\n")
+
+
+def isExecutablePlan(tasks: Tasks) -> bool:
+    """Cheap check whether a draft plan can be run as is, without another pass over it"""
+    if not tasks.tasks or len(tasks.tasks) > PLAN_MAX_TASKS:
+        return False
+    for number, task in enumerate(tasks.tasks, start=1):
+        if not task.description.strip() or not task.test.strip() or not any(q.strip() for q in task.tool_queries):
+            return False
+        if any(not 0 < d < number for d in task.depends_on or []):
+            return False
+    return True
+
+
+async def solveMediumRequest(user, chat_id: str, request: str, difficulty: str = DifficultyLevel.MEDIUM.value):
     """Solves a Request Medium complexity"""
 
     logger.info(f"solveMediumRequest {request}")
-    model="ollama_chat/qwen2.5-coder:32b"
 
-    await asyncio.create_task(add_to_queue(chat_id, f"Finding best candidate to solve your medium complex request ... \n\n"))
-
-    response = await litellm.acompletion(
-        model=model,
-        response_format=Agent,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"You are a Manager").model_dump(),
-            Message(role=Roles.USER.value, content=f'''Based on the following request, which schould be of medium complexity, which means a single agent can solve it with the appropriate background, skills and tools. Determine which role, skill, background and tool might be needed. Request:
-                    {request}
-            ''').model_dump()
-        ],
-    )
-    logger.debug(f"respone {response}")
-
-    content = response.choices[0].message.content
-
-    logger.debug(f"content {content}")
-    c = Agent.model_validate(json.loads(content))
-    logger.info(f"Agent {c}")
-    await asyncio.create_task(add_to_queue(chat_id, f"Starting Agent with role {c.role} with background '{c.background}' ... \n\n"))
-
-
-    # Gather information
-
-    
-    requestImproved = await litellm.acompletion(
-        model=model,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"You are: {c.model_dump()}").model_dump(),
-            Message(role=Roles.USER.value, content=f'''
-                    Be conscise and clear in your following request.
-                    Based on who you are, your background skills and tools. Analyse the request and make it more concrete add information which might be necessary so that an intern could solve the request. Add information like best practices to follow when using tools and solving tasks to fulfull the request. Request:
-                    Don't provide too much information, just the necessary information to solve the request.
-                    {request}
-            ''').model_dump()
-        ],
-    )
-    requestImprovedTxt= requestImproved.choices[0].message.content
-    await asyncio.create_task(add_to_queue(chat_id, f"{c.role}: I have refined your original request for further processing: '{requestImprovedTxt}' ... \n\n"))
-
-
-    await asyncio.create_task(add_to_queue(chat_id, f"{c.role}: Breaking down your request into executable subtasks ... \n\n"))
-   
-    response = await litellm.acompletion(
-        model=model,
-        response_format=Tasks,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"You are: {c.model_dump()}").model_dump(),
-            Message(role=Roles.USER.value, content=f'''Based on who you are, your background skills and tools. Analyse the request and break it down into multiple executable tasks, including tasks to test if the request is fullfilled, including steps to rollback to be able to revert if something goes wrong. Always consider Best practices for the considered tool and workflow you use. Request:
-                    {requestImprovedTxt}
-            ''').model_dump()
-        ],
-    )
-    currentTasks= response.choices[0].message.content
-
-    response = await litellm.acompletion(
-        model=model,
-        response_format=Tasks,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"You are: {c.model_dump()}").model_dump(),
-            Message(role=Roles.USER.value, content=f'''Context: 
-                    Original Request: {requestImprovedTxt}
-                    
-                    currentTasks: {currentTasks}
-                    
-                    Based on who you are, your background skills and tools. Analyse the currentTasks if they are executcable steps to solve the given original Request. Improve the given tasks. If the rollback is not needed leave it blank, make the tool queries concise and favour bash, sh, cli calls and mentiond the bash, sh, cli within the tool queries whenever used. Always consider Best practices for the considered tool and workflow you use (i.e. if your all dealing with code use git repo, never push to main use PRs and so on). Request:
-                    {request}
-            ''').model_dump()
-        ],
-    )
-
-
-    logger.debug(f"solve reponse {response}")
-    content = response.choices[0].message.content
-    logger.info(f"Tasks {content}")
-
-    tasks = Tasks.model_validate(json.loads(content))
-    taskString = "\n\n".join([f"* {task.description}" for task in tasks.tasks]) + "\n\n ... "
-    await asyncio.create_task(add_to_queue(chat_id, f"{c.role}: Tasks: \n\n {taskString}"))
-
-    # Creating jira Subtasks, toDO
-
-    for task in tasks.tasks:
-        await solveSubTask(user, agent=c,chat_id=chat_id, task=task)
+    await add_to_queue(chat_id, f"Finding best candidate to solve your medium complex request ... \n\n")
+
+    # Agent selection and a draft breakdown only need the original request, so they run at the same
+    # time. The request is only refined, by the selected agent, if the draft needs the planning pass.
+    agentMessages=[
+        Message(role=Roles.SYSTEM.value, content=f"You are a Manager").model_dump(),
+        Message(role=Roles.USER.value, content=f'''Based on the following request, which schould be of medium complexity, which means a single agent can solve it with the appropriate background, skills and tools. Determine which role, skill, background and tool might be needed. Request:
+                {request}
+        ''').model_dump()
+    ]
+    breakdownMessages=[
+        Message(role=Roles.SYSTEM.value, content=f"You are a Manager").model_dump(),
+        Message(role=Roles.USER.value, content=f'''Analyse the request and break it down into multiple executable tasks, including tasks to test if the request is fullfilled, including steps to rollback to be able to revert if something goes wrong. If the rollback is not needed leave it blank, make the tool queries concise and favour bash, sh, cli calls. Always consider Best practices for the considered tool and workflow you use. Request:
+                {request}
+        ''').model_dump()
+    ]
+
+    agentTask = asyncio.create_task(cascade(
+        "agent",
+        lambda model: cached_acompletion(stage="agent", model=model, response_format=Agent, messages=agentMessages),
+        lambda content: Agent.model_validate(json.loads(content)),
+        difficulty=difficulty,
+    ))
+    draftTask = asyncio.create_task(cascade(
+        "breakdown",
+        lambda model: cached_acompletion(stage="breakdown", model=model, response_format=Tasks, messages=breakdownMessages),
+        lambda content: Tasks.model_validate(json.loads(content)),
+        difficulty=difficulty,
+    ))
+    try:
+        c = await agentTask
+        logger.info(f"Agent {c}")
+        await add_to_queue(chat_id, f"Starting Agent with role {c.role} with background '{c.background}' ... \n\n")
+        draft = await draftTask
+        # subtasks find their tool suggestions ready, the refined plan mostly asks for the same ones
+        prefetch_tool_suggestions(*(task.tool_queries for task in draft.tasks))
+    except BaseException:
+        for pending in (agentTask, draftTask):
+            pending.cancel()
+        raise
+
+    executable = PLAN_SKIP_REFINEMENT and isExecutablePlan(draft)
+    if not executable:
+        await add_to_queue(chat_id, f"{c.role}: I have refined your original request for further processing: '")
+        requestImprovedTxt = await cached_stream_completion(
+            lambda delta: add_to_queue(chat_id, delta),
+            stage="refine",
+            model=model_for("refine", difficulty),
+            messages=layered_messages(REFINE_INSTRUCTIONS, request, persona=str(c.model_dump())),
+        )
+        await add_to_queue(chat_id, "' ... \n\n")
+    await add_to_queue(chat_id, f"{c.role}: Breaking down your request into executable subtasks ... \n\n")
+    currentTasks = draft.model_dump_json()
+
+    # A draft that already looks executable is run as it is. Otherwise the refined plan is streamed and
+    # every task is handed to the scheduler as soon as it has been generated, so the first tasks run
+    # while the model is still writing the remaining ones.
+    await add_to_queue(chat_id, f"{c.role}: Tasks: \n\n")
+    parser = IncrementalJSON()
+    seen = 0
+    plan_done = False
+
+    async def run_task(number: int, task: Task):
+        # streamed answers would interleave with the plan or with parallel subtasks
+        stream = plan_done and SUBTASK_CONCURRENCY == 1
+        await solveSubTask(user, agent=c,chat_id=chat_id, task=task, stream=stream, name=f"{c.role} [task {number}]", difficulty=difficulty)
+
+    async def rollback_task(number: int, task: Task, error: Exception):
+        await add_to_queue(chat_id, f"{c.role} [task {number}]: Subtask failed: {error} \n\n")
+        await rollbackSubTask(user, c, chat_id, task, name=f"{c.role} [task {number}]", difficulty=difficulty)
+
+    async def skip_task(number: int, task: Task, dependency: int):
+        await add_to_queue(chat_id, f"{c.role} [task {number}]: Skipping subtask {task.description}, task {dependency} did not succeed \n\n")
+
+    graph = TaskGraph(run_task, on_failure=rollback_task, on_skip=skip_task)
+
+    async def schedule(task: Task):
+        nonlocal seen
+        seen += 1
+        prefetch_tool_suggestions(task.tool_queries)
+        await add_to_queue(chat_id, f"* {seen}. {task.description}\n\n")
+        # without declared dependencies a task conservatively waits for the one before it
+        depends_on = task.depends_on if task.depends_on is not None else [seen - 1]
+        graph.add(seen, task, depends_on=[d for d in depends_on if 0 < d < seen])
+
+    async def on_delta(delta: str):
+        parser.feed(delta)
+        for item in parser.items.get("tasks", [])[seen:]:
+            await schedule(Task.model_validate(item))
+
+    try:
+        if executable:
+            logger.info(f"Draft plan is executable, skipping its refinement")
+            metrics.increment("plan_refinements_skipped")
+            content = currentTasks
+            for task in draft.tasks:
+                await schedule(task)
+            plan_done = True
+        else:
+            content = await stream_completion(
+                on_delta,
+                stage="plan",
+                model=model_for("plan", difficulty),
+                response_format=Tasks,
+                messages=layered_messages(
+                    PLAN_INSTRUCTIONS,
+                    f'''Original Request: {requestImprovedTxt}
+
+currentTasks: {currentTasks}
+
+Request:
+{request}''',
+                    persona=str(c.model_dump()),
+                ),
+            )
+            plan_done = True
+            logger.info(f"Tasks {content}")
+
+            tasks = Tasks.model_validate(json.loads(content))
+            for task in tasks.tasks[seen:]:
+                await schedule(task)
+
+        # Creating jira Subtasks, toDO
+
+        outcomes = await graph.wait()
+    except BaseException:
+        # stops subtasks that already started when planning fails or the chat is cancelled
+        graph.cancel()
+        raise
+
+    failed = [str(number) for number, ok in outcomes.items() if not ok]
+    if failed:
+        await add_to_queue(chat_id, f"{c.role}: Tasks {', '.join(failed)} did not succeed \n\n")
       
     return content
 
@@ -389,29 +530,24 @@ class Queries(BaseModel):
     queries: Optional[list[str]] = Field(default = None, description="A list of query strings to be processed.")
 
 
-def getQueriesForDocument(doc):
-    response = litellm.completion(
-        model=MODEL,
-        response_format=Queries,
-        messages=[
-            Message(role=Roles.SYSTEM.value, content=f"You are a research query specialist").model_dump(),
-            Message(role=Roles.USER.value, content=f'''Given the following Documentation: 
+async def getQueriesForDocument(doc):
+    messages=[
+        Message(role=Roles.SYSTEM.value, content=f"You are a research query specialist").model_dump(),
+        Message(role=Roles.USER.value, content=f'''Given the following Documentation: 
+            
+                {doc}
                 
-                    {doc}
-                    
-                    ________________________________________
-
-                    Return a list of short search queries users and ai agents might use to search for the provided information in the documentation.
-                    Each search query should contain 8-15 words
-            ''').model_dump()
-        ],
-    ) 
-    logger.debug(f"solve reponse {response}")
-    content = response.choices[0].message.content
-    logger.info(f" {content}")
-
-    queries = Queries.model_validate(json.loads(content))
-    return queries
+                ________________________________________
+
+                Return a list of short search queries users and ai agents might use to search for the provided information in the documentation.
+                Each search query should contain 8-15 words
+        ''').model_dump()
+    ]
+    return await cascade(
+        "queries",
+        lambda model: cached_acompletion(stage="queries", model=model, response_format=Queries, messages=messages),
+        lambda content: Queries.model_validate(json.loads(content)),
+    )
 
 
 async def process_request(user, chat_id: str, request: str):
@@ -420,13 +556,26 @@ async def process_request(user, chat_id: str, request: str):
     """
     
     logger.info(f"Processing request {request} for client_id {chat_id}")
-    category = await categorizeRequest(chat_id, request)
-
-    if category:
-        if category.lvl == DifficultyLevel.EASY:
-            await answerRequest(user, chat_id, request)
-        elif category.lvl == DifficultyLevel.MEDIUM or category.lvl == DifficultyLevel.COMPLEX:
-            await solveMediumRequest(user, chat_id,request)
-    await asyncio.create_task(add_to_queue(chat_id, "[DONE]"))
+    # LLM calls of this pipeline and its subtasks queue as this user
+    current_user.set(user.id or user.username or "anonymous")
+    try:
+        category = await categorizeRequest(chat_id, request)
+
+        if category:
+            if category.lvl == DifficultyLevel.EASY:
+                await answerRequest(user, chat_id, request)
+            elif category.lvl == DifficultyLevel.MEDIUM or category.lvl == DifficultyLevel.COMPLEX:
+                await solveMediumRequest(user, chat_id,request, difficulty=category.lvl.value)
+    except asyncio.CancelledError:
+        logger.info(f"Processing request for client_id {chat_id} cancelled")
+        raise
+    except Exception as e:
+        # tell the client before the stream ends, start_chat_task logs and counts the failure
+        await add_to_queue(chat_id, f"Processing your request failed: {e} \n\n")
+        raise
+    finally:
+        clear_tool_cache(chat_id)
+        # ends the client's stream whether the pipeline finished, failed or was cancelled
+        await add_to_queue(chat_id, "[DONE]")
     return "fin"
     
\ No newline at end of file
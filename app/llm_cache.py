@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+import litellm
+from pydantic import BaseModel
+
+from app import metrics
+from app.admission import llm_slot
+from app.routing import model_options
+from app.streaming import stream_completion
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+# Entries kept in memory
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 512))
+# SQLite file for the on-disk tier, unset keeps the cache in memory only
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_DB_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DB_MAX_ENTRIES", 20000))
+
+# Request parameters that change the response and are therefore part of the key
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "seed", "max_tokens", "stop", "presence_penalty", "frequency_penalty")
+
+
+def cache_key(kwargs: dict) -> str:
+    """
+    Derives the cache key of a completion request from model, messages, response format and sampling params.
+    """
+    response_format = kwargs.get("response_format")
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        response_format = response_format.model_json_schema()
+    payload = {
+        "model": kwargs.get("model"),
+        "messages": kwargs.get("messages"),
+        "response_format": response_format,
+        "params": {k: kwargs[k] for k in SAMPLING_PARAMS if k in kwargs},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class LLMCache:
+    """
+    Two tier cache of completion contents: an in-memory LRU in front of an optional SQLite file.
+    aget and aput keep the SQLite reads and writes off the event loop.
+    """
+
+    def __init__(self, size: int = LLM_CACHE_SIZE, path: Optional[str] = LLM_CACHE_DB,
+                 ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_DB_MAX_ENTRIES):
+        self.size = size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._rows = 0
+        self._lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, content TEXT, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created)")
+            self._db.commit()
+            self._rows = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        content = self._get_memory(key)
+        if content is None and self._db is not None:
+            content = self._get_disk(key)
+        if content is None:
+            metrics.increment("llm_cache_misses")
+        return content
+
+    async def aget(self, key: str) -> Optional[str]:
+        content = self._get_memory(key)
+        if content is None and self._db is not None:
+            content = await asyncio.to_thread(self._get_disk, key)
+        if content is None:
+            metrics.increment("llm_cache_misses")
+        return content
+
+    def put(self, key: str, content: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+        if self._db is not None:
+            self._put_disk(key, content, now)
+
+    async def aput(self, key: str, content: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+        if self._db is not None:
+            await asyncio.to_thread(self._put_disk, key, content, now)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                metrics.increment("llm_cache_hits_memory")
+                return entry[1]
+            self._memory.pop(key, None)
+        return None
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT content, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] >= self.ttl:
+                return None
+            self._remember(key, row[0], row[1])
+        metrics.increment("llm_cache_hits_disk")
+        return row[0]
+
+    def _put_disk(self, key: str, content: str, created: float):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO llm_cache (key, content, created) VALUES (?, ?, ?)", (key, content, created))
+            # counts replaced keys too, that only makes the next eviction come a bit early
+            self._rows += 1
+            if self._rows > self.max_entries:
+                self._evict()
+            self._db.commit()
+
+    def _remember(self, key: str, content: str, created: float):
+        self._memory[key] = (created, content)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        """Deletes expired entries and the oldest ones down to 90% of max_entries, so it runs once in a while."""
+        self._db.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries * 9 // 10,),
+        )
+        self._rows = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+llm_cache = LLMCache()
+
+
+def _valid(content: Optional[str], kwargs: dict, validate: Optional[Callable[[str], Any]]) -> bool:
+    """
+    Whether content may be cached or served from the cache: it is not empty, matches the
+    response_format model if there is one and validate (if given) returns a truthy value without raising.
+    """
+    if not content:
+        return False
+    try:
+        response_format = kwargs.get("response_format")
+        if hasattr(response_format, "model_validate_json"):
+            response_format.model_validate_json(content)
+        return validate is None or bool(validate(content))
+    except Exception:
+        return False
+
+
+def _cached(key: Optional[str], kwargs: dict, validate: Optional[Callable[[str], Any]]) -> Optional[str]:
+    if key is None:
+        return None
+    content = llm_cache.get(key)
+    # entries that don't pass validation (anymore) are treated as misses and replaced
+    return content if content is not None and _valid(content, kwargs, validate) else None
+
+
+async def _acached(key: Optional[str], kwargs: dict, validate: Optional[Callable[[str], Any]]) -> Optional[str]:
+    if key is None:
+        return None
+    content = await llm_cache.aget(key)
+    return content if content is not None and _valid(content, kwargs, validate) else None
+
+
+def _store(key: Optional[str], content: Optional[str], kwargs: dict, validate: Optional[Callable[[str], Any]]):
+    if key is not None and _valid(content, kwargs, validate):
+        llm_cache.put(key, content)
+
+
+async def _astore(key: Optional[str], content: Optional[str], kwargs: dict, validate: Optional[Callable[[str], Any]]):
+    if key is not None and _valid(content, kwargs, validate):
+        await llm_cache.aput(key, content)
+
+
+async def cached_acompletion(stage: Optional[str] = None, validate: Optional[Callable[[str], Any]] = None, **kwargs) -> str:
+    """
+    litellm.acompletion for calls whose result only depends on their input, returns the message content.
+
+    Only content that parses as the response_format model and passes validate is cached, so a
+    truncated or rejected answer is asked for again next time instead of being served for LLM_CACHE_TTL.
+    """
+    key = cache_key(kwargs) if LLM_CACHE_ENABLED else None
+    content = await _acached(key, kwargs, validate)
+    if content is not None:
+        return content
+    async with llm_slot(stage):
+        response = await litellm.acompletion(**{**model_options(kwargs.get("model", "")), **kwargs})
+    content = response.choices[0].message.content
+    await _astore(key, content, kwargs, validate)
+    return content
+
+
+def cached_completion(validate: Optional[Callable[[str], Any]] = None, **kwargs) -> str:
+    """
+    Synchronous counterpart of cached_acompletion around litellm.completion.
+    """
+    key = cache_key(kwargs) if LLM_CACHE_ENABLED else None
+    content = _cached(key, kwargs, validate)
+    if content is not None:
+        return content
+    response = litellm.completion(**{**model_options(kwargs.get("model", "")), **kwargs})
+    content = response.choices[0].message.content
+    _store(key, content, kwargs, validate)
+    return content
+
+
+async def cached_stream_completion(on_delta: Optional[Callable[[str], Awaitable[Any]]] = None, stage: Optional[str] = None, validate: Optional[Callable[[str], Any]] = None, **kwargs) -> str:
+    """
+    stream_completion with caching like cached_acompletion, a cached result is passed to on_delta in one piece.
+    """
+    key = cache_key(kwargs) if LLM_CACHE_ENABLED else None
+    content = await _acached(key, kwargs, validate)
+    if content is not None:
+        if on_delta is not None:
+            await on_delta(content)
+        return content
+    content = await stream_completion(on_delta, stage=stage, **kwargs)
+    await _astore(key, content, kwargs, validate)
+    return content
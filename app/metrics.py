@@ -0,0 +1,31 @@
+import logging
+from collections import defaultdict
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# monotonically increasing counters, e.g. evictions or cache hits
+counters: Dict[str, float] = defaultdict(float)
+# gauges are evaluated when a snapshot is taken
+gauges: Dict[str, Callable[[], float]] = {}
+
+
+def increment(name: str, value: float = 1):
+    counters[name] += value
+
+
+def register_gauge(name: str, fn: Callable[[], float]):
+    gauges[name] = fn
+
+
+def snapshot() -> Dict[str, float]:
+    """
+    Returns the current value of all counters and gauges.
+    """
+    values = dict(counters)
+    for name, fn in gauges.items():
+        try:
+            values[name] = fn()
+        except Exception as e:
+            logger.error(f"Evaluating gauge {name} failed: {e}")
+    return values
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Items waiting between two stages, a full queue makes the stage before it wait
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 16))
+# Seconds between progress reports
+PIPELINE_REPORT_INTERVAL = float(os.getenv("PIPELINE_REPORT_INTERVAL", 10))
+
+_END = object()
+
+
+class PipelineError(Exception):
+    """Raised by run_pipeline once it has finished if any item failed in any stage."""
+
+    def __init__(self, stages: List["Stage"]):
+        self.stages = stages
+        failures = ", ".join(f"{stage.name}: {stage.failed}" for stage in stages if stage.failed)
+        super().__init__(f"Pipeline items failed ({failures})")
+
+
+class Stage:
+    """
+    One step of a pipeline: `run` gets an item (a list of up to batch_size items if batch_size is set)
+    and returns the items for the next stage, `concurrency` workers run it at the same time.
+    """
+
+    def __init__(self, name: str, run: Callable[[Any], Awaitable[Optional[Iterable[Any]]]], concurrency: int = 1, batch_size: Optional[int] = None):
+        self.name = name
+        self.run = run
+        self.concurrency = max(concurrency, 1)
+        self.batch_size = batch_size
+        self.received = 0
+        self.emitted = 0
+        self.failed = 0
+        self.busy = 0.0
+
+    def report(self, elapsed: float) -> str:
+        rate = self.received / elapsed if elapsed else 0.0
+        return (f"{self.name}: {self.received} in, {self.emitted} out, {self.failed} failed, "
+                f"{rate:.2f}/s, busy {self.busy:.1f}s over {self.concurrency} workers")
+
+
+async def _worker(stage: Stage, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue]):
+    while True:
+        item = await inbox.get()
+        if item is _END:
+            return
+        if stage.batch_size:
+            # take whatever else is already waiting, up to a full batch
+            items = [item]
+            while len(items) < stage.batch_size and not inbox.empty():
+                more = inbox.get_nowait()
+                if more is _END:
+                    # leave the end marker for this worker's next round
+                    inbox.put_nowait(_END)
+                    break
+                items.append(more)
+            item = items
+        stage.received += len(item) if stage.batch_size else 1
+        started = time.monotonic()
+        try:
+            results = await stage.run(item)
+        except Exception as e:
+            logger.error(f"{stage.name} failed: {e}")
+            stage.failed += len(item) if stage.batch_size else 1
+            continue
+        finally:
+            stage.busy += time.monotonic() - started
+        for result in results or []:
+            stage.emitted += 1
+            if outbox is not None:
+                await outbox.put(result)
+
+
+async def _report(stages: List[Stage], started: float):
+    while True:
+        await asyncio.sleep(PIPELINE_REPORT_INTERVAL)
+        elapsed = time.monotonic() - started
+        for stage in stages:
+            logger.info(f"Pipeline progress {stage.report(elapsed)}")
+
+
+async def run_pipeline(items: Union[Iterable[Any], AsyncIterable[Any]], stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE) -> List[Stage]:
+    """
+    Passes items through the stages with bounded queues in between, all stages running at the same
+    time, so throughput is limited by the slowest stage. A failing item is logged, counted and dropped,
+    the other items still run through. items may be an async iterable, e.g. pages coming in from a crawl.
+
+    Returns the stages with their counters, raises PipelineError at the end if any item failed.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    started = time.monotonic()
+    reporter = asyncio.create_task(_report(stages, started))
+
+    async def run_stage(i: int, stage: Stage):
+        outbox = queues[i + 1] if i + 1 < len(stages) else None
+        await asyncio.gather(*(_worker(stage, queues[i], outbox) for _ in range(stage.concurrency)))
+        if outbox is not None:
+            for _ in range(stages[i + 1].concurrency):
+                await outbox.put(_END)
+
+    async def feed():
+        if hasattr(items, "__aiter__"):
+            async for item in items:
+                await queues[0].put(item)
+        else:
+            for item in items:
+                await queues[0].put(item)
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_END)
+
+    runners = [asyncio.create_task(run_stage(i, stage)) for i, stage in enumerate(stages)]
+    try:
+        await asyncio.gather(feed(), *runners)
+    except BaseException:
+        for runner in runners:
+            runner.cancel()
+        raise
+    finally:
+        reporter.cancel()
+
+    elapsed = time.monotonic() - started
+    for stage in stages:
+        logger.info(f"Pipeline finished {stage.report(elapsed)}")
+    if any(stage.failed for stage in stages):
+        raise PipelineError(stages)
+    return stages
@@ -0,0 +1,35 @@
+from typing import List, Optional
+
+# Fixed instructions of the prompts that are sent over and over (every turn of an agent loop, every
+# subtask). They are kept free of per-request content and sent first, so the backend can reuse the
+# prompt cache of this prefix instead of evaluating it again.
+
+ANSWER_INSTRUCTIONS = '''Answer Request to the best of your knowledge.
+
+you can use shell(command) to execute bash/shell commands to gather the needed information, use cli tools, call APIs
+Follow the syntax to call shell(command) strictly: example: shell(ls -l), shell(gcloud init), shell(echo "content" >> file)
+if you gather the needed information set done=true and provide a message to the user.'''
+
+SUBTASK_INSTRUCTIONS = '''Shell is available
+shell("command") # execute bash/shell commands to create edit files, use cli tools, call APIs
+whenever you want use the shell use "shell('command')" in the tool calls. you can execute multiple shell commands. Just use multiple entries in the tool_calls list.
+As long as the task is not done you can continue to execute tools. If you are done set done=true and provide a message to the user.
+Based on who you are, your background skills and tools, solve the task given by the user.'''
+
+REFINE_INSTRUCTIONS = '''Be conscise and clear in your following request.
+Based on who you are, your background skills and tools. Analyse the request given by the user and make it more concrete add information which might be necessary so that an intern could solve the request. Add information like best practices to follow when using tools and solving tasks to fulfull the request.
+Don't provide too much information, just the necessary information to solve the request.'''
+
+PLAN_INSTRUCTIONS = '''Based on who you are, your background skills and tools. Analyse the currentTasks given by the user if they are executcable steps to solve the given original Request. Improve the given tasks. If the rollback is not needed leave it blank, make the tool queries concise and favour bash, sh, cli calls and mentiond the bash, sh, cli within the tool queries whenever used. Always consider Best practices for the considered tool and workflow you use (i.e. if your all dealing with code use git repo, never push to main use PRs and so on).'''
+
+
+def layered_messages(instructions: str, content: str, persona: Optional[str] = None) -> List[dict]:
+    """
+    Builds the leading system and user message of a prompt, most stable part first: the fixed
+    instructions, then the persona (shared by chats with the same agent), then the variable content.
+    """
+    system = instructions if persona is None else f"{instructions}\n\nYou are: {persona}"
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": content},
+    ]
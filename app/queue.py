@@ -1,44 +1,195 @@
 import logging
+import math
+import os
 import re
+import time
+from collections import deque
 logger = logging.getLogger(__name__)
 
 
 import asyncio
 from pydantic import BaseModel
 
+from app import metrics
+from app.tasks import cancel_chat_task
+
+DONE = "[DONE]"
+# Seconds between two frames sent to the client, 0 sends as fast as the client reads
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL", 0.03))
+# Tokens per frame while the writer keeps up
+STREAM_TOKENS_PER_FRAME = int(os.getenv("STREAM_TOKENS_PER_FRAME", 1))
+# Maximum seconds of typing animation the backlog may represent before tokens get merged into bigger frames
+STREAM_MAX_LAG = float(os.getenv("STREAM_MAX_LAG", 1.0))
+
+# Maximum number of messages waiting per chat
+STREAM_QUEUE_MAXSIZE = int(os.getenv("STREAM_QUEUE_MAXSIZE", 256))
+# What happens when a chat queue is full: "drop-oldest", "merge" or "block"
+STREAM_OVERFLOW_POLICY = os.getenv("STREAM_OVERFLOW_POLICY", "merge")
+# Chats without any queue activity for this many seconds are evicted by reap_idle_queues
+STREAM_IDLE_TIMEOUT = float(os.getenv("STREAM_IDLE_TIMEOUT", 900))
+STREAM_REAP_INTERVAL = float(os.getenv("STREAM_REAP_INTERVAL", 60))
+
+OVERFLOW_POLICIES = ("drop-oldest", "merge", "block")
+
+
+class ChatQueue(asyncio.Queue):
+    """
+    Bounded queue of messages for one chat, applying an overflow policy when the client falls behind.
+    """
+
+    def __init__(self, maxsize: int = STREAM_QUEUE_MAXSIZE, policy: str = STREAM_OVERFLOW_POLICY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}, expected one of {OVERFLOW_POLICIES}")
+        super().__init__(maxsize=maxsize)
+        self.policy = policy
+        self.closed = False
+        self.last_activity = time.monotonic()
+
+    def _put(self, item):
+        self.last_activity = time.monotonic()
+        super()._put(item)
+
+    def _get(self):
+        self.last_activity = time.monotonic()
+        return super()._get()
+
+    async def offer(self, msg: str):
+        """
+        Enqueues a message, only waits when the queue is full and the policy is "block".
+        """
+        if self.closed:
+            return
+        if not self.full():
+            self.put_nowait(msg)
+            return
+
+        metrics.increment("stream_queue_overflows")
+        if self.policy == "block":
+            await self.put(msg)
+        elif self.policy == "merge" and self.maxsize > 1 and self._queue[-1] != DONE:
+            if msg == DONE:
+                # the end of the stream must not be merged into text, fold the last two messages instead
+                last = self._queue.pop()
+                self._queue[-1] += last
+                self.put_nowait(msg)
+            else:
+                self._queue[-1] += msg
+                self.last_activity = time.monotonic()
+            metrics.increment("stream_messages_merged")
+        else:
+            self.get_nowait()
+            metrics.increment("stream_messages_dropped")
+            self.put_nowait(msg)
+
+    def close(self):
+        """
+        Discards pending messages, releases blocked producers and ends the stream of a waiting reader.
+        """
+        self.closed = True
+        while not self.empty():
+            self.get_nowait()
+        self.put_nowait(DONE)
+
 
 stream_queues = {}
 
 
 async def add_to_queue(chat_id: str, msg: str):
     """
-    Adds words from the message to the queue one by one with a delay of 0.1 seconds.
+    Adds a message to the chat's queue, pacing happens in paced_stream.
     """
-    logger.info(f"Adding to queue: {msg} for chat_id: {chat_id}")
-    logger.info(f"Current queues: {stream_queues}")
-
-    # Check if the chat_id exists in the stream_queues
-    if chat_id in stream_queues:
-        # Split the message into words, spaces, and punctuation
-        tokens = re.findall(r'\S+|\s+', msg)  # Matches non-whitespace sequences or whitespace sequences
-        for token in tokens:
-            # Add each token to the queue
-            await stream_queues[chat_id].put(token)
-            logger.debug(f"Added token to queue: {repr(token)}")  # Use repr to show spaces and special characters
-            # Delay of 0.1 seconds
-            await asyncio.sleep(0.03)
+    queue = stream_queues.get(chat_id)
+    if queue is None:
+        # chat is gone (finished, disconnected or evicted), nothing to allocate
+        metrics.increment("stream_messages_unrouted")
+        return False
 
+    logger.info(f"Adding to queue: {msg} for chat_id: {chat_id}")
+    await queue.offer(msg)
     return True
 
 
-def add_queue_for_chat(chat_id: str, queue: asyncio.Queue = None):
+def add_queue_for_chat(chat_id: str, queue: ChatQueue = None):
     logger.info(f"Adding queue for chat_id: {chat_id} with queue: {queue}")
     if queue is None:
-        queue = asyncio.Queue()
+        queue = ChatQueue()
     stream_queues[chat_id] = queue
+    metrics.increment("stream_queues_created")
+    return queue
 
 def remove_queue_for_chat(chat_id: str):
     logger.info(f"Removing queue for chat_id: {chat_id}")
     stream_queues.pop(chat_id, None)
 
 
+async def reap_idle_queues():
+    """
+    Periodically evicts chats whose queue saw no activity for STREAM_IDLE_TIMEOUT seconds.
+    """
+    while True:
+        await asyncio.sleep(STREAM_REAP_INTERVAL)
+        now = time.monotonic()
+        for chat_id, queue in list(stream_queues.items()):
+            if now - queue.last_activity > STREAM_IDLE_TIMEOUT:
+                logger.info(f"Evicting idle chat_id: {chat_id}")
+                remove_queue_for_chat(chat_id)
+                queue.close()
+                cancel_chat_task(chat_id, "idle stream evicted")
+                metrics.increment("stream_queues_evicted")
+
+
+metrics.register_gauge("stream_queues_open", lambda: len(stream_queues))
+metrics.register_gauge("stream_queue_depth_total", lambda: sum(q.qsize() for q in stream_queues.values()))
+metrics.register_gauge("stream_queue_depth_max", lambda: max((q.qsize() for q in stream_queues.values()), default=0))
+
+
+def _tokens_per_frame(backlog: int) -> int:
+    """
+    Returns how many tokens the next frame carries.
+
+    Whatever the typing effect cannot show within STREAM_MAX_LAG is merged into the next frame, so the
+    client never falls more than STREAM_MAX_LAG seconds behind the producers.
+    """
+    if STREAM_FRAME_INTERVAL <= 0:
+        return max(backlog, 1)
+    capacity = math.floor(STREAM_MAX_LAG / STREAM_FRAME_INTERVAL) * STREAM_TOKENS_PER_FRAME
+    return max(STREAM_TOKENS_PER_FRAME, backlog - capacity)
+
+
+async def paced_stream(queue: asyncio.Queue):
+    """
+    Drains a chat queue and yields text frames until DONE.
+
+    Messages are split into words and whitespace and sent with a typing effect of
+    STREAM_TOKENS_PER_FRAME tokens every STREAM_FRAME_INTERVAL seconds. When producers get ahead,
+    tokens are merged into larger frames instead of delaying the stream, and since this is a generator
+    a slow client simply reads fewer, bigger frames.
+    """
+    pending = deque()
+    done = False
+    while True:
+        if not pending and not done:
+            msg = await queue.get()
+            if msg == DONE:
+                done = True
+            else:
+                # Split the message into words, spaces, and punctuation
+                pending.extend(re.findall(r'\S+|\s+', msg))
+        # pick up everything else that is already waiting without blocking
+        while not done and not queue.empty():
+            msg = queue.get_nowait()
+            if msg == DONE:
+                done = True
+            else:
+                pending.extend(re.findall(r'\S+|\s+', msg))
+
+        if not pending:
+            if done:
+                return
+            continue
+
+        count = min(_tokens_per_frame(len(pending)), len(pending))
+        yield "".join(pending.popleft() for _ in range(count))
+
+        if pending and STREAM_FRAME_INTERVAL > 0:
+            await asyncio.sleep(STREAM_FRAME_INTERVAL)
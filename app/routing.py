@@ -0,0 +1,127 @@
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+import litellm
+from pydantic import ValidationError
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Model tiers, ordered from cheapest to most capable. Stages on the small tier escalate to the large
+# one if the small model fails (e.g. isn't pulled) or its output doesn't validate, see cascade.
+MODEL_SMALL = os.getenv("MODEL_SMALL", "ollama_chat/qwen2.5-coder:7b")
+MODEL_LARGE = os.getenv("MODEL_LARGE", "ollama_chat/qwen2.5-coder:32b")
+MODEL_TIERS = {"small": MODEL_SMALL, "large": MODEL_LARGE}
+TIER_ORDER = ["small", "large"]
+
+# Pipeline stage (optionally "stage:difficulty") -> tier name or model
+DEFAULT_ROUTES = {
+    "categorize": "small",
+    "summarize": "small",
+    "queries": "small",
+    "agent": "large",
+    "refine": "large",
+    "breakdown": "large",
+    "plan": "large",
+    "answer": "large",
+    "subtask": "large",
+}
+# Overrides as comma separated stage=tier pairs, e.g. "categorize=small,subtask:medium=small,answer=gpt-4o-mini"
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+# Ollama only: how long a model stays loaded after a call, and a fixed context size. Changing num_ctx
+# between calls reloads the model, both would throw away the cached prompt prefix.
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_CTX = os.getenv("OLLAMA_NUM_CTX")
+# Results reporting a certainty below this are retried with the next tier
+ESCALATION_CERTAINTY = int(os.getenv("ESCALATION_CERTAINTY", 6))
+# Backend failures of a model (not pulled, unreachable, erroring) that are retried with the next tier
+BACKEND_ERRORS = (
+    litellm.APIError,
+    litellm.APIConnectionError,
+    litellm.BadRequestError,
+    litellm.InternalServerError,
+    litellm.NotFoundError,
+    litellm.ServiceUnavailableError,
+    litellm.Timeout,
+)
+
+
+def _parse_routes(spec: str) -> dict:
+    routes = dict(DEFAULT_ROUTES)
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        stage, sep, target = entry.partition("=")
+        if not sep or not target.strip():
+            logger.warning(f"Ignoring malformed model route '{entry}'")
+            continue
+        routes[stage.strip()] = target.strip()
+    return routes
+
+
+routes = _parse_routes(MODEL_ROUTES)
+
+
+def models_for(stage: str, difficulty: Optional[str] = None) -> List[str]:
+    """
+    Returns the model a stage is routed to, followed by the more capable tiers it escalates to.
+    """
+    target = routes.get(f"{stage}:{difficulty}") if difficulty else None
+    target = target or routes.get(stage, "large")
+    if target in MODEL_TIERS:
+        return list(dict.fromkeys(MODEL_TIERS[tier] for tier in TIER_ORDER[TIER_ORDER.index(target):]))
+    # a model configured by name escalates straight to the largest tier
+    return list(dict.fromkeys([target, MODEL_TIERS[TIER_ORDER[-1]]]))
+
+
+def model_for(stage: str, difficulty: Optional[str] = None) -> str:
+    return models_for(stage, difficulty)[0]
+
+
+def model_options(model: str) -> dict:
+    """
+    Backend specific request options for a model, passed along with every completion call.
+    """
+    if not model.startswith("ollama"):
+        return {}
+    options = {"keep_alive": OLLAMA_KEEP_ALIVE}
+    if OLLAMA_NUM_CTX:
+        options["num_ctx"] = int(OLLAMA_NUM_CTX)
+    return options
+
+
+async def cascade(
+    stage: str,
+    call: Callable[[str], Awaitable[str]],
+    parse: Callable[[str], T],
+    accept: Optional[Callable[[T], bool]] = None,
+    difficulty: Optional[str] = None,
+) -> T:
+    """
+    Runs call(model) on the stage's model and escalates to the next tier while the model fails, its
+    output fails to parse or is not accepted. The last tier's result is returned as is and its errors
+    are raised.
+    """
+    models = models_for(stage, difficulty)
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
+        try:
+            result = parse(await call(model))
+        except BACKEND_ERRORS as e:
+            if last:
+                raise
+            logger.warning(f"{stage}: {model} failed, escalating to {models[i + 1]}: {e}")
+            metrics.increment("model_escalations")
+            continue
+        except (ValueError, ValidationError) as e:
+            if last:
+                raise
+            logger.warning(f"{stage}: invalid output from {model}, escalating to {models[i + 1]}: {e}")
+            metrics.increment("model_escalations")
+            continue
+        if last or accept is None or accept(result):
+            return result
+        logger.info(f"{stage}: result of {model} not accepted, escalating to {models[i + 1]}")
+        metrics.increment("model_escalations")
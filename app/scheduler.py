@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of subtasks of one request running at the same time
+SUBTASK_CONCURRENCY = int(os.getenv("SUBTASK_CONCURRENCY", 3))
+
+
+class TaskGraph:
+    """
+    Runs tasks as soon as all their dependencies succeeded, at most `concurrency` at a time.
+
+    Tasks can be added while the graph is already running, e.g. while a plan is still being streamed,
+    so dependencies may only refer to tasks that were added before. When a task fails `on_failure` is
+    awaited (e.g. to roll it back) and every task depending on it, directly or not, is skipped.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[int, Any], Awaitable[Any]],
+        on_failure: Optional[Callable[[int, Any, Exception], Awaitable[Any]]] = None,
+        on_skip: Optional[Callable[[int, Any, int], Awaitable[Any]]] = None,
+        concurrency: int = SUBTASK_CONCURRENCY,
+    ):
+        self._run = run
+        self._on_failure = on_failure
+        self._on_skip = on_skip
+        self._semaphore = asyncio.Semaphore(max(concurrency, 1))
+        # task id -> resolves to True if the task succeeded
+        self._outcomes: Dict[int, "asyncio.Future[bool]"] = {}
+        self._workers: List[asyncio.Task] = []
+
+    def add(self, key: int, task: Any, depends_on: Iterable[int] = ()):
+        if key in self._outcomes:
+            raise ValueError(f"Task {key} was already added")
+        deps = []
+        for dep in depends_on:
+            if dep in self._outcomes:
+                deps.append(dep)
+            else:
+                logger.warning(f"Task {key} depends on unknown task {dep}, ignoring the dependency")
+        outcome = asyncio.get_running_loop().create_future()
+        self._outcomes[key] = outcome
+        self._workers.append(asyncio.create_task(self._execute(key, task, deps, outcome)))
+
+    async def _succeeded(self, dep: int) -> bool:
+        outcome = self._outcomes[dep]
+        try:
+            return await asyncio.shield(outcome)
+        except asyncio.CancelledError:
+            # the dependency was cancelled rather than this task, it didn't succeed
+            if outcome.cancelled():
+                return False
+            raise
+
+    async def _execute(self, key: int, task: Any, deps: List[int], outcome: "asyncio.Future[bool]"):
+        try:
+            for dep in deps:
+                if not await self._succeeded(dep):
+                    logger.info(f"Skipping task {key}, its dependency {dep} did not succeed")
+                    metrics.increment("subtasks_skipped")
+                    if self._on_skip is not None:
+                        await self._on_skip(key, task, dep)
+                    outcome.set_result(False)
+                    return
+
+            async with self._semaphore:
+                try:
+                    await self._run(key, task)
+                except Exception as e:
+                    logger.error(f"Task {key} failed: {e}")
+                    metrics.increment("subtasks_failed")
+                    outcome.set_result(False)
+                    if self._on_failure is not None:
+                        await self._on_failure(key, task, e)
+                    return
+            metrics.increment("subtasks_succeeded")
+            outcome.set_result(True)
+        finally:
+            if not outcome.done():
+                outcome.cancel()
+
+    async def wait(self) -> Dict[int, bool]:
+        """
+        Waits for every added task and returns whether each one succeeded, a task that was cancelled
+        did not.
+
+        Cancelling the wait cancels all running tasks.
+        """
+        try:
+            if self._workers:
+                await asyncio.wait(self._workers)
+        except BaseException:
+            self.cancel()
+            raise
+        for worker in self._workers:
+            if not worker.cancelled() and worker.exception() is not None:
+                raise worker.exception()
+        return {key: not outcome.cancelled() and outcome.result() for key, outcome in self._outcomes.items()}
+
+    def cancel(self):
+        for worker in self._workers:
+            worker.cancel()
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import litellm
+
+from app.admission import llm_slot
+from app.routing import model_options
+
+logger = logging.getLogger(__name__)
+
+# set to false for backends that can't stream, on_delta then receives the whole text at once
+LLM_STREAM = os.getenv("LLM_STREAM", "true").lower() == "true"
+
+
+_END = object()
+
+
+async def _forward(deltas: asyncio.Queue, on_delta: Callable[[str], Awaitable[Any]]):
+    while True:
+        delta = await deltas.get()
+        if delta is _END:
+            return
+        await on_delta(delta)
+
+
+async def stream_completion(on_delta: Optional[Callable[[str], Awaitable[Any]]] = None, stage: Optional[str] = None, **kwargs) -> str:
+    """
+    Calls litellm.acompletion with stream=True, passes every content delta to on_delta as it arrives
+    and returns the assembled text once on_delta has had all of it. The call holds an LLM slot of
+    the given stage (see app.admission), on_delta runs outside of it: deltas it hasn't taken yet are
+    buffered, so a slow client (e.g. a "block" overflow policy) doesn't keep the slot busy.
+    """
+    kwargs = {**model_options(kwargs.get("model", "")), **kwargs}
+    deltas: asyncio.Queue = asyncio.Queue()
+    forwarder = asyncio.create_task(_forward(deltas, on_delta)) if on_delta is not None else None
+    try:
+        async with llm_slot(stage):
+            if not LLM_STREAM:
+                response = await litellm.acompletion(**kwargs)
+                content = response.choices[0].message.content
+                if forwarder is not None and content:
+                    deltas.put_nowait(content)
+            else:
+                response = await litellm.acompletion(stream=True, **kwargs)
+                parts = []
+                async for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        if forwarder is not None:
+                            if forwarder.done():
+                                # on_delta failed, its error is raised below
+                                break
+                            deltas.put_nowait(delta)
+                content = "".join(parts)
+    except BaseException:
+        if forwarder is not None:
+            forwarder.cancel()
+        raise
+    if forwarder is not None:
+        deltas.put_nowait(_END)
+        await forwarder
+    return content
+
+
+class IncrementalJSON:
+    """
+    Incremental reader for a JSON object that arrives in pieces, e.g. streamed structured output.
+
+    Top level values become available in `values` as soon as they are complete, and so do the
+    elements of top level arrays in `items`, so e.g. the first task of a plan can be used while the
+    model is still generating the rest. The text of a top level string that is still being generated
+    can be read with partial_string.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.values: Dict[str, Any] = {}
+        self.items: Dict[str, List[Any]] = {}
+        self._in_array = False
+        self._item_start: Optional[int] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expecting_key = False
+        self._key: Optional[str] = None
+        self._key_start = 0
+        self._value_start: Optional[int] = None
+
+    def feed(self, delta: str):
+        self.text += delta
+        for i in range(self._pos, len(self.text)):
+            self._scan(i, self.text[i])
+        self._pos = len(self.text)
+
+    def _complete(self, end: int):
+        raw = self.text[self._value_start:end]
+        try:
+            self.values[self._key] = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.debug(f"Could not decode value of {self._key}: {raw}")
+        self._value_start = None
+
+    def _add_item(self, end: int):
+        raw = self.text[self._item_start:end]
+        try:
+            self.items.setdefault(self._key, []).append(json.loads(raw))
+        except json.JSONDecodeError:
+            logger.debug(f"Could not decode item of {self._key}: {raw}")
+        self._item_start = None
+
+    def _scan(self, i: int, c: str):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == "\\":
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+                if self._depth == 2 and self._in_array and self._item_start is not None:
+                    self._add_item(i + 1)
+                elif self._depth == 1:
+                    if self._expecting_key:
+                        self._key = json.loads(self.text[self._key_start:i + 1])
+                        self._expecting_key = False
+                    else:
+                        self._complete(i + 1)
+            return
+
+        in_items = self._depth == 2 and self._in_array
+        if c == '"':
+            self._in_string = True
+            if self._depth == 1:
+                if self._expecting_key:
+                    self._key_start = i
+                elif self._value_start is None:
+                    self._value_start = i
+            elif in_items and self._item_start is None:
+                self._item_start = i
+        elif c in "{[":
+            if in_items and self._item_start is None:
+                self._item_start = i
+            self._depth += 1
+            if self._depth == 1:
+                self._expecting_key = True
+            elif self._depth == 2 and self._value_start is None:
+                self._value_start = i
+                self._in_array = c == "["
+        elif c in "}]":
+            if self._depth == 3 and self._in_array and self._item_start is not None:
+                self._add_item(i + 1)
+            elif self._depth == 2 and self._value_start is not None:
+                if in_items and self._item_start is not None:
+                    self._add_item(i)
+                self._complete(i + 1)
+                self._in_array = False
+            elif self._depth == 1 and self._value_start is not None:
+                self._complete(i)
+            self._depth -= 1
+        elif c == ",":
+            if self._depth == 1:
+                if self._value_start is not None:
+                    self._complete(i)
+                self._expecting_key = True
+            elif in_items and self._item_start is not None:
+                self._add_item(i)
+        elif c == ":" or c.isspace():
+            pass
+        elif self._depth == 1 and not self._expecting_key and self._value_start is None:
+            # start of a number, true, false or null
+            self._value_start = i
+        elif in_items and self._item_start is None:
+            self._item_start = i
+
+    def partial_string(self, key: str) -> Optional[str]:
+        """
+        Returns the decoded text of a top level string value generated so far, None if it hasn't started.
+        """
+        if key in self.values:
+            value = self.values[key]
+            return value if isinstance(value, str) else None
+        if not (self._in_string and self._depth == 1 and self._key == key and self._value_start is not None):
+            return None
+        raw = self.text[self._value_start + 1:]
+        # an escape sequence may be cut in half, drop its beginning until it decodes
+        for cut in range(0, 7):
+            try:
+                return json.loads('"' + raw[:len(raw) - cut] + '"')
+            except json.JSONDecodeError:
+                continue
+        return None
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+from typing import Coroutine, Dict
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# chat_id -> the process_request task producing that chat's stream
+chat_tasks: Dict[str, asyncio.Task] = {}
+
+
+def start_chat_task(chat_id: str, coro: Coroutine) -> asyncio.Task:
+    """
+    Starts the agent pipeline of a chat and keeps a reference so it can be cancelled later.
+    """
+    task = asyncio.create_task(coro, name=f"chat-{chat_id}")
+    chat_tasks[chat_id] = task
+
+    def _done(t: asyncio.Task):
+        if chat_tasks.get(chat_id) is t:
+            chat_tasks.pop(chat_id, None)
+        if t.cancelled():
+            metrics.increment("pipelines_cancelled")
+        elif t.exception() is not None:
+            logger.error(f"Pipeline for chat_id: {chat_id} failed", exc_info=t.exception())
+            metrics.increment("pipelines_failed")
+        else:
+            metrics.increment("pipelines_completed")
+
+    task.add_done_callback(_done)
+    metrics.increment("pipelines_started")
+    return task
+
+
+def cancel_chat_task(chat_id: str, reason: str) -> bool:
+    """
+    Cancels the pipeline of a chat including everything it awaits (LLM and tool calls, subtasks).
+
+    Returns False if there was nothing left to cancel.
+    """
+    task = chat_tasks.get(chat_id)
+    if task is None or task.done():
+        return False
+    logger.info(f"Cancelling pipeline for chat_id: {chat_id}: {reason}")
+    task.cancel(reason)
+    return True
+
+
+metrics.register_gauge("pipelines_running", lambda: len(chat_tasks))
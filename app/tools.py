@@ -0,0 +1,814 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import shlex
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from app import metrics
+from app.context import TOOL_OUTPUT_MAX_CHARS
+from app.http_client import get_http_client
+from app.models import User
+
+logger = logging.getLogger(__name__)
+TOKEN=os.getenv("TOKEN")
+TOOL_SERVER_URL=os.getenv("TOOL_SERVER_URL", "http://127.0.0.1:8000")
+
+# Maximum number of tool calls running at the same time, over all chats and per chat
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", 16))
+TOOL_CHAT_CONCURRENCY = int(os.getenv("TOOL_CHAT_CONCURRENCY", 4))
+
+# Ask the tool server for streamed output (NDJSON), servers answering with plain JSON keep working
+TOOL_STREAM = os.getenv("TOOL_STREAM", "true").lower() == "true"
+# Directory the complete output of streamed tool calls is written to, unset keeps only head and tail.
+# Only the newest TOOL_SPOOL_MAX_FILES outputs are kept there.
+TOOL_SPOOL_DIR = os.getenv("TOOL_SPOOL_DIR")
+TOOL_SPOOL_MAX_FILES = int(os.getenv("TOOL_SPOOL_MAX_FILES", 200))
+# Output buffered before it is written to the spool file
+TOOL_SPOOL_BUFFER_CHARS = int(os.getenv("TOOL_SPOOL_BUFFER_CHARS", 64 * 1024))
+# How often and how many of the latest output lines of a running tool are shown in the chat
+TOOL_LIVE_TAIL_INTERVAL = float(os.getenv("TOOL_LIVE_TAIL_INTERVAL", 2.0))
+TOOL_LIVE_TAIL_LINES = int(os.getenv("TOOL_LIVE_TAIL_LINES", 5))
+
+# Seconds a read-only command's result is reused within a chat, 0 disables reuse
+TOOL_CACHE_TTL = float(os.getenv("TOOL_CACHE_TTL", 120))
+# Seconds for commands in VOLATILE_COMMANDS, short enough for a polling loop to see the change
+TOOL_CACHE_VOLATILE_TTL = float(os.getenv("TOOL_CACHE_VOLATILE_TTL", 5))
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", 128))
+
+# Tool suggestions kept per normalised query
+TOOL_SUGGESTION_CACHE_SIZE = int(os.getenv("TOOL_SUGGESTION_CACHE_SIZE", 1024))
+# Longest suggestions JSON put into a subtask's prompt
+TOOL_SUGGESTIONS_MAX_CHARS = int(os.getenv("TOOL_SUGGESTIONS_MAX_CHARS", 4000))
+
+_tool_slots = asyncio.Semaphore(TOOL_CONCURRENCY)
+# a chat's semaphore lives as long as one of its tool calls holds a reference to it
+_chat_tool_slots: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+
+class ToolSuggestionRequest(BaseModel):
+    """Represents a request for tool suggestions based on a query and parameters."""
+    #user: Optional[User] = None
+    #token: str
+    queries: list[str]
+
+
+# Suggestions per normalised query, or per task (see _group_key) if the tool server's answer can't be
+# attributed to single queries
+_suggestions: "OrderedDict[str, Any]" = OrderedDict()
+_pending_suggestions: Dict[str, asyncio.Future] = {}
+# running lookups, referenced so they aren't garbage collected
+_suggestion_lookups: set = set()
+# cleared once the tool server answers a batch in a way that can't be split per query, suggestions
+# are then looked up per task like before batching
+_batching = True
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _group_key(queries: List[str]) -> str:
+    """Cache key of the suggestions for a task's queries, the query itself for a single one."""
+    return "\n".join(dict.fromkeys(filter(None, map(_normalize_query, queries))))
+
+
+async def _post_suggestions(queries: List[str]) -> Any:
+    headers = {"Content-Type": "application/json"}
+    if TOKEN:
+        headers["Authorization"] = f"Bearer {TOKEN}"
+    data = ToolSuggestionRequest(queries=queries)
+    logger.info(f"Requesting tool suggestions: {data.model_dump_json()}")
+    response = await get_http_client().post(f"{TOOL_SERVER_URL}/tools/suggestions", content=data.model_dump_json(), headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+def _split_suggestions(queries: List[str], body: Any) -> Optional[List[Any]]:
+    """
+    Splits a batch response into one result per query, None if the response doesn't say which
+    suggestion belongs to which query.
+    """
+    if len(queries) == 1:
+        return [body]
+    if isinstance(body, list) and len(body) == len(queries):
+        return body
+    if isinstance(body, dict):
+        if all(q in body for q in queries):
+            return [body[q] for q in queries]
+        if isinstance(body.get("results"), list) and len(body["results"]) == len(queries):
+            return body["results"]
+    return None
+
+
+def _remember_suggestions(key: str, result: Any):
+    _suggestions[key] = result
+    _suggestions.move_to_end(key)
+    while len(_suggestions) > TOOL_SUGGESTION_CACHE_SIZE:
+        _suggestions.popitem(last=False)
+
+
+async def _resolve_suggestions(queries: List[str], groups: List[List[str]], futures: Dict[str, asyncio.Future]):
+    """
+    Looks up queries in one request. If the answer can't be split per query, batching is turned off
+    and the groups (the tasks' queries) that asked for them are looked up one by one instead.
+    """
+    global _batching
+    try:
+        results = _split_suggestions(queries, await _post_suggestions(queries))
+        if results is None:
+            logger.info(f"Tool suggestions can't be attributed to single queries, asking per task from now on")
+            _batching = False
+            # tasks whose queries are being looked up already by a lookup started since then are left out
+            groups = [g for g in groups if _group_key(g) in futures or not _known(_group_key(g))]
+            await asyncio.gather(*(_resolve_group(group) for group in groups))
+            return
+        for query, result in zip(queries, results):
+            _remember_suggestions(query, result)
+            futures[query].set_result(result)
+    except Exception as e:
+        # suggestions are a hint, subtasks work without them
+        logger.warning(f"Tool suggestions for {queries} failed: {e}")
+
+
+async def _resolve_group(group: List[str]):
+    """Looks up the suggestions of one task, kept under its group key only."""
+    try:
+        result = await _post_suggestions(list(dict.fromkeys(group)))
+        _remember_suggestions(_group_key(group), result)
+    except Exception as e:
+        logger.warning(f"Tool suggestions for {group} failed: {e}")
+
+
+def _release_suggestions(futures: Dict[str, asyncio.Future], lookup: asyncio.Task):
+    # also runs if the lookup was cancelled, even before it started, subtasks waiting for it go on
+    # without suggestions
+    _suggestion_lookups.discard(lookup)
+    for key, future in futures.items():
+        if not future.done():
+            future.set_result(_suggestions.get(key))
+        if _pending_suggestions.get(key) is future:
+            del _pending_suggestions[key]
+
+
+def _start_lookup(coroutine, futures: Dict[str, asyncio.Future]):
+    _pending_suggestions.update(futures)
+    metrics.increment("tool_suggestion_requests")
+    lookup = asyncio.create_task(coroutine)
+    _suggestion_lookups.add(lookup)
+    lookup.add_done_callback(functools.partial(_release_suggestions, futures))
+
+
+def _known(key: str) -> bool:
+    return key in _suggestions or key in _pending_suggestions
+
+
+def prefetch_tool_suggestions(*groups: List[str]):
+    """
+    Starts looking up the suggestions of all queries that are neither cached nor already being
+    looked up, deduplicated and in one request. Each group holds the queries of one task, they are
+    asked for per task if the tool server's answers can't be attributed to single queries.
+    """
+    groups = [[q for q in map(_normalize_query, group) if q] for group in groups]
+    groups = [group for group in groups if group]
+    if not _batching:
+        keys = list(dict.fromkeys(_group_key(group) for group in groups))
+        missing = {key: group for key, group in zip(map(_group_key, groups), groups) if not _known(key)}
+        metrics.increment("tool_suggestions_reused", len(keys) - len(missing))
+        for key, group in missing.items():
+            _start_lookup(_resolve_group(group), {key: asyncio.get_running_loop().create_future()})
+        return
+
+    requested = list(dict.fromkeys(q for group in groups for q in group))
+    missing = [q for q in requested if not _known(q)]
+    metrics.increment("tool_suggestions_reused", len(requested) - len(missing))
+    if not missing:
+        return
+    futures = {query: asyncio.get_running_loop().create_future() for query in missing}
+    # the tasks that asked for the missing queries, in case they have to be asked for per task
+    asking = [group for group in groups if any(q in futures for q in group)]
+    asking = list({_group_key(group): group for group in asking}.values())
+    _start_lookup(_resolve_suggestions(missing, asking, futures), futures)
+
+
+async def get_tool_suggestions(queries: List[str]) -> Dict[str, Any]:
+    """
+    Returns the suggestions for each query that has any, waiting for lookups that are still running.
+    Suggestions that were looked up for the task as a whole are returned under its joined queries.
+    """
+    prefetch_tool_suggestions(queries)
+    keys = list(dict.fromkeys(filter(None, map(_normalize_query, queries))))
+    group = _group_key(queries)
+    for key in dict.fromkeys(keys + [group]):
+        if key in _pending_suggestions:
+            await asyncio.shield(_pending_suggestions[key])
+    if len(keys) > 1 and group in _suggestions:
+        _suggestions.move_to_end(group)
+        result = _suggestions[group]
+        return {"; ".join(dict.fromkeys(queries)): result} if result else {}
+    suggestions = {}
+    for query in dict.fromkeys(queries):
+        key = _normalize_query(query)
+        result = _suggestions.get(key)
+        if result:
+            _suggestions.move_to_end(key)
+            suggestions[query] = result
+    return suggestions
+
+
+class ExecutionRequest(BaseModel):
+    """Represents a request to execute a tool with specific parameters."""
+    user: Optional[User] = None
+    toolname: Optional[str] = None
+    params: Optional[Dict[str, Any]] = None
+
+
+class OutputCapture:
+    """
+    Keeps head and tail of a stream of output within max_chars, like clip_text but without holding
+    the whole output in memory.
+    """
+
+    def __init__(self, max_chars: int = TOOL_OUTPUT_MAX_CHARS):
+        self.head_chars = max_chars * 2 // 3
+        self.tail_chars = max_chars - self.head_chars
+        self.head = ""
+        self.tail: deque = deque()
+        self.tail_len = 0
+        self.total = 0
+
+    def write(self, text: str):
+        self.total += len(text)
+        if len(self.head) < self.head_chars:
+            take = self.head_chars - len(self.head)
+            self.head += text[:take]
+            text = text[take:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_len += len(text)
+        while self.tail_len - len(self.tail[0]) >= self.tail_chars:
+            self.tail_len -= len(self.tail.popleft())
+
+    def text(self, spool_path: Optional[str] = None) -> str:
+        tail = "".join(self.tail)[-self.tail_chars:]
+        omitted = self.total - len(self.head) - len(tail)
+        if omitted <= 0:
+            return self.head + tail
+        where = f", full output in {spool_path}" if spool_path else ""
+        return f"{self.head}\n[... {omitted} of {self.total} characters omitted{where} ...]\n{tail}"
+
+
+async def execute_tool(user, toolname: str, params: Dict[str, Any], on_output: Optional[Callable[[str], Awaitable[Any]]] = None):
+    """
+    Calls the tool execution API with the given parameters.
+
+    If the tool server streams its output as NDJSON ({"stream": "stdout", "data": "..."} lines and a
+    final line with the exit code) the latest lines are passed to on_output while the tool runs, and
+    only head and tail of the output are kept in the result, see OutputCapture. The output of a plain
+    JSON result is capped the same way.
+    """
+    url = f"{TOOL_SERVER_URL}/tools/execute"
+    headers = {"Content-Type": "application/json"}
+    if TOKEN:
+        headers["Authorization"] = f"Bearer {TOKEN}"
+    if TOOL_STREAM:
+        headers["Accept"] = "application/x-ndjson, application/json"
+
+    execution_request = ExecutionRequest(
+        toolname="bash sh",
+        params=params,
+        user=User(id=user.id, username=user.username)
+    )
+
+    logger.info(f"Sending execution request: {execution_request.model_dump_json()}")
+
+    async with get_http_client().stream("POST", url, content=execution_request.model_dump_json(), headers=headers) as response:
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        content_type = response.headers.get("content-type", "")
+        if "ndjson" not in content_type and not content_type.startswith("text/plain"):
+            return _capped_result(json.loads(await response.aread()))
+        return await _read_streamed_output(response, content_type.startswith("text/plain"), on_output)
+
+
+def _capped_result(result: Any) -> Any:
+    """Keeps head and tail of the output of a plain JSON result, like for streamed output."""
+    if isinstance(result, str):
+        capture = OutputCapture()
+        capture.write(result)
+        metrics.increment("tool_output_chars", capture.total)
+        return capture.text()
+    if isinstance(result, dict):
+        for key in ("stdout", "stderr", "output"):
+            if isinstance(result.get(key), str):
+                capture = OutputCapture()
+                capture.write(result[key])
+                metrics.increment("tool_output_chars", capture.total)
+                result[key] = capture.text()
+    return result
+
+
+def _open_spool() -> Tuple[str, Any]:
+    os.makedirs(TOOL_SPOOL_DIR, exist_ok=True)
+    # drop the oldest outputs, the new one is the last to be kept
+    spooled = sorted(
+        (entry for entry in os.scandir(TOOL_SPOOL_DIR) if entry.name.endswith(".log")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in spooled[:max(len(spooled) - TOOL_SPOOL_MAX_FILES + 1, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"Could not remove spooled tool output {entry.path}: {e}")
+    path = os.path.join(TOOL_SPOOL_DIR, f"{uuid.uuid4()}.log")
+    return path, open(path, "w")
+
+
+async def _read_streamed_output(response, plain: bool, on_output: Optional[Callable[[str], Awaitable[Any]]]) -> Dict[str, Any]:
+    spool_path = spool = None
+    # output not yet written to the spool file, files are only written to in a thread
+    pending: List[str] = []
+    pending_chars = 0
+    if TOOL_SPOOL_DIR:
+        spool_path, spool = await asyncio.to_thread(_open_spool)
+    captures = {"stdout": OutputCapture(), "stderr": OutputCapture()}
+    result: Dict[str, Any] = {}
+    recent: deque = deque(maxlen=TOOL_LIVE_TAIL_LINES)
+    last_sent = time.monotonic()
+
+    try:
+        lines = response.aiter_text() if plain else response.aiter_lines()
+        async for line in lines:
+            if plain:
+                event = {"stream": "stdout", "data": line}
+            elif not line.strip():
+                continue
+            else:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    event = {"stream": "stdout", "data": line + "\n"}
+            if "data" not in event:
+                # final event with exit code and whatever else the server reports
+                result.update(event)
+                continue
+            captures.get(event.get("stream"), captures["stdout"]).write(event["data"])
+            if spool is not None:
+                pending.append(event["data"])
+                pending_chars += len(event["data"])
+                if pending_chars >= TOOL_SPOOL_BUFFER_CHARS:
+                    await asyncio.to_thread(spool.write, "".join(pending))
+                    pending, pending_chars = [], 0
+            recent.extend(l for l in event["data"].splitlines() if l.strip())
+            if on_output is not None and recent and time.monotonic() - last_sent >= TOOL_LIVE_TAIL_INTERVAL:
+                await on_output("\n".join(recent))
+                recent.clear()
+                last_sent = time.monotonic()
+    finally:
+        if spool is not None:
+            await asyncio.to_thread(_close_spool, spool, "".join(pending))
+
+    metrics.increment("tool_output_chars", captures["stdout"].total + captures["stderr"].total)
+    result["stdout"] = captures["stdout"].text(spool_path)
+    result["stderr"] = captures["stderr"].text(spool_path)
+    if spool_path:
+        result["output_file"] = spool_path
+    return result
+
+
+def _close_spool(spool, rest: str):
+    try:
+        spool.write(rest)
+    finally:
+        spool.close()
+
+
+def parse_tool_call(tool_call: str):
+    """
+    Splits a tool call in the format tool(params) into tool and params.
+    """
+    tool, params = tool_call.split("(", 1)
+    params = params[:-1]
+    return tool, params
+
+
+# Commands that only read state, as long as they don't redirect output into files
+READ_ONLY_COMMANDS = {
+    "basename", "cat", "column", "cut", "df", "diff", "dirname", "du", "echo", "file", "find", "grep",
+    "egrep", "fgrep", "head", "id", "jq", "less", "ls", "md5sum", "nproc", "printenv", "printf", "ps",
+    "pwd", "readlink", "realpath", "rg", "sed", "sha256sum", "sort", "stat", "tail", "test", "tr",
+    "true", "type", "uname", "uniq", "wc", "which", "whoami",
+}
+# Read-only subcommands of CLIs that can also change state
+READ_ONLY_SUBCOMMANDS = {
+    "git": {"blame", "diff", "grep", "log", "ls-files", "ls-remote", "rev-parse", "show", "status"},
+    "kubectl": {"api-resources", "cluster-info", "describe", "explain", "get", "logs", "top", "version"},
+    "docker": {"images", "info", "inspect", "logs", "ps", "version"},
+    "helm": {"get", "history", "list", "ls", "search", "show", "status", "version"},
+    "gh": {"api", "browse", "search", "status", "view"},
+}
+# Flags that turn an otherwise read-only command into a writing one
+WRITE_FLAGS = {
+    "find": {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"},
+    "gh": {"-X", "--method", "-f", "-F", "--field", "--raw-field"},
+}
+# Flags that edit in place or write an output file for many programs, checked for every program
+# except where they are known to mean something else
+COMMON_WRITE_FLAGS = {"-i", "--in-place", "--inplace", "-o", "--output"}
+COMMON_WRITE_FLAG_EXCEPTIONS = {
+    "grep": {"-i", "-o"}, "egrep": {"-i", "-o"}, "fgrep": {"-i", "-o"}, "rg": {"-i", "-o"},
+    "git": {"-i", "-o"}, "ls": {"-i", "-o"}, "ps": {"-o"}, "uname": {"-i", "-o"}, "df": {"-i"},
+    "diff": {"-i"}, "uniq": {"-i"}, "sort": {"-i"}, "find": {"-o"},
+    "kubectl": {"-o", "--output"}, "helm": {"-o", "--output"},
+}
+_SEGMENT_SEPARATOR = re.compile(r"\|\||&&|[|;&\n]")
+
+
+def _command_words(command: str) -> Optional[List[List[str]]]:
+    """
+    The words of each simple command in a shell command line, None if it contains redirections,
+    substitutions or quoting the heuristics don't handle.
+    """
+    stripped = re.sub(r"\d?>&\d|[12]?>\s*/dev/null", "", command)
+    if re.search(r">|\$\(|`|<\(", stripped):
+        return None
+    segments = []
+    for segment in _SEGMENT_SEPARATOR.split(stripped):
+        try:
+            words = shlex.split(segment)
+        except ValueError:
+            return None
+        if words:
+            segments.append(words)
+    return segments
+
+
+def _flags(program: str, words: List[str]) -> List[str]:
+    """The flags among words, with clusters of short options like -io split up."""
+    flags = []
+    for word in words:
+        if not word.startswith("-") or word == "-":
+            continue
+        flags.append(word.split("=", 1)[0])
+        # find's options are words of their own, e.g. -iname
+        if program != "find" and re.fullmatch(r"-[A-Za-z]{2,}", word):
+            flags.extend(f"-{c}" for c in word[1:])
+    return flags
+
+
+def _sed_scripts(words: List[str]) -> Optional[List[str]]:
+    """The scripts of a sed invocation, None if they come from a file."""
+    scripts = []
+    expect_script = False
+    for word in words:
+        if expect_script:
+            scripts.append(word)
+            expect_script = False
+        elif word.startswith("--expression"):
+            if "=" in word:
+                scripts.append(word.split("=", 1)[1])
+            else:
+                expect_script = True
+        elif word == "--file" or word.startswith("--file="):
+            return None
+        elif re.match(r"-[A-Za-z]", word):
+            # cluster of short options, -e and -f take the rest of the word or the next one
+            for j, option in enumerate(word[1:]):
+                if option == "f":
+                    return None
+                if option == "e":
+                    if word[j + 2:]:
+                        scripts.append(word[j + 2:])
+                    else:
+                        expect_script = True
+                    break
+        elif not word.startswith("-") and not scripts:
+            # without -e the first operand is the script
+            scripts.append(word)
+    return scripts
+
+
+def _sed_script_writes(script: str) -> bool:
+    """
+    Whether a sed script may write files or run commands (w, W and e commands, the w and e flags of s).
+    Regular expressions and replacements are skipped, any other w, W or e counts, so text of
+    a, i and c commands errs on the side of writing.
+    """
+    i = 0
+    rest = []
+    while i < len(script):
+        c = script[i]
+        if c in "sy" and i + 1 < len(script) and script[i + 1] not in "\n;} ":
+            # s/regex/replacement/flags or y/source/dest/, skip the two delimited parts
+            delimiter = script[i + 1]
+            i += 2
+            for _ in range(2):
+                while i < len(script) and script[i] != delimiter:
+                    i += 2 if script[i] == "\\" else 1
+                i += 1
+            continue
+        if c == "/" or c == "\\" and i + 1 < len(script):
+            # /regex/ or \cregexc address
+            delimiter = "/" if c == "/" else script[i + 1]
+            i += 1 if c == "/" else 2
+            while i < len(script) and script[i] != delimiter:
+                i += 2 if script[i] == "\\" else 1
+            i += 1
+            continue
+        rest.append(c)
+        i += 1
+    return bool(re.search(r"[wWe]", "".join(rest)))
+
+
+def is_read_only_command(command: str) -> bool:
+    """
+    Heuristically decides whether a shell command has no side effects.
+
+    Anything the heuristic doesn't understand (redirections, command substitution, unknown programs,
+    sed scripts from files) counts as mutating, so the worst case is a call that runs in order although
+    it could have run in parallel.
+    """
+    segments = _command_words(command)
+    if segments is None:
+        return False
+    for words in segments:
+        # skip leading VAR=value assignments
+        while words and re.match(r"^[A-Za-z_][A-Za-z0-9_]*=", words[0]):
+            words = words[1:]
+        if not words:
+            continue
+        program = os.path.basename(words[0])
+        if program in READ_ONLY_SUBCOMMANDS:
+            subcommand = next((w for w in words[1:] if not w.startswith("-")), None)
+            if subcommand not in READ_ONLY_SUBCOMMANDS[program]:
+                return False
+        elif program not in READ_ONLY_COMMANDS:
+            return False
+        flags = _flags(program, words[1:])
+        write_flags = WRITE_FLAGS.get(program, set()) | (COMMON_WRITE_FLAGS - COMMON_WRITE_FLAG_EXCEPTIONS.get(program, set()))
+        if any(flag in write_flags for flag in flags):
+            return False
+        if program == "sed":
+            scripts = _sed_scripts(words[1:])
+            if scripts is None or any(_sed_script_writes(script) for script in scripts):
+                return False
+    return True
+
+
+# Exact argument shapes of the commands whose results are cached: the flags each program (or CLI
+# subcommand) may be called with, a trailing "=" marks a flag that takes a value. Any other flag, or
+# a command the read-only heuristic has doubts about, runs again every time.
+CACHEABLE_COMMANDS = {
+    "cat": {"-n", "-A", "-b", "-s"},
+    "head": {"-n=", "-c=", "-q"},
+    "tail": {"-n=", "-c=", "-q"},
+    "ls": {"-a", "-A", "-l", "-h", "-R", "-1", "-t", "-r", "-S", "-d", "-F"},
+    "grep": {
+        "-i", "-r", "-R", "-n", "-l", "-L", "-c", "-v", "-w", "-x", "-E", "-F", "-o", "-H", "-h", "-s",
+        "-e=", "-m=", "-A=", "-B=", "-C=", "--include=", "--exclude=", "--exclude-dir=",
+    },
+    "wc": {"-l", "-w", "-c", "-m"},
+    "stat": set(),
+    "file": set(),
+    "du": {"-s", "-h", "-c", "-d="},
+    "pwd": set(),
+    "whoami": set(),
+    "id": set(),
+    "uname": {"-a", "-r", "-s", "-m", "-n"},
+    "which": set(),
+    "find": {"-name=", "-iname=", "-path=", "-type=", "-maxdepth=", "-mindepth=", "-o", "-not"},
+    "git status": {"-s", "--short", "-b", "--porcelain"},
+    "git log": {"--oneline", "-n=", "--stat", "--format=", "--pretty="},
+    "git diff": {"--stat", "--name-only", "--cached", "--staged"},
+    "git show": {"--stat", "--name-only"},
+    "git ls-files": set(),
+    "git rev-parse": {"--abbrev-ref", "--show-toplevel"},
+    "kubectl get": {"-n=", "--namespace=", "-o=", "--output=", "-l=", "--selector=", "-A", "--all-namespaces"},
+    "kubectl describe": {"-n=", "--namespace=", "-l=", "--selector="},
+}
+
+# Cacheable commands showing state that changes without the chat running anything, cluster resources
+# or files other processes write. Agents poll them waiting for a rollout or a file, so their results
+# are only reused for TOOL_CACHE_VOLATILE_TTL.
+VOLATILE_COMMANDS = {"ls", "tail", "du", "kubectl get", "kubectl describe"}
+
+
+def _matches_shape(words: List[str], allowed: set) -> bool:
+    """Whether every flag among words is one of allowed, consuming the values of value flags."""
+    words = iter(words)
+    for word in words:
+        if word == "--":
+            break
+        if not word.startswith("-") or word == "-":
+            continue
+        if "=" in word and word.startswith("--"):
+            if word.split("=", 1)[0] + "=" not in allowed:
+                return False
+        elif word in allowed:
+            continue
+        elif word + "=" in allowed:
+            if next(words, None) is None:
+                return False
+        elif word[:2] + "=" in allowed and not word.startswith("--"):
+            # value attached to a short flag, e.g. -n5
+            continue
+        elif not all(f"-{c}" in allowed for c in word[1:]):
+            return False
+    return True
+
+
+def _cacheable_shapes(command: str) -> Optional[List[str]]:
+    """The CACHEABLE_COMMANDS entries of the simple commands in command, None if any of them has none."""
+    if not is_read_only_command(command):
+        return None
+    segments = _command_words(command)
+    if not segments:
+        return None
+    shapes = []
+    for words in segments:
+        if "/" in words[0]:
+            return None
+        if len(words) > 1 and f"{words[0]} {words[1]}" in CACHEABLE_COMMANDS:
+            shape, arguments = f"{words[0]} {words[1]}", words[2:]
+        elif words[0] in CACHEABLE_COMMANDS:
+            shape, arguments = words[0], words[1:]
+        else:
+            # also unknown programs and VAR=value assignments
+            return None
+        if not _matches_shape(arguments, CACHEABLE_COMMANDS[shape]):
+            return None
+        shapes.append(shape)
+    return shapes
+
+
+def is_cacheable_command(command: str) -> bool:
+    """
+    Whether the result of a shell command may be reused, i.e. it is read-only and every simple
+    command in it has one of the exact shapes in CACHEABLE_COMMANDS.
+    """
+    return _cacheable_shapes(command) is not None
+
+
+def tool_cache_ttl(command: str) -> float:
+    """Seconds the result of a shell command may be reused, 0 if it isn't cacheable."""
+    shapes = _cacheable_shapes(command)
+    if shapes is None:
+        return 0.0
+    if any(shape in VOLATILE_COMMANDS for shape in shapes):
+        return min(TOOL_CACHE_TTL, TOOL_CACHE_VOLATILE_TTL)
+    return TOOL_CACHE_TTL
+
+
+class ChatToolCache:
+    """
+    Results of cacheable commands of one chat, dropped whenever a command that may change state runs.
+
+    The generation counts those invalidations, a result is only stored if no command that may change
+    state started while it was being produced.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.results: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+
+    def get(self, command: str) -> Optional[Any]:
+        entry = self.results.get(command)
+        if entry is None or entry[0] < time.monotonic():
+            self.results.pop(command, None)
+            return None
+        return entry[1]
+
+    def put(self, command: str, result: Any, generation: int, ttl: float = TOOL_CACHE_TTL):
+        if generation != self.generation:
+            return
+        self.results[command] = (time.monotonic() + ttl, result)
+        self.results.move_to_end(command)
+        while len(self.results) > TOOL_CACHE_MAX_ENTRIES:
+            self.results.popitem(last=False)
+
+    def invalidate(self):
+        self.generation += 1
+        self.results.clear()
+
+
+# chat_id -> tool results reused within that chat
+_chat_tool_caches: Dict[str, ChatToolCache] = {}
+
+
+def cached_tool_result(chat_id: str, command: str) -> Optional[Any]:
+    """
+    Result of an identical cacheable command that ran earlier in the chat, if it is still valid.
+    """
+    if tool_cache_ttl(command) <= 0:
+        return None
+    cache = _chat_tool_caches.get(chat_id)
+    result = cache.get(command) if cache is not None else None
+    metrics.increment("tool_cache_hits" if result is not None else "tool_cache_misses")
+    return result
+
+
+async def execute_tool_cached(user, chat_id: str, toolname: str, command: str, on_output: Optional[Callable[[str], Awaitable[Any]]] = None):
+    """
+    execute_tool for a shell command of a chat. Results of cacheable commands are kept for
+    cached_tool_result, any command that isn't read-only invalidates what the chat has cached.
+    """
+    cache = _chat_tool_caches.setdefault(chat_id, ChatToolCache())
+    read_only = is_read_only_command(command)
+    ttl = tool_cache_ttl(command) if read_only else 0.0
+    if not read_only:
+        cache.invalidate()
+    generation = cache.generation
+    try:
+        result = await execute_tool(user, toolname, params={"command": command}, on_output=on_output)
+    finally:
+        if not read_only:
+            # reads that started while this command ran may have seen a partial change
+            cache.invalidate()
+    if ttl > 0:
+        cache.put(command, result, generation, ttl)
+    return result
+
+
+def clear_tool_cache(chat_id: str):
+    _chat_tool_caches.pop(chat_id, None)
+
+
+def _chat_slots(chat_id: str) -> asyncio.Semaphore:
+    slots = _chat_tool_slots.get(chat_id)
+    if slots is None:
+        slots = asyncio.Semaphore(TOOL_CHAT_CONCURRENCY)
+        _chat_tool_slots[chat_id] = slots
+    return slots
+
+
+class ToolCallExecutor:
+    """
+    Runs the tool calls of one agent turn, concurrently where that is safe.
+
+    Read-only calls run in parallel with each other. A call that may change state waits for every
+    earlier call and every later call waits for it, so writes keep their original order. Results are
+    returned in submission order regardless of completion order.
+    """
+
+    def __init__(self, chat_id: str, run: Callable[[str], Awaitable[Any]], sequential: bool = False):
+        self.chat_id = chat_id
+        self.sequential = sequential
+        self._run = run
+        self._calls: List[asyncio.Task] = []
+        # last call that may change state, and the read-only calls started after it
+        self._barrier: Optional[asyncio.Task] = None
+        self._since_barrier: List[asyncio.Task] = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def submit(self, tool_call: str):
+        try:
+            _, command = parse_tool_call(tool_call)
+        except ValueError:
+            # malformed, runs in order and fails there
+            command = None
+        parallel = not self.sequential and command is not None and is_read_only_command(command)
+        waits_for = [self._barrier] if self._barrier is not None else []
+        if not parallel:
+            waits_for += self._since_barrier
+        call = asyncio.create_task(self._execute(tool_call, waits_for))
+        self._calls.append(call)
+        if parallel:
+            self._since_barrier.append(call)
+        else:
+            self._barrier = call
+            self._since_barrier = []
+
+    async def _execute(self, tool_call: str, waits_for: List[asyncio.Task]):
+        if waits_for:
+            # an earlier failure is reported through that call, this one still waits for it to finish
+            await asyncio.wait(waits_for)
+        chat_slots = _chat_slots(self.chat_id)
+        async with chat_slots, _tool_slots:
+            return await self._run(tool_call)
+
+    async def results(self) -> List[Any]:
+        """
+        Waits for all submitted calls and returns their results in submission order.
+        """
+        try:
+            return list(await asyncio.gather(*self._calls))
+        except BaseException:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        for call in self._calls:
+            call.cancel()
+
+
+metrics.register_gauge("tool_cache_chats", lambda: len(_chat_tool_caches))
@@ -0,0 +1,123 @@
+"""
+Compares Ollama prompt evaluation of the old and the layered prompt layout for subtask loops.
+
+Runs the same subtasks (one agent, different task descriptions) with a few turns each against
+Ollama's /api/chat, once with the persona and task at the start of the prompt as before and once
+with the fixed instructions first (app.prompts), and prints the prompt tokens Ollama had to evaluate,
+the time it took and what the layered layout saves, for every turn of a task. Both runs use the same
+request options (keep_alive, num_ctx, ...), so only the layout differs.
+
+    python benchmarks/prompt_prefix.py --model qwen2.5-coder:32b --tasks 4 --turns 3
+"""
+import argparse
+import os
+import statistics
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.prompts import SUBTASK_INSTRUCTIONS, layered_messages  # noqa: E402
+
+AGENT = {
+    "role": "DevOps Engineer",
+    "background": "Ten years of running Kubernetes clusters and CI pipelines",
+    "skills": "bash, git, kubectl, helm, terraform",
+    "tools": "shell, git, kubectl, helm",
+}
+CONTEXT = "Repository https://example.com/acme/service, deployments go through pull requests"
+TASKS = [
+    "Clone the repository and list the helm charts it contains",
+    "Check which image tag the staging deployment is running",
+    "Find the CI job that builds the container image and show its last log lines",
+    "List the open pull requests that touch the helm chart",
+    "Show the resource limits of the api deployment",
+    "Find the terraform module that creates the database",
+]
+TOOL_OUTPUT = "total 12\ndrwxr-xr-x 2 root root 4096 charts\n-rw-r--r-- 1 root root  220 README.md\n" * 8
+
+
+def legacy_messages(task: str) -> list:
+    return [
+        {"role": "system", "content": f"You are: {AGENT}"},
+        {"role": "user", "content": f'''Shell is available
+                        shell("command") # execute bash/shell commands to create edit files, use cli tools, call APIs
+                        whenever you want use the shell use "shell('command')" in the tool calls. you can execute multiple shell commands. Just use multiple entries in the tool_calls list.
+                        As long as the task is not done you can continue to execute tools. If you are done set done=true and provide a message to the user.
+                        Context Informtion: {CONTEXT}
+                        Based on who you are, your background skills and tools, solve the current task:
+                        {task}
+                '''},
+    ]
+
+
+def layered(task: str) -> list:
+    return layered_messages(SUBTASK_INSTRUCTIONS, f"Context Informtion: {CONTEXT}\n\nCurrent task:\n{task}", persona=str(AGENT))
+
+
+def chat(client: httpx.Client, args, messages: list) -> dict:
+    body = {
+        "model": args.model,
+        "messages": messages,
+        "stream": False,
+        "keep_alive": args.keep_alive,
+        "options": {"num_predict": args.num_predict, "num_ctx": args.num_ctx, "temperature": 0},
+    }
+    response = client.post(f"{args.url}/api/chat", json=body)
+    response.raise_for_status()
+    return response.json()
+
+
+def run(client: httpx.Client, args, build) -> list:
+    """Returns per turn the (prompt tokens evaluated, prompt eval ms) of each task."""
+    turns = [[] for _ in range(args.turns)]
+    for task in TASKS[:args.tasks]:
+        messages = build(task)
+        for turn in range(args.turns):
+            result = chat(client, args, messages)
+            turns[turn].append((result.get("prompt_eval_count", 0), result.get("prompt_eval_duration", 0) / 1e6))
+            messages.append({"role": "assistant", "content": result["message"]["content"]})
+            messages.append({"role": "system", "content": f"Tool shell executed with params ls -l res {TOOL_OUTPUT}"})
+    return turns
+
+
+def means(samples: list) -> tuple:
+    return statistics.mean(v[0] for v in samples), statistics.mean(v[1] for v in samples)
+
+
+def report(legacy: list, layered_results: list):
+    saved_total = 0.0
+    for turn, (old, new) in enumerate(zip(legacy, layered_results), start=1):
+        for name, samples in (("legacy", old), ("layered", new)):
+            tokens, ms = means(samples)
+            print(f"turn {turn:<3} {name:<10} calls {len(samples):>3}  prompt tokens evaluated {tokens:>8.1f}  prompt eval {ms:>9.1f} ms")
+        saved_tokens = means(old)[0] - means(new)[0]
+        saved = means(old)[1] - means(new)[1]
+        saved_total += saved
+        print(f"turn {turn:<3} saved      {saved_tokens:>8.1f} tokens  {saved:>9.1f} ms per call")
+    print(f"prompt eval saved per subtask of {len(legacy)} turns: {saved_total:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default=os.getenv("OLLAMA_URL", "http://localhost:11434"))
+    parser.add_argument("--model", default="qwen2.5-coder:32b")
+    parser.add_argument("--tasks", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--num-ctx", type=int, default=8192)
+    parser.add_argument("--num-predict", type=int, default=16)
+    parser.add_argument("--keep-alive", default="30m")
+    args = parser.parse_args()
+
+    with httpx.Client(timeout=600) as client:
+        # load the model so neither layout pays for it
+        chat(client, args, [{"role": "user", "content": "hi"}])
+        legacy = run(client, args, legacy_messages)
+        layered_results = run(client, args, layered)
+
+    report(legacy, layered_results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import asyncio
 
+from contextlib import asynccontextmanager
 import datetime
 import os
 from typing import Dict, List, Optional
@@ -13,7 +14,11 @@ import logging
 
 from sse_starlette import EventSourceResponse
 
-from app.queue import add_queue_for_chat, add_to_queue, remove_queue_for_chat
+from app.auth import AUTH_MODE, jwks_refresh_loop, verify_token
+from app.http_client import close_http_client, get_http_client
+from app import admission, metrics
+from app.queue import add_queue_for_chat, add_to_queue, paced_stream, reap_idle_queues, remove_queue_for_chat
+from app.tasks import cancel_chat_task, start_chat_task
 logger = logging.getLogger(__name__)
 
 from dotenv import load_dotenv
@@ -29,38 +34,10 @@ logging.basicConfig(
 import uvicorn
 
 import os
-import requests
 
 from fastapi import HTTPException, Header, Depends, status
 
 
-def introspect_token(token: str) -> dict:
-    if token is None: 
-       raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token introspection failed"
-        ) 
-    ctoken = token.split(" ", 1)[1] if token.startswith("Bearer ") else token
-    introspection_url = "https://auth.agentsphere.cloud/realms/agentsphere/protocol/openid-connect/token/introspect"
-
-    client_id = "agentserver"
-    client_secret = os.getenv("CLIENT_SECRET")
-
-    logger.debug(f"id {client_id} sec {client_secret}")
-    response = requests.post(
-        introspection_url,
-        headers={"Content-Type":"application/x-www-form-urlencoded"},
-        data={"token": ctoken, "client_id": client_id, "client_secret": client_secret}
-    )
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token introspection failed"
-        )
-
-
 from pydantic import BaseModel, Field
 
 class User(BaseModel):
@@ -87,19 +64,30 @@ def get_user_headers(
     }
 
 
-def get_user(user_headers: dict = Depends(get_user_headers)):
-    introspect_token(user_headers.get("token", None))
+async def get_user(user_headers: dict = Depends(get_user_headers)):
+    await verify_token(user_headers.get("token", None))
     return User(**user_headers)
 
-def validate_token(token_header: dict = Depends(get_user_headers)):
+async def validate_token(token_header: dict = Depends(get_user_headers)):
     logger.debug(f"token_header {token_header}")
-    introspect_token(token_header.get("token", None))
+    await verify_token(token_header.get("token", None))
     return
 
 
 logger=logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_http_client()
+    jwks_task = asyncio.create_task(jwks_refresh_loop()) if AUTH_MODE == "local" else None
+    reaper_task = asyncio.create_task(reap_idle_queues())
+    yield
+    reaper_task.cancel()
+    if jwks_task:
+        jwks_task.cancel()
+    await close_http_client()
+
+app = FastAPI(lifespan=lifespan)
 class Message(BaseModel):
     role: str
     content: str
@@ -158,6 +146,10 @@ def list_models(token: str = Depends(validate_token)):
 def get_version(token: str = Depends(validate_token)):
     return {"version": "0.5.7"}
 
+@app.get("/metrics")
+def get_metrics(token: str = Depends(validate_token)):
+    return metrics.snapshot()
+
 from datetime import datetime, timezone, timedelta
 tz_offset = -8  # Offset in hours
 tzinfo = timezone(timedelta(hours=tz_offset))
@@ -184,7 +176,7 @@ class CallbackData(BaseModel):
 
 @app.post("/callback/{chat_id}")
 async def subagent_callback(chat_id: str, data: CallbackData):
-    add_to_queue(chat_id, data.data)
+    await add_to_queue(chat_id, data.data)
     return {"status": "ok"}
 
 import json
@@ -225,13 +217,19 @@ async def handle_models(request: ChatRequest,user: str = Depends(get_user)):
     logger.debug(f"Incoming request: {request}")
 
     if request.stream:
+        if admission.overloaded():
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(int(admission.LLM_QUEUE_SLO))},
+            )
+
         # Generate a unique chat ID
         chat_id = str(uuid.uuid4())
         logger.debug(f"Generated chat_id: {chat_id}")
 
-        # Create a new asyncio.Queue for streaming messages
-        queue = asyncio.Queue()
-        add_queue_for_chat(chat_id, queue)
+        # Create a new bounded queue for streaming messages
+        queue = add_queue_for_chat(chat_id)
         logger.info(f"Queue created for chat_id: {chat_id}")
 
         async def event_stream():
@@ -240,18 +238,18 @@ async def handle_models(request: ChatRequest,user: str = Depends(get_user)):
             """
             try:
                 userRequest=request.messages[0].content
-                asyncio.create_task(process_request(user=user, chat_id=chat_id,request=userRequest))
-
-                while True:
-                    # Wait for the next message from the queue
-                    msg = await queue.get()
-                    if msg == "[DONE]":
-                        logger.info(f"Streaming completed for chat_id: {chat_id}")
-                        yield getResponseObject("", finish=True) + "\n"
-                        break
+                start_chat_task(chat_id, process_request(user=user, chat_id=chat_id,request=userRequest))
+
+                # Frames are paced and coalesced by paced_stream until process_request sends [DONE]
+                async for msg in paced_stream(queue):
                     yield stream_response(msg) + "\n"
+                logger.info(f"Streaming completed for chat_id: {chat_id}")
+                yield getResponseObject("", finish=True) + "\n"
 
             finally:
+                # Starlette closes this generator when the client disconnects, stop the agent so it
+                # doesn't keep running for nobody. No-op if the pipeline already sent [DONE].
+                cancel_chat_task(chat_id, "client disconnected")
                 # Cleanup: Remove the queue after streaming is done
                 logger.info(f"Cleaning up queue for chat_id: {chat_id}")
                 remove_queue_for_chat(chat_id)
@@ -0,0 +1,4 @@
+import os
+
+# importing app loads litellm, which otherwise fetches its model cost map in the background
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
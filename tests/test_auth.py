@@ -0,0 +1,165 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+
+from app import auth
+from app.http_client import close_http_client
+
+ISSUER = "https://auth.example.test/realms/test"
+AUDIENCE = "agentserver"
+
+
+def keypair(kid):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private.public_key()))
+    return private, {**jwk, "kid": kid, "use": "sig", "alg": "RS256"}
+
+
+@pytest.fixture
+def jwks(tmp_path, monkeypatch):
+    """Writes a JWKS file with one key, yields (private key, write(*jwks entries), fetch count)."""
+    path = tmp_path / "jwks.json"
+    private, jwk = keypair("k1")
+
+    def write(*keys):
+        path.write_text(json.dumps({"keys": list(keys)}))
+
+    write(jwk)
+    fetches = []
+    fetch_jwks = auth._fetch_jwks
+
+    async def counting_fetch():
+        fetches.append(time.time())
+        return await fetch_jwks()
+
+    monkeypatch.setattr(auth, "JWKS_FILE", str(path))
+    monkeypatch.setattr(auth, "_fetch_jwks", counting_fetch)
+    monkeypatch.setattr(auth, "TOKEN_ISSUER", ISSUER)
+    monkeypatch.setattr(auth, "TOKEN_AUDIENCE", AUDIENCE)
+    monkeypatch.setattr(auth, "_jwks", {})
+    monkeypatch.setattr(auth, "_jwks_fetched_at", 0.0)
+    # the lock belongs to the event loop of the test that first used it
+    monkeypatch.setattr(auth, "_jwks_lock", asyncio.Lock())
+    return private, write, fetches
+
+
+def token(private, kid="k1", **claims):
+    claims = {"iss": ISSUER, "aud": AUDIENCE, "sub": "user", "exp": int(time.time()) + 300, **claims}
+    return jwt.encode(claims, private, algorithm="RS256", headers={"kid": kid})
+
+
+def verify(token):
+    return asyncio.run(auth.verify_jwt(token))
+
+
+def rejected(token):
+    with pytest.raises(HTTPException) as e:
+        verify(token)
+    return e.value.status_code == 401
+
+
+def test_valid_token(jwks):
+    private, _, _ = jwks
+    assert verify(token(private))["sub"] == "user"
+
+
+def test_wrong_signature(jwks):
+    other, _ = keypair("k1")
+    assert rejected(token(other))
+
+
+def test_expired_token(jwks):
+    private, _, _ = jwks
+    assert rejected(token(private, exp=int(time.time()) - 60))
+
+
+def test_wrong_audience_or_issuer(jwks):
+    private, _, _ = jwks
+    assert rejected(token(private, aud="someone-else"))
+    assert rejected(token(private, iss="https://evil.example.test/realms/test"))
+
+
+def test_unknown_kid_refreshes_once(jwks, monkeypatch):
+    private, write, fetches = jwks
+    verify(token(private))
+    assert len(fetches) == 1
+    # a token with a key id we don't know triggers one refresh, further ones are rate limited
+    rotated, jwk = keypair("k2")
+    assert rejected(token(rotated, kid="k2"))
+    assert rejected(token(rotated, kid="k2"))
+    assert len(fetches) == 1
+
+    # after the interval the refresh picks up the realm's new key
+    write(jwk)
+    monkeypatch.setattr(auth, "_jwks_fetched_at", time.time() - auth.JWKS_MIN_REFRESH_INTERVAL - 1)
+    assert verify(token(rotated, kid="k2"))["sub"] == "user"
+    assert len(fetches) == 2
+
+
+def test_jwks_file(jwks):
+    _, write, _ = jwks
+    _, first = keypair("a")
+    _, second = keypair("b")
+    write(first, second, {**second, "kid": "enc", "use": "enc"})
+    assert asyncio.run(auth.refresh_jwks(force=True))
+    assert sorted(auth._jwks) == ["a", "b"]
+
+
+def test_refresh_loop_survives_errors(monkeypatch):
+    calls = []
+
+    async def refresh(force=False):
+        calls.append(force)
+        if len(calls) == 1:
+            raise RuntimeError("unexpected")
+
+    async def run():
+        loop = asyncio.create_task(auth.jwks_refresh_loop())
+        while len(calls) < 2:
+            await asyncio.sleep(0.01)
+        loop.cancel()
+
+    monkeypatch.setattr(auth, "refresh_jwks", refresh)
+    monkeypatch.setattr(auth, "JWKS_REFRESH_INTERVAL", 0)
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert len(calls) >= 2 and all(calls)
+
+
+def test_introspection_times_out(monkeypatch):
+    release = threading.Event()
+
+    class Hanging(BaseHTTPRequestHandler):
+        def do_POST(self):
+            release.wait(5)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Hanging)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(auth, "INTROSPECTION_URL", f"http://127.0.0.1:{server.server_port}/introspect")
+    monkeypatch.setattr(auth, "AUTH_HTTP_TIMEOUT", 0.2)
+
+    async def run():
+        try:
+            return await auth.introspect_token("Bearer hanging")
+        finally:
+            await close_http_client()
+
+    started = time.monotonic()
+    try:
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(asyncio.wait_for(run(), 5))
+        assert e.value.status_code == 401
+        assert time.monotonic() - started < 2
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,34 @@
+import json
+
+from app import classifier
+from app.classifier import RequestClassifier
+
+
+def test_requests_are_trimmed_with_the_examples(monkeypatch):
+    monkeypatch.setattr(classifier, "CLASSIFIER_MAX_EXAMPLES", 3)
+    store = RequestClassifier(path=None)
+    for i in range(5):
+        store.learn(f"request {i}", [1.0, 0.0], "code")
+    assert len(store) == 3
+    assert len(store._requests) == 3
+    # a request that was dropped is learned again, a kept one is not
+    store.learn("request 0", [1.0, 0.0], "code")
+    store.learn("request 4", [1.0, 0.0], "code")
+    assert [key for _, _, key in store._examples][-1] == classifier._request_key("request 0")
+    assert len(store._requests) == 3
+
+
+def test_request_texts_are_only_stored_when_enabled(tmp_path, monkeypatch):
+    path = tmp_path / "examples.jsonl"
+    RequestClassifier(path=str(path)).learn("secret request", [1.0, 0.0], "code")
+    monkeypatch.setattr(classifier, "CLASSIFIER_STORE_REQUESTS", True)
+    RequestClassifier(path=str(path)).learn("kept request", [0.0, 1.0], "chat")
+    examples = [json.loads(line) for line in path.read_text().splitlines()]
+    assert "request" not in examples[0] and "secret" not in path.read_text().splitlines()[0]
+    assert examples[1]["request"] == "kept request"
+
+    reloaded = RequestClassifier(path=str(path))
+    assert len(reloaded) == 2
+    reloaded.learn("secret request", [1.0, 0.0], "code")
+    reloaded.learn("kept request", [0.0, 1.0], "chat")
+    assert len(path.read_text().splitlines()) == 2
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.crawler import BrowserPool, Crawler, normalize_url
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Serves tmp_path over HTTP, yields (base URL, write(path, text), requested paths)."""
+    requested = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requested.append((self.path, time.monotonic()))
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=str(tmp_path)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def write(path, text):
+        file = tmp_path / path
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_text(text)
+
+    yield f"http://127.0.0.1:{server.server_port}", write, requested
+    server.shutdown()
+    server.server_close()
+
+
+def page(*links, text="some text"):
+    return "<html><body><p>" + text + "</p>" + "".join(f'<a href="{link}">{link}</a>' for link in links) + "</body></html>"
+
+
+def sitemap(*urls, index=False):
+    tag, entry = ("sitemapindex", "sitemap") if index else ("urlset", "url")
+    entries = "".join(f"<{entry}><loc>{url}</loc></{entry}>" for url in urls)
+    return f'<?xml version="1.0" encoding="UTF-8"?><{tag} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</{tag}>'
+
+
+class FakeBrowsers:
+    def __init__(self, html):
+        self.html = html
+        self.fetched = []
+
+    async def fetch(self, url):
+        self.fetched.append(url)
+        return self.html
+
+    def close(self):
+        pass
+
+
+def crawl(seeds, **kwargs):
+    kwargs.setdefault("rate", 0)
+    kwargs.setdefault("browsers", FakeBrowsers(page()))
+    crawler = Crawler(seeds, **kwargs)
+
+    async def collect():
+        return [p async for p in crawler.pages()]
+
+    return crawler, asyncio.run(asyncio.wait_for(collect(), 10))
+
+
+def test_normalize_url():
+    assert normalize_url("HTTP://Example.com:80/a/#frag") == "http://example.com/a"
+    assert normalize_url("../b?x=1", base="https://example.com/a/c") == "https://example.com/b?x=1"
+    assert normalize_url("mailto:someone@example.com") is None
+
+
+def test_sitemap(site):
+    base, write, _ = site
+    write("a.html", page("b.html"))
+    write("b.html", page())
+    write("sitemap.xml", sitemap(f"{base}/a.html"))
+    _, pages = crawl([f"{base}/sitemap.xml"], max_depth=2)
+    # pages from a sitemap are not followed, the sitemap lists every page
+    assert [p.url for p in pages] == [f"{base}/a.html"]
+
+
+def test_sitemap_index(site):
+    base, write, _ = site
+    write("a.html", page())
+    write("b.html", page())
+    write("pages.xml", sitemap(f"{base}/a.html", f"{base}/b.html"))
+    write("index.xml", sitemap(f"{base}/pages.xml", index=True))
+    _, pages = crawl([f"{base}/index.xml"])
+    assert sorted(p.url for p in pages) == [f"{base}/a.html", f"{base}/b.html"]
+
+
+def test_depth_limit(site):
+    base, write, _ = site
+    write("a.html", page("b.html"))
+    write("b.html", page("c.html"))
+    write("c.html", page())
+    _, pages = crawl([f"{base}/a.html"], max_depth=1)
+    assert sorted(p.url for p in pages) == [f"{base}/a.html", f"{base}/b.html"]
+
+
+def test_dedup_and_normalisation(site):
+    base, write, requested = site
+    host = base.replace("http://", "HTTP://")
+    write("a.html", page("b.html", "b.html#top", "/b.html", f"{host}/b.html", "./b.html"))
+    write("b.html", page("a.html"))
+    _, pages = crawl([f"{base}/a.html"], max_depth=3)
+    assert sorted(p.url for p in pages) == [f"{base}/a.html", f"{base}/b.html"]
+    assert sorted(path for path, _ in requested) == ["/a.html", "/b.html"]
+
+
+def test_same_site_only(site):
+    base, write, requested = site
+    other = base.replace("127.0.0.1", "localhost")
+    write("a.html", page(f"{other}/b.html", "https://example.com/", "b.html"))
+    write("b.html", page())
+    _, pages = crawl([f"{base}/a.html"])
+    assert sorted(p.url for p in pages) == [f"{base}/a.html", f"{base}/b.html"]
+    assert len(requested) == 2
+
+
+def test_rate_limit(site):
+    base, write, requested = site
+    write("a.html", page(*(f"p{i}.html" for i in range(4))))
+    for i in range(4):
+        write(f"p{i}.html", page())
+    crawl([f"{base}/a.html"], rate=10, concurrency=4)
+    times = sorted(t for _, t in requested)
+    assert len(times) == 5
+    # 4 intervals of 0.1s, minus the jitter of when the server sees each request
+    assert times[-1] - times[0] >= 0.35
+
+
+def test_javascript_pages_are_rendered(site):
+    base, write, requested = site
+    write("app.html", "<html><body><div id='root'></div><script src='app.js'></script></body></html>")
+    write("static.html", page("app.html", text="x" * 300))
+    write("rendered.html", page())
+    browsers = FakeBrowsers(page("rendered.html", text="rendered content"))
+    crawler, pages = crawl([f"{base}/static.html"], max_depth=2, browsers=browsers)
+    assert browsers.fetched == [f"{base}/app.html"]
+    assert crawler.rendered == 1
+    app = next(p for p in pages if p.url == f"{base}/app.html")
+    assert "rendered content" in app.html
+    # links are taken from the rendered page
+    assert f"{base}/rendered.html" in {p.url for p in pages}
+
+
+def test_unchanged_pages_are_requested_conditionally(site):
+    base, write, _ = site
+    write("a.html", page("b.html"))
+    write("b.html", page())
+    _, first = crawl([f"{base}/a.html"])
+    known = {p.url: {"etag": p.etag, "last_modified": p.last_modified, "links": p.links} for p in first}
+    crawler, second = crawl([f"{base}/a.html"], known=known)
+    assert crawler.unchanged == 2
+    assert all(p.html is None for p in second)
+    assert sorted(p.url for p in second) == sorted(p.url for p in first)
+
+
+def test_browser_start_failure_wakes_waiting_fetches():
+    class BrokenPool(BrowserPool):
+        def _start(self):
+            time.sleep(0.05)
+            raise RuntimeError("no browser")
+
+    async def fetch_all():
+        pool = BrokenPool(size=1)
+        return await asyncio.wait_for(asyncio.gather(*(pool.fetch(f"http://x/{i}") for i in range(3)), return_exceptions=True), 5)
+
+    results = asyncio.run(fetch_all())
+    assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,90 @@
+import pytest
+
+from app.document_store import SqliteDatabase
+
+
+@pytest.fixture
+def database(tmp_path):
+    return SqliteDatabase(str(tmp_path / "documents.db"))
+
+
+@pytest.fixture
+def sources(database):
+    sources = database["sources"]
+    sources.replace_one({"_id": "a"}, {"_id": "a", "doc_ids": ["x", "y"], "crawls": ["c1"]}, upsert=True)
+    sources.replace_one({"_id": "b"}, {"_id": "b", "doc_ids": ["y", "z"], "crawls": ["c1", "c2"]}, upsert=True)
+    sources.replace_one({"_id": "c"}, {"_id": "c", "doc_ids": [], "etag": "e"}, upsert=True)
+    return sources
+
+
+def ids(documents):
+    return sorted(d["_id"] for d in documents)
+
+
+def test_find(sources):
+    assert ids(sources.find()) == ["a", "b", "c"]
+    assert ids(sources.find({"_id": {"$in": ["a", "c", "missing"]}})) == ["a", "c"]
+    assert ids(sources.find({"_id": {"$in": []}})) == []
+    assert sources.find({"_id": "b"}) == [{"_id": "b", "doc_ids": ["y", "z"], "crawls": ["c1", "c2"]}]
+
+
+def test_find_in_list_fields(sources):
+    assert ids(sources.find({"doc_ids": {"$in": ["y"]}})) == ["a", "b"]
+    assert ids(sources.find({"doc_ids": {"$in": ["x", "z"]}})) == ["a", "b"]
+    assert ids(sources.find({"doc_ids": {"$in": ["nothing"]}})) == []
+    # a scalar field matches by its value
+    assert ids(sources.find({"etag": "e"})) == ["c"]
+    assert ids(sources.find({"crawls": "c2", "doc_ids": {"$in": ["y"]}})) == ["b"]
+
+
+def test_find_projection(sources):
+    assert sources.find({"_id": "a"}, {"_id": 1}) == [{"_id": "a"}]
+    assert sources.find({"_id": "a"}, {"crawls": 1}) == [{"_id": "a", "crawls": ["c1"]}]
+
+
+def test_find_one(sources):
+    assert sources.find_one({"_id": "a"})["doc_ids"] == ["x", "y"]
+    assert sources.find_one({"_id": "missing"}) is None
+
+
+def test_replace_one(sources):
+    sources.replace_one({"_id": "a"}, {"etag": "new"})
+    assert sources.find_one({"_id": "a"}) == {"_id": "a", "etag": "new"}
+    # without upsert a missing document stays missing
+    sources.replace_one({"_id": "d"}, {"etag": "d"})
+    assert sources.find_one({"_id": "d"}) is None
+    sources.replace_one({"_id": "d"}, {"etag": "d"}, upsert=True)
+    assert sources.find_one({"_id": "d"}) == {"_id": "d", "etag": "d"}
+
+
+def test_update_one(sources):
+    sources.update_one({"_id": "b"}, {"$set": {"crawls": ["c2"]}})
+    assert sources.find_one({"_id": "b"}) == {"_id": "b", "doc_ids": ["y", "z"], "crawls": ["c2"]}
+    sources.update_one({"_id": "missing"}, {"$set": {"crawls": []}})
+    assert sources.find_one({"_id": "missing"}) is None
+    with pytest.raises(ValueError):
+        sources.update_one({"_id": "b"}, {"$push": {"crawls": "c3"}})
+
+
+def test_delete(sources):
+    sources.delete_one({"doc_ids": {"$in": ["y"]}})
+    assert len(sources.find()) == 2
+    sources.delete_many({"_id": {"$in": ["a", "b"]}})
+    assert ids(sources.find()) == ["c"]
+    sources.delete_many({})
+    assert sources.find() == []
+
+
+def test_persists_and_collections_are_separate(tmp_path, sources):
+    database = SqliteDatabase(str(tmp_path / "documents.db"))
+    assert ids(database["sources"].find()) == ["a", "b", "c"]
+    assert database["docs"].find() == []
+
+
+def test_rejects_unsupported_filters(sources):
+    with pytest.raises(ValueError):
+        sources.find({"_id": {"$gt": "a"}})
+    with pytest.raises(ValueError):
+        sources.find({"a.b": 1})
+    with pytest.raises(ValueError):
+        SqliteDatabase(":memory:")["bad name"]
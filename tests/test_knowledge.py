@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import knowledge
+from app.crawler import Page
+from app.knowledge import KnowledgeStore, document_hash
+from app.pipeline import PipelineError
+
+SEED = "https://example.com/"
+
+
+class FakeCrawler:
+    """Yields the pages of site, html None for pages that are unchanged since the last crawl."""
+
+    def __init__(self, site, complete=True):
+        self.site = site
+        self.complete = complete
+
+    async def pages(self):
+        for url, html in self.site.items():
+            yield Page(url, html, None, None, [])
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Returns ingest(site, complete=True) against a fresh store, and the documents queries were generated for."""
+    store = KnowledgeStore(milvus_uri=str(tmp_path / "milvus.db"), dimension=4)
+    queried = []
+    slow = set()
+
+    async def getQueriesForDocument(doc):
+        queried.append(doc)
+        if doc == "bad":
+            raise RuntimeError("no queries")
+        if doc in slow:
+            await asyncio.sleep(0.5)
+        return SimpleNamespace(queries=[f"about {doc}"])
+
+    monkeypatch.setattr(knowledge, "store", store)
+    monkeypatch.setattr(knowledge, "emb_texts", lambda texts: [[0.1, 0.2, 0.3, 0.4] for _ in texts])
+    monkeypatch.setattr(knowledge, "getQueriesForDocument", getQueriesForDocument)
+    monkeypatch.setattr(knowledge, "getDocsFromHTML", lambda html: html.split("|"))
+
+    def ingest(site, complete=True):
+        monkeypatch.setattr(knowledge, "Crawler", lambda urls, **kwargs: FakeCrawler(site, complete))
+        queried.clear()
+        asyncio.run(asyncio.wait_for(knowledge.ingest([SEED]), 30))
+
+    yield SimpleNamespace(ingest=ingest, store=store, queried=queried, slow=slow)
+    if store._vector is not None:
+        store._vector.close()
+
+
+def documents(store):
+    """The stored documents and the documents that have vectors."""
+    docs = {d["doc"] for d in store.docs.find()}
+    hits = store.search([0.1, 0.2, 0.3, 0.4], limit=100)[0]
+    return docs, {hit["entity"]["query"][len("about "):] for hit in hits}
+
+
+def doc_ids(store, url):
+    return store.sources.find_one({"_id": url})["doc_ids"]
+
+
+def test_unchanged_pages_are_not_processed(run):
+    run.ingest({SEED + "a": "d1|d2", SEED + "b": "d3"})
+    assert sorted(run.queried) == ["d1", "d2", "d3"]
+    # a with the same content, b not modified (HTTP 304)
+    run.ingest({SEED + "a": "d1|d2", SEED + "b": None})
+    assert run.queried == []
+    assert doc_ids(run.store, SEED + "b") == [document_hash("d3")]
+    assert documents(run.store) == ({"d1", "d2", "d3"}, {"d1", "d2", "d3"})
+
+
+def test_changed_page_processes_only_new_documents(run):
+    run.ingest({SEED + "a": "d1|d2"})
+    run.ingest({SEED + "a": "d1|d4"})
+    assert run.queried == ["d4"]
+    assert doc_ids(run.store, SEED + "a") == [document_hash("d1"), document_hash("d4")]
+    assert documents(run.store) == ({"d1", "d4"}, {"d1", "d4"})
+
+
+def test_documents_shared_with_another_page_are_kept(run):
+    run.ingest({SEED + "a": "d1|d2", SEED + "b": "d2"})
+    run.ingest({SEED + "a": "d1", SEED + "b": None})
+    assert documents(run.store) == ({"d1", "d2"}, {"d1", "d2"})
+
+
+def test_removed_page(run):
+    run.ingest({SEED + "a": "d1", SEED + "b": "d2"})
+    run.ingest({SEED + "a": None})
+    assert run.store.sources.find_one({"_id": SEED + "b"}) is None
+    assert documents(run.store) == ({"d1"}, {"d1"})
+
+
+def test_incomplete_crawl_keeps_pages_it_did_not_reach(run):
+    run.ingest({SEED + "a": "d1", SEED + "b": "d2"})
+    run.ingest({SEED + "a": None}, complete=False)
+    assert doc_ids(run.store, SEED + "b") == [document_hash("d2")]
+    assert documents(run.store) == ({"d1", "d2"}, {"d1", "d2"})
+
+
+def test_failed_document_keeps_previous_version(run):
+    run.ingest({SEED + "a": "d1|d2", SEED + "b": "d3"})
+    with pytest.raises(PipelineError):
+        run.ingest({SEED + "a": "d1|bad"})
+    assert doc_ids(run.store, SEED + "a") == [document_hash("d1"), document_hash("d2")]
+    # nothing is removed after a failure
+    assert doc_ids(run.store, SEED + "b") == [document_hash("d3")]
+    assert documents(run.store) == ({"d1", "d2", "d3"}, {"d1", "d2", "d3"})
+    # the next run retries it
+    run.ingest({SEED + "a": "d1|d4", SEED + "b": None})
+    assert documents(run.store) == ({"d1", "d3", "d4"}, {"d1", "d3", "d4"})
+
+
+def test_document_moving_to_another_page_is_not_deleted(run):
+    run.ingest({SEED + "a": "x"})
+    # b finds x stored and waits for z, meanwhile a switches to y and no longer refers to x
+    run.slow.add("z")
+    run.ingest({SEED + "b": "x|z", SEED + "a": "y"})
+    assert doc_ids(run.store, SEED + "b") == [document_hash("x"), document_hash("z")]
+    assert documents(run.store) == ({"x", "y", "z"}, {"x", "y", "z"})
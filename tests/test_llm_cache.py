@@ -0,0 +1,32 @@
+import asyncio
+
+from app.llm_cache import LLMCache
+
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = LLMCache(size=1, path=path)
+    asyncio.run(cache.aput("a", "first"))
+    cache.put("b", "second")
+    # a was pushed out of memory by b
+    assert asyncio.run(cache.aget("a")) == "first"
+    assert LLMCache(path=path).get("b") == "second"
+    assert cache.get("missing") is None
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = LLMCache(size=0, path=str(tmp_path / "cache.db"), ttl=0)
+    cache.put("a", "first")
+    assert cache.get("a") is None
+
+
+def test_evicts_oldest_entries_once_over_the_limit(tmp_path):
+    cache = LLMCache(size=0, path=str(tmp_path / "cache.db"), max_entries=10)
+    for i in range(10):
+        cache.put(f"k{i}", str(i))
+    assert cache._rows == 10
+    cache.put("k10", "10")
+    # down to 90% of max_entries, the newest are kept
+    assert cache._rows == 9
+    assert cache.get("k1") is None
+    assert [cache.get(f"k{i}") for i in range(2, 11)] == [str(i) for i in range(2, 11)]
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from app.pipeline import PipelineError, Stage, run_pipeline
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def collector(results):
+    async def collect(item):
+        results.append(item)
+    return collect
+
+
+def test_items_pass_all_stages_with_several_workers():
+    results = []
+
+    async def double(item):
+        await asyncio.sleep(0.001 * (item % 3))
+        return [item * 2]
+
+    async def pair(item):
+        return [item, item]
+
+    stages = run(run_pipeline(range(20), [
+        Stage("double", double, concurrency=3),
+        Stage("pair", pair, concurrency=2),
+        Stage("collect", collector(results), concurrency=4),
+    ], queue_size=2))
+    assert sorted(results) == sorted([i * 2 for i in range(20)] * 2)
+    assert [(s.received, s.emitted, s.failed) for s in stages] == [(20, 20, 0), (20, 40, 0), (40, 0, 0)]
+
+
+def test_async_items():
+    results = []
+
+    async def items():
+        for i in range(5):
+            await asyncio.sleep(0)
+            yield i
+
+    run(run_pipeline(items(), [Stage("collect", collector(results), concurrency=2)]))
+    assert sorted(results) == list(range(5))
+
+
+def test_batches_leave_the_end_marker_for_other_workers():
+    batches = []
+
+    async def gather(batch):
+        batches.append(batch)
+
+    # all items and end markers are queued before a worker starts, the second batch runs into an end marker
+    stages = run(run_pipeline(range(5), [Stage("batch", gather, concurrency=2, batch_size=4)], queue_size=10))
+    assert batches == [[0, 1, 2, 3], [4]]
+    assert stages[0].received == 5
+
+
+def test_failing_item_raises_after_the_rest_has_drained():
+    results = []
+
+    async def check(item):
+        if item == 3:
+            raise ValueError("bad item")
+        await asyncio.sleep(0.01)
+        return [item]
+
+    with pytest.raises(PipelineError) as error:
+        run(run_pipeline(range(10), [Stage("check", check, concurrency=2), Stage("collect", collector(results))]))
+    assert sorted(results) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert [stage.failed for stage in error.value.stages] == [1, 0]
+    assert "check: 1" in str(error.value)
+
+
+def test_cancellation_stops_all_stages():
+    cancelled = []
+
+    async def block(item):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(item)
+            raise
+
+    async def main():
+        before = asyncio.all_tasks()
+        task = asyncio.create_task(run_pipeline(range(3), [Stage("block", block, concurrency=3)]))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        return asyncio.all_tasks() - before
+
+    assert run(main()) == set()
+    assert sorted(cancelled) == [0, 1, 2]
@@ -0,0 +1,41 @@
+import asyncio
+
+import litellm
+import pytest
+
+from app import routing
+from app.routing import MODEL_LARGE, MODEL_SMALL, cascade, models_for
+
+
+def test_cheap_stages_start_on_the_small_model():
+    for stage in ("categorize", "summarize", "queries"):
+        assert models_for(stage) == [MODEL_SMALL, MODEL_LARGE]
+    assert models_for("subtask") == [MODEL_LARGE]
+
+
+def test_missing_small_model_escalates():
+    calls = []
+
+    async def call(model):
+        calls.append(model)
+        if model == MODEL_SMALL:
+            raise litellm.NotFoundError(message="model not found, try pulling it first", model=model, llm_provider="ollama")
+        return "42"
+
+    assert asyncio.run(cascade("categorize", call, int)) == 42
+    assert calls == [MODEL_SMALL, MODEL_LARGE]
+
+
+def test_invalid_output_escalates_and_last_tier_raises():
+    async def call(model):
+        return "not a number"
+
+    with pytest.raises(ValueError):
+        asyncio.run(cascade("queries", call, int))
+
+
+def test_routes_override_defaults(monkeypatch):
+    monkeypatch.setattr(routing, "routes", routing._parse_routes("subtask:easy=small,answer=gpt-4o-mini,broken"))
+    assert models_for("subtask", "easy") == [MODEL_SMALL, MODEL_LARGE]
+    assert models_for("subtask", "hard") == [MODEL_LARGE]
+    assert models_for("answer") == ["gpt-4o-mini", MODEL_LARGE]
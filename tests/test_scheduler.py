@@ -0,0 +1,51 @@
+import asyncio
+
+from app.scheduler import TaskGraph
+
+
+def run_graph(run, tasks, **kwargs):
+    """Runs tasks {key: depends_on} and returns the outcomes and the (key, dependency) pairs skipped."""
+    skipped = []
+
+    async def on_skip(key, task, dep):
+        skipped.append((key, dep))
+
+    async def main():
+        graph = TaskGraph(run, on_skip=on_skip, **kwargs)
+        for key, depends_on in tasks.items():
+            graph.add(key, key, depends_on)
+        return await graph.wait()
+
+    return asyncio.run(asyncio.wait_for(main(), 5)), skipped
+
+
+def test_dependants_run_after_their_dependencies():
+    order = []
+
+    async def run(key, task):
+        await asyncio.sleep(0.01 * (3 - key))
+        order.append(key)
+
+    outcomes, skipped = run_graph(run, {1: [], 2: [1], 3: [1, 2]}, concurrency=3)
+    assert outcomes == {1: True, 2: True, 3: True}
+    assert order == [1, 2, 3] and skipped == []
+
+
+def test_failed_dependency_skips_its_dependants():
+    async def run(key, task):
+        if key == 1:
+            raise RuntimeError("failed")
+
+    outcomes, skipped = run_graph(run, {1: [], 2: [1], 3: [2], 4: []})
+    assert outcomes == {1: False, 2: False, 3: False, 4: True}
+    assert sorted(skipped) == [(2, 1), (3, 2)]
+
+
+def test_cancelled_dependency_skips_its_dependants():
+    async def run(key, task):
+        if key == 1:
+            raise asyncio.CancelledError()
+
+    outcomes, skipped = run_graph(run, {1: [], 2: [1], 3: []})
+    assert outcomes == {1: False, 2: False, 3: True}
+    assert skipped == [(2, 1)]
@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+from app import streaming
+from app.streaming import stream_completion
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+@pytest.fixture
+def events(monkeypatch):
+    events = []
+
+    @asynccontextmanager
+    async def llm_slot(stage=None):
+        events.append("acquire")
+        try:
+            yield
+        finally:
+            events.append("release")
+
+    async def acompletion(stream=False, **kwargs):
+        async def chunks():
+            for text in ("a", "b", "c"):
+                await asyncio.sleep(0)
+                yield chunk(text)
+        return chunks()
+
+    monkeypatch.setattr(streaming, "llm_slot", llm_slot)
+    monkeypatch.setattr(streaming.litellm, "acompletion", acompletion)
+    return events
+
+
+def test_slow_consumer_does_not_hold_the_slot(events):
+    async def on_delta(delta):
+        await asyncio.sleep(0.05)
+        events.append(delta)
+
+    content = asyncio.run(asyncio.wait_for(stream_completion(on_delta, model="ollama/test"), 5))
+    assert content == "abc"
+    assert events[0] == "acquire"
+    # the slot is released while the client is still taking the deltas, all of them in order
+    assert events.index("release") < events.index("c")
+    assert [e for e in events if e not in ("acquire", "release")] == ["a", "b", "c"]
+
+
+def test_on_delta_error_is_raised(events):
+    async def on_delta(delta):
+        raise RuntimeError("client gone")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(asyncio.wait_for(stream_completion(on_delta, model="ollama/test"), 5))
+    assert events == ["acquire", "release"]
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app import tools
+from app.http_client import close_http_client
+from app.models import User
+from app.tools import TOOL_CACHE_TTL, TOOL_CACHE_VOLATILE_TTL, execute_tool, get_tool_suggestions, is_cacheable_command, is_read_only_command, prefetch_tool_suggestions, tool_cache_ttl
+
+
+@pytest.mark.parametrize("command", [
+    "ls -la",
+    "cat README.md | grep -i foo",
+    "grep -rio pattern src",
+    "git status && git log --oneline -n 5",
+    "kubectl get pods -o yaml",
+    "find . -name '*.py' -o -name '*.md'",
+    "sed -n '1,5p' file.txt",
+    "sed 's/foo/bar/g' file.txt",
+    "sed -e 's/a/b/' -e '/^#/d' file.txt",
+    "ps -o pid,cmd",
+    "head -n 20 log.txt 2>/dev/null",
+])
+def test_read_only_commands(command):
+    assert is_read_only_command(command)
+
+
+@pytest.mark.parametrize("command", [
+    # programs that can change state with the right arguments
+    "yq -i '.a=1' f.yaml",
+    "awk 'BEGIN{system(\"rm x\")}'",
+    "date -s 2020-01-01",
+    "hostname foo",
+    "tree -o out",
+    # flags that write files
+    "git diff --output=x",
+    "git diff --output x",
+    "sort -o sorted.txt file.txt",
+    "sed -i 's/a/b/' f",
+    "sed --in-place 's/a/b/' f",
+    "sed -ni 's/a/b/p' f",
+    # sed scripts that write files or run commands
+    "sed -n 'w out' f",
+    "sed 'W out' f",
+    "sed '1e rm x' f",
+    "sed 's/a/b/w out' f",
+    "sed 's/a/b/e' f",
+    "sed -e 'p' -e 'w out' f",
+    "sed -ne 'w out' f",
+    "sed -f script.sed f",
+    # shell constructs
+    "echo hi > file",
+    "cat $(ls)",
+    "rm -rf build",
+    "find . -name '*.tmp' -delete",
+])
+def test_mutating_commands(command):
+    assert not is_read_only_command(command)
+
+
+@pytest.mark.parametrize("command", [
+    "ls -la",
+    "cat README.md | grep -i foo",
+    "grep -rn --include=*.py pattern src",
+    "head -n 20 log.txt",
+    "head -n5 log.txt",
+    "git status --short",
+    "git log --oneline -n 5",
+    "kubectl get pods -n default -o yaml",
+])
+def test_cacheable_commands(command):
+    assert is_cacheable_command(command)
+
+
+@pytest.mark.parametrize("command", [
+    # not read-only
+    "sed -i 's/a/b/' f",
+    "echo hi > file",
+    # read-only, but not an allowed shape
+    "tail -f log.txt",
+    "ps -o pid,cmd",
+    "kubectl logs pod",
+    "sed -n '1,5p' file.txt",
+    "git log -p",
+    "grep --color=always foo f",
+    "head -n",
+    "LANG=C ls",
+    "/bin/ls",
+])
+def test_uncacheable_commands(command):
+    assert not is_cacheable_command(command)
+
+
+def test_state_polled_by_agents_is_reused_briefly():
+    assert tool_cache_ttl("cat README.md") == TOOL_CACHE_TTL
+    assert tool_cache_ttl("kubectl get pods -n default") == TOOL_CACHE_VOLATILE_TTL
+    assert tool_cache_ttl("cat README.md && ls -l") == TOOL_CACHE_VOLATILE_TTL
+    assert tool_cache_ttl("echo hi > file") == 0
+
+
+@pytest.fixture
+def tool_server(monkeypatch):
+    """
+    Stub tool server, the test sets the content type and body it answers /tools/execute with.
+    The body is written in chunks without a content length, like streamed output.
+    """
+    response = {"content_type": "application/x-ndjson", "chunks": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("content-length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", response["content_type"])
+            self.end_headers()
+            for chunk in response["chunks"]:
+                self.wfile.write(chunk.encode())
+                self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(tools, "TOOL_SERVER_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(tools, "TOOL_LIVE_TAIL_INTERVAL", 0)
+    yield response
+    server.shutdown()
+    server.server_close()
+
+
+def run_tool(on_output=None):
+    async def run():
+        try:
+            return await execute_tool(User(id="1", username="u"), "bash sh", {"command": "x"}, on_output=on_output)
+        finally:
+            await close_http_client()
+
+    return asyncio.run(run())
+
+
+def ndjson(*events):
+    return [json.dumps(event) + "\n" for event in events]
+
+
+def test_streamed_output(tool_server):
+    tool_server["chunks"] = ndjson(
+        {"stream": "stdout", "data": "line 1\n"},
+        {"stream": "stderr", "data": "warning\n"},
+        {"stream": "stdout", "data": "line 2\n"},
+        {"exit_code": 0},
+    )
+    shown = []
+
+    async def on_output(text):
+        shown.append(text)
+
+    result = run_tool(on_output)
+    assert result == {"exit_code": 0, "stdout": "line 1\nline 2\n", "stderr": "warning\n"}
+    assert "line 2" in "\n".join(shown)
+
+
+def test_plain_text_output(tool_server):
+    tool_server["content_type"] = "text/plain"
+    tool_server["chunks"] = ["some ", "output\n"]
+    assert run_tool()["stdout"] == "some output\n"
+
+
+def test_streamed_output_keeps_head_and_tail(tool_server):
+    lines = [f"line {i:05d}\n" for i in range(5000)]
+    tool_server["chunks"] = ndjson(*({"stream": "stdout", "data": line} for line in lines), {"exit_code": 1})
+    result = run_tool()
+    total = sum(map(len, lines))
+    assert len(result["stdout"]) < tools.TOOL_OUTPUT_MAX_CHARS + 200
+    assert result["stdout"].startswith("line 00000\n")
+    assert result["stdout"].endswith("line 04999\n")
+    assert f"of {total} characters omitted" in result["stdout"]
+    assert result["exit_code"] == 1
+
+
+def test_streamed_output_is_spooled(tool_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(tools, "TOOL_SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(tools, "TOOL_SPOOL_MAX_FILES", 2)
+    monkeypatch.setattr(tools, "TOOL_SPOOL_BUFFER_CHARS", 100)
+    lines = [f"line {i:05d}\n" for i in range(2000)]
+    tool_server["chunks"] = ndjson(*({"stream": "stdout", "data": line} for line in lines), {"exit_code": 0})
+    results = [run_tool() for _ in range(3)]
+    with open(results[-1]["output_file"]) as f:
+        assert f.read() == "".join(lines)
+    assert results[-1]["output_file"] in results[-1]["stdout"]
+    # older outputs are rotated out
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(r["output_file"].rsplit("/", 1)[1] for r in results[1:])
+
+
+def test_plain_json_result_is_capped(tool_server):
+    tool_server["content_type"] = "application/json"
+    output = "".join(f"line {i:05d}\n" for i in range(5000))
+    tool_server["chunks"] = [json.dumps({"stdout": output, "stderr": "", "exit_code": 0})]
+    result = run_tool()
+    assert result["stdout"].startswith("line 00000\n") and result["stdout"].endswith("line 04999\n")
+    assert f"of {len(output)} characters omitted" in result["stdout"]
+    assert result["stderr"] == "" and result["exit_code"] == 0
+
+
+def test_small_plain_json_result_is_unchanged(tool_server):
+    tool_server["content_type"] = "application/json"
+    tool_server["chunks"] = [json.dumps({"stdout": "ok\n", "exit_code": 0})]
+    assert run_tool() == {"stdout": "ok\n", "exit_code": 0}
+
+
+@pytest.fixture
+def suggestions(monkeypatch):
+    """
+    Fresh suggestion caches and a fake tool server, yields the posted query lists. With
+    attributable=False the server answers with one result for the whole request.
+    """
+    posted = []
+    server = {"attributable": True}
+
+    async def post(queries):
+        posted.append(list(queries))
+        await asyncio.sleep(0.01)
+        if server["attributable"]:
+            return {q: {"tools": [f"tool for {q}"]} for q in queries}
+        return {"tools": [f"tool for {' + '.join(queries)}"]}
+
+    monkeypatch.setattr(tools, "_post_suggestions", post)
+    monkeypatch.setattr(tools, "_suggestions", OrderedDict())
+    monkeypatch.setattr(tools, "_pending_suggestions", {})
+    monkeypatch.setattr(tools, "_batching", True)
+    return posted, server
+
+
+def test_suggestions_are_batched_and_reused(suggestions):
+    posted, _ = suggestions
+
+    async def run():
+        prefetch_tool_suggestions(["List files", "b"], ["c"])
+        first = await get_tool_suggestions(["list  files", "b"])
+        second = await get_tool_suggestions(["b", "c"])
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert posted == [["list files", "b", "c"]]
+    assert first == {"list  files": {"tools": ["tool for list files"]}, "b": {"tools": ["tool for b"]}}
+    assert second == {"b": {"tools": ["tool for b"]}, "c": {"tools": ["tool for c"]}}
+
+
+def test_unattributable_suggestions_are_looked_up_per_task(suggestions):
+    posted, server = suggestions
+    server["attributable"] = False
+
+    async def run():
+        prefetch_tool_suggestions(["a", "b"], ["c"], ["a", "d"])
+        results = [await get_tool_suggestions(queries) for queries in (["a", "b"], ["c"], ["a", "d"])]
+        # once attribution failed there are no batch requests anymore
+        prefetch_tool_suggestions(["e", "f"], ["g"])
+        results.append(await get_tool_suggestions(["e", "f"]))
+        # a task that shares a query with another one still gets its own suggestions
+        results.append(await get_tool_suggestions(["a", "x"]))
+        return results
+
+    results = asyncio.run(run())
+    assert posted[0] == ["a", "b", "c", "d"]
+    assert sorted(posted[1:4]) == [["a", "b"], ["a", "d"], ["c"]]
+    assert sorted(posted[4:6]) == [["e", "f"], ["g"]]
+    assert posted[6:] == [["a", "x"]]
+    assert results == [
+        {"a; b": {"tools": ["tool for a + b"]}},
+        {"c": {"tools": ["tool for c"]}},
+        {"a; d": {"tools": ["tool for a + d"]}},
+        {"e; f": {"tools": ["tool for e + f"]}},
+        {"a; x": {"tools": ["tool for a + x"]}},
+    ]
+
+
+def test_cancelled_lookup_releases_waiting_tasks(suggestions):
+    async def run():
+        prefetch_tool_suggestions(["x"], ["y"])
+        for lookup in list(tools._suggestion_lookups):
+            lookup.cancel()
+        return await asyncio.wait_for(get_tool_suggestions(["x", "y"]), 1)
+
+    assert asyncio.run(run()) == {}
+    assert tools._pending_suggestions == {}